@@ -1,23 +1,88 @@
 #!/usr/bin/env python
 
 ## NECESSARY IMPORTS
-import sys
+import argparse
+import cProfile
+import importlib
 import json
 import os
 import shutil
 
-from src.data import make_dataset
-from src.features import build_features,metrics_analysis
-from src.models import make_models, evaluate_models
-from src.visualizations import make_visualizations, dimensionality_analysis
+from src.profiling import instrumentation
+from src.visualizations import render_queue
 
+# Figures are only saved to files, select the non-interactive backend before anything imports matplotlib
+os.environ.setdefault('MPLBACKEND', 'Agg')
+# umap compiles its numba functions with cache=True, keep the compiled code across runs (data/temp is cleaned)
+os.environ.setdefault('NUMBA_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'numba_cache'))
 
-def main(targets):
+PIPELINE_MODULES = ['src.data.make_dataset', 'src.features.build_features', 'src.features.metrics_analysis',
+                    'src.models.make_models', 'src.models.evaluate_models', 'src.visualizations.make_visualizations',
+                    'src.visualizations.dimensionality_analysis']
+
+# Modules (and with them qiime2, its plugins, umap, seaborn...) imported by each target, so light targets start fast
+TARGET_MODULES = {
+    'test': PIPELINE_MODULES,
+    'all': PIPELINE_MODULES + ['src.data.stage_cache', 'src.pipeline.scheduler', 'src.pipeline.stages'],
+    'ingest': PIPELINE_MODULES + ['src.data.stage_cache', 'src.pipeline.scheduler', 'src.pipeline.stages',
+                                  'src.pipeline.incremental'],
+    'tune': ['src.data.make_dataset', 'src.data.stage_cache', 'src.pipeline.scheduler', 'src.pipeline.stages',
+             'src.models.tuning'],
+    'predict': ['src.data.make_dataset', 'src.models.predict'],
+    'cache-stats': ['src.data.stage_cache'],
+    'clean': [],
+}
+
+# Parameter files of the stage graph context (see load_context)
+CONTEXT_FILES = [('file_paths', "config/data-params.json"),
+                 ('feature_params', "config/feature-params.json"),
+                 ('umap_params', "config/umap-params.json"),
+                 ('dim_analysis_params', "config/dim-analysis-params.json"),
+                 ('model_params', "config/model-params.json")]
+
+# Wall time, CPU time, peak RSS and input sizes of their public functions are written to data/out/profile.json
+PROFILED_MODULES = ['src.data.make_dataset', 'src.features.build_features', 'src.features.metrics_analysis',
+                    'src.models.make_models', 'src.visualizations.dimensionality_analysis',
+                    'src.visualizations.make_visualizations']
+
+
+def load_target(target):
+    """Import the modules of a target and instrument the profiled ones"""
+    modules = [importlib.import_module(name) for name in TARGET_MODULES.get(target, [])]
+    instrumentation.instrument_modules([m for m in modules if m.__name__ in PROFILED_MODULES])
+
+def load_context():
+    """Parameters available to every stage of the stage graph, keyed by name"""
+    context = {}
+    for name, path in CONTEXT_FILES:
+        with open(path) as fh:
+            context[name] = json.load(fh)
+    return context
+
+
+def main(targets, only=None, start_from=None, profile=False, render=None):
+    for target in targets:
+        load_target(target)
+    instrumentation.configure(artifact_shapes=profile)
+    # Figures and visualizations are saved by background processes while the pipeline computes
+    with open("config/render-params.json") as fh:
+        render_params = json.load(fh)
+    if render is not None:
+        render_params['mode'] = render
+    render_queue.configure(**render_params)
+    
     if "test" in targets:
+        from src.data import make_dataset
+        from src.features import build_features, metrics_analysis
+        from src.models import make_models, evaluate_models
+        from src.visualizations import make_visualizations, dimensionality_analysis
         if not os.path.exists("data/temp"):
             os.makedirs("data/temp")
         if not os.path.exists("data/out"):
             os.makedirs("data/out")
+        if profile:
+            profiler = cProfile.Profile()
+            profiler.enable()
         
         test_path_metadata="test/test_metadata.tsv"
         test_path_feature_table = "test/test_feature_table.qza"
@@ -37,7 +102,7 @@ def main(targets):
         make_visualizations.disease_counts_graph(organized_metadata,test_feature_params['disease_cols'])
         
         # Convert metadata dataframe to qiime Metadata object
-        qiime_metadata_tf = make_dataset.read_qiime_metadata("data/temp/final_metadata_tf.tsv")
+        qiime_metadata_tf = make_dataset.dataframe_to_qiime_metadata(organized_metadata_tf)
         filtered_table = make_dataset.filter_feature_table(feature_table, min_samples=1, metadata=qiime_metadata_tf)
         
         # Calculate distance matrix
@@ -61,108 +126,123 @@ def main(targets):
         # Model Performance 
         disease_accuracy_scores = evaluate_models.binary_relevance_accuracy_scores(binary_relevance_model, model_params['disease_targets'])
         make_visualizations.binary_relevance_accuracy_scores_graph(disease_accuracy_scores)
+        print(evaluate_models.training_report(disease_accuracy_scores))
+        make_dataset.flush_writes()
+        render_queue.wait()
+        if profile:
+            profiler.disable()
+            profiler.dump_stats('data/out/test.prof')
+        instrumentation.write_profile('data/out/profile.json')
         print('End')
         return binary_relevance_model
 
     
     if "all" in targets:
+        from src.data import make_dataset, stage_cache
+        from src.pipeline import scheduler, stages
         if not os.path.exists("data/temp"):
             os.makedirs("data/temp")
         if not os.path.exists("data/out"):
             os.makedirs("data/out")
             
-        with open("config/data-params.json") as fh:
-            file_paths = json.load(fh)
-            
-        # Reading feature table as Qiime Artifact and biom table
-        feature_table = make_dataset.read_feature_table(file_paths["feature_table_path"])
-        biom_table = make_dataset.feature_table_biom_view(feature_table)
-        # Reading metadata
-        metadata = make_dataset.read_metadata(file_paths["metadata_path"])
-        
-        # Reading Phylogenetic Tree
-        tree_artifact = make_dataset.read_tree_table(file_paths['tree_path']) 
-
-        ## Obtaining feature parameters
-        with open("config/feature-params.json") as fh:
-            feature_params = json.load(fh)
+        with open("config/cache-params.json") as fh:
+            cache = stage_cache.StageCache(before_store = stages.wait_for_side_files, **json.load(fh))
+        with open("config/pipeline-params.json") as fh:
+            pipeline_params = json.load(fh)
             
-        # Organizing metadata and returning two metadata tables
-        # organized_metadata: 0/1 binary; organized_metadata_tf:T/F binary 
-        organized_metadata, organized_metadata_tf = build_features.organize_metadata(metadata,biom_table.ids(),**feature_params)
-        
-        # Create disease count graph
-        make_visualizations.disease_counts_graph(organized_metadata, feature_params['disease_cols'])
+        # Parameters available to every stage
+        context = load_context()
+        make_dataset.configure_columnar(context['file_paths'].get('columnar_cache', False))
         
-        # Converting metadata dataframe to Qiime metadata object
-        qiime_metadata_tf = make_dataset.read_qiime_metadata("data/temp/final_metadata_tf.tsv") #Metadata with True and False booleans
-        qiime_metadata = make_dataset.read_qiime_metadata("data/temp/final_metadata.tsv") #Metadata with 1 and 0s floats
-        # Balance Precvd classes
-        qiime_metadata_precvd = build_features.balance_precvd(organized_metadata_tf)
-
-        
-        #DIMENSIONALITY ANALYSIS
-        print('Dimensionality Analysis')
-        
-        #Filtering metadata and feature table to only get samples with 1 target disease type, to remove disease ambiguity and perform supervised UMAP
-        metadata_df = qiime_metadata.to_dataframe()
-        feature_df_target_disease, target_disease_map, target_disease_dict = dimensionality_analysis.process_table_umap(feature_table, metadata_df, feature_params['disease_cols'])
-        
-        #Perform the supervised UMAP with params from json file
-        with open("config/umap-params.json") as fh:
-            umap_params = json.load(fh)
+        # Independent branches (UMAP, distances/PCoA/PERMANOVA, classifiers) run concurrently
+        all_stages = stages.all_stages()
+        results, timings = scheduler.run_pipeline(all_stages, context, n_workers = pipeline_params['n_workers'],
+                                                  cache = cache, only = only, start_from = start_from,
+                                                  profile_dir = "data/out/profiles" if profile else None)
+        make_dataset.flush_writes()
+        render_queue.wait()
+        instrumentation.write_profile('data/out/profile.json')
+        scheduler.print_timing_summary(all_stages, timings)
+        print(cache.stats())
+        print('END')
 
-        #Create the UMAP embeddings matrix and plot the UMAP results
-        umap_embedding = dimensionality_analysis.umap_plot_supervised(feature_df_target_disease, target_disease_map, target_disease_dict, **umap_params)
-        
+        return results.get('binary_relevance_model')
         
-        with open("config/dim-analysis-params.json") as fh:
-            dim_analysis_params = json.load(fh)
+    if 'ingest' in targets:
+        from src.data import make_dataset, stage_cache
+        from src.pipeline import scheduler, stages, incremental
+        with open("config/cache-params.json") as fh:
+            cache = stage_cache.StageCache(before_store = stages.wait_for_side_files, **json.load(fh))
+        with open("config/ingest-params.json") as fh:
+            ingest_params = json.load(fh)
+        context = load_context()
+        make_dataset.configure_columnar(context['file_paths'].get('columnar_cache', False))
         
-        # Minimum number of samples a given feature must be present in
-        min_samples = dim_analysis_params['filter_min_samples'] 
+        # Outputs of the last 'all' run, reloaded from the stage cache
+        results, _ = scheduler.run_pipeline(stages.all_stages(), context, n_workers = 1, cache = cache,
+                                            only = ['calculate_pcoa', 'umap_plot_supervised'])
+        new_table = make_dataset.read_feature_table(ingest_params['feature_table_path'])
+        updated = incremental.ingest_batch(results, new_table, context['file_paths'], context['feature_params'],
+                                           context['dim_analysis_params'])
         
-        # Filtering Feature Tables 
-        filtered_table = make_dataset.filter_feature_table(feature_table, min_samples, qiime_metadata_tf)
-        filtered_table_precvd = make_dataset.filter_feature_table(feature_table, min_samples, qiime_metadata_precvd)
+        # Saving the extended outputs
+        os.makedirs(ingest_params['out_dir'], exist_ok=True)
+        for metric, pcoa_result in updated.get('pcoa_results', {}).items():
+            pcoa_result.save(os.path.join(ingest_params['out_dir'], metric + '_pcoa'))
+        for metric, distance_matrix in updated.get('distance_matrices', {}).items():
+            if hasattr(distance_matrix, 'save'):
+                distance_matrix.save(os.path.join(ingest_params['out_dir'], metric + '_distance_matrix'))
+        for name in ['feature_table', 'filtered_table', 'rarefied_table']:
+            if name in updated:
+                updated[name].save(os.path.join(ingest_params['out_dir'], name))
+        if 'umap_embedding_new' in updated:
+            updated['umap_embedding_new'].to_csv(os.path.join(ingest_params['out_dir'], 'umap_new_samples.tsv'), sep='\t')
+        make_dataset.flush_writes()
+        render_queue.wait()
+        return updated
         
-            
-        rarefied_table = make_dataset.rarefy_feature_table(filtered_table, dim_analysis_params['rarefy_sampling_depth'])
-        # Obtain distance matrices
-        distance_matrices = metrics_analysis.calculate_distance_matrices(rarefied_table,metrics = dim_analysis_params['metrics'], phylogeny = tree_artifact)
+    if 'tune' in targets:
+        from src.data import stage_cache
+        from src.models import make_models, tuning
+        from src.pipeline import scheduler, stages
+        if not os.path.exists("data/out"):
+            os.makedirs("data/out")
+        with open("config/cache-params.json") as fh:
+            cache = stage_cache.StageCache(before_store = stages.wait_for_side_files, **json.load(fh))
+        context = load_context()
+        model_params = context['model_params']
         
-        # Obtain pcoa results based on distance matrices
-        pcoa_results = metrics_analysis.calculate_pcoa(distance_matrices, dim_analysis_params['pcoa_n_dimensions'])
+        # Feature table and disease metadata of the 'all' stage graph, reloaded from the stage cache
+        results, _ = scheduler.run_pipeline(stages.all_stages(), context, n_workers = 1, cache = cache,
+                                            only = ['qiime_metadata'])
+        disease_cols = make_models.disease_columns(results['qiime_metadata_tf'], results['qiime_metadata_precvd'],
+                                                   model_params['disease_targets'])
+        leaderboard = tuning.tune_binary_relevance(results['feature_table'], disease_cols, **model_params['tuning'])
+        print(leaderboard[leaderboard['rank'] <= 3].to_string())
+        return leaderboard
         
-        # Plot pcoa results
-        dimensionality_analysis.plot_pcoa(pcoa_results, qiime_metadata_tf)
+    if 'predict' in targets:
+        from src.data import make_dataset
+        from src.models import predict
+        if not os.path.exists("data/out"):
+            os.makedirs("data/out")
+        with open("config/predict-params.json") as fh:
+            predict_params = json.load(fh)
         
-        print('Permanova Test')
+        # Scoring new samples with the classifiers saved by the last 'all' run
+        feature_table = make_dataset.read_feature_table(predict_params['feature_table_path'])
+        disease_probabilities = predict.predict_diseases(feature_table, predict_params['model_dir'],
+                                                         chunk_size = predict_params['chunk_size'])
+        disease_probabilities.to_csv(predict_params['output_path'], sep='\t')
+        print(disease_probabilities.describe())
+        return disease_probabilities
         
-        # Permanova Tests - all diseases w/o precvd
-        metrics_analysis.permanova_test_all_diseases(distance_matrices['unweighted_unifrac'], distance_matrices['weighted_unifrac'], qiime_metadata_tf, feature_params['disease_cols'])
-
-        # Permanova Test - balanced precvd
-        distance_matrices_precvd = metrics_analysis.calculate_distance_matrices(filtered_table_precvd, metrics = dim_analysis_params['precvd_metrics'], phylogeny = tree_artifact)       
-
-        metrics_analysis.permanova_test(distance_matrices_precvd["unweighted_unifrac"], qiime_metadata_precvd.get_column('precvd_v2'),'u_unifrac')
-        metrics_analysis.permanova_test(distance_matrices_precvd["weighted_unifrac"], qiime_metadata_precvd.get_column('precvd_v2'),'w_unifrac')
-
-
-        ## Obtaining model params
-        with open("config/model-params.json") as fh:
-            model_params = json.load(fh)
-            
-        print('Model Training Begins')
-        # Creating machine learning model
-        binary_relevance_model = make_models.binary_relevance_model(feature_table, qiime_metadata_tf, qiime_metadata_precvd, **model_params)
-        
-        #Model Performance 
-        disease_accuracy_scores = evaluate_models.binary_relevance_accuracy_scores(binary_relevance_model, **model_params)
-        make_visualizations.binary_relevance_accuracy_scores_graph(disease_accuracy_scores)
-        print('END')
-
-        return binary_relevance_model
+    if 'cache-stats' in targets:
+        from src.data import stage_cache
+        with open("config/cache-params.json") as fh:
+            cache = stage_cache.StageCache(**json.load(fh))
+        print(cache.stats())
+        print('Cache size: %.2f GB' % (cache.size() / 1024 ** 3))
         
     if 'clean' in targets:
         try:
@@ -176,6 +256,15 @@ def main(targets):
 
 if __name__ == "__main__":
     # python run.py test
-    targets = sys.argv[1:]
-    main(targets)
+    # python run.py all --only calculate_pcoa / --from binary_relevance_model
+    parser = argparse.ArgumentParser()
+    parser.add_argument('targets', nargs='*')
+    parser.add_argument('--only', type=lambda x: x.split(','), help='comma separated stages to run with their dependencies')
+    parser.add_argument('--from', dest='start_from', type=lambda x: x.split(','),
+                        help='comma separated stages to run with their dependencies and everything downstream')
+    parser.add_argument('--profile', action='store_true', help='save a cProfile dump per stage to data/out/profiles')
+    parser.add_argument('--render', choices=render_queue.MODES,
+                        help='full, draft (low resolution figures) or skip figure and visualization renders')
+    args = parser.parse_args()
+    main(args.targets, only=args.only, start_from=args.start_from, profile=args.profile, render=args.render)
     
\ No newline at end of file
@@ -0,0 +1,197 @@
+import json
+import os
+import subprocess
+import time
+
+from qiime2 import Artifact
+import pandas as pd
+
+from src.benchmarks.synthetic_data import synthetic_metadata, synthetic_feature_table, synthetic_phylogeny
+from src.data import make_dataset
+from src.features import build_features, metrics_analysis
+from src.models import make_models
+from src.profiling.memory import PeakRSSMonitor
+from src.visualizations import render_queue
+from src.visualizations import dimensionality_analysis
+
+# Stage functions in pipeline order; each reads earlier outputs from values and returns its own outputs
+def organize_metadata(values, params):
+    organized_metadata, organized_metadata_tf = build_features.organize_metadata(
+        values['metadata'], values['sample_ids'], persist=False, **params['feature_params'])
+    return {'organized_metadata': organized_metadata,
+            'qiime_metadata_tf': make_dataset.dataframe_to_qiime_metadata(organized_metadata_tf)}
+
+def filter_feature_table(values, params):
+    if params['dim_analysis_params']['table_engine'] == 'sparse':
+        return {'filtered_table': make_dataset.filter_feature_matrix(make_dataset.feature_table_matrix(values['feature_table']),
+                                                                     params['filter_min_samples'], values['qiime_metadata_tf'].ids)}
+    return {'filtered_table': make_dataset.filter_feature_table(values['feature_table'], params['filter_min_samples'],
+                                                                values['qiime_metadata_tf'])}
+
+def rarefy_feature_table(values, params):
+    if params['dim_analysis_params']['table_engine'] == 'sparse':
+        rarefied = make_dataset.rarefy_feature_matrix(values['filtered_table'], params['rarefy_sampling_depth'])
+        return {'rarefied_table': make_dataset.feature_matrix_to_table(rarefied)}
+    return {'rarefied_table': make_dataset.rarefy_feature_table(values['filtered_table'], params['rarefy_sampling_depth'])}
+
+def calculate_distance_matrices(values, params):
+    return {'distance_matrices': metrics_analysis.calculate_distance_matrices(
+        values['rarefied_table'], params['metrics'], phylogeny=values['tree_artifact'],
+        n_jobs=params['dim_analysis_params']['n_jobs'], parallel_metrics=params['dim_analysis_params']['parallel_metrics'])}
+
+def calculate_pcoa(values, params):
+    dim_analysis_params = params['dim_analysis_params']
+    return {'pcoa_results': metrics_analysis.calculate_pcoa(values['distance_matrices'], dim_analysis_params['pcoa_n_dimensions'],
+                                                            method=dim_analysis_params['pcoa_method'],
+                                                            tol=dim_analysis_params['pcoa_tol'],
+                                                            n_landmarks=dim_analysis_params['pcoa_n_landmarks'])}
+
+def binary_relevance_model(values, params):
+    model_params = params['model_params']
+    return {'binary_relevance_model': make_models.binary_relevance_model(
+        make_dataset.feature_matrix_to_table(values['filtered_table']), values['qiime_metadata_tf'], values['qiime_metadata_tf'], model_params['disease_targets'],
+        n_workers=model_params['n_workers'], threads_per_worker=model_params['threads_per_worker'],
+        engine=model_params['engine'], estimator=model_params['estimator'], prefilter=model_params['prefilter'])}
+
+def umap_plot_supervised(values, params):
+    feature_df_target_disease, target_disease_map, target_disease_dict = dimensionality_analysis.process_table_umap(
+        values['feature_table'], values['organized_metadata'], params['feature_params']['disease_cols'], persist=False)
+    return {'umap_embedding': dimensionality_analysis.umap_plot_supervised(
+        feature_df_target_disease, target_disease_map, target_disease_dict, **params['umap_params'])}
+
+STAGES = [('organize_metadata', organize_metadata),
+          ('filter_feature_table', filter_feature_table),
+          ('rarefy_feature_table', rarefy_feature_table),
+          ('calculate_distance_matrices', calculate_distance_matrices),
+          ('calculate_pcoa', calculate_pcoa),
+          ('binary_relevance_model', binary_relevance_model),
+          ('umap_plot_supervised', umap_plot_supervised)]
+
+def current_commit():
+    """Short hash of the checked out commit, 'unknown' outside of a git checkout"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+def synthetic_inputs(n_samples, n_features, feature_params, features_per_sample=300, random_state=0):
+    """Generate the metadata, feature table and phylogeny of one benchmark size
+
+    Args:
+        n_samples (Int): Number of samples
+        n_features (Int): Number of features
+        feature_params (Dict): Feature parameters (disease_cols, additional_info_cols)
+        features_per_sample (Int, optional): Feature draws per sample. Defaults to 300.
+        random_state (Int, optional): Seed of the generators. Defaults to 0.
+
+    Returns:
+        Dict: metadata, sample_ids, feature_table (FeatureTable[Frequency]), tree_artifact (Phylogeny[Rooted]) and nnz
+    """
+    metadata = synthetic_metadata(n_samples, feature_params['disease_cols'], feature_params['additional_info_cols'],
+                                  random_state=random_state)
+    table = synthetic_feature_table(metadata.index, n_features, features_per_sample, random_state=random_state)
+    tree = synthetic_phylogeny(table.ids(axis='observation'), random_state=random_state)
+    return {'metadata': metadata,
+            'sample_ids': table.ids(),
+            'feature_table': Artifact.import_data('FeatureTable[Frequency]', table),
+            'tree_artifact': Artifact.import_data('Phylogeny[Rooted]', tree),
+            'nnz': table.nnz}
+
+def benchmark_size(n_samples, n_features, params):
+    """Time the stage functions on one synthetic dataset
+
+    Stages run in pipeline order on the outputs of the earlier ones. Stages missing from params['stages']
+    still run when a later selected stage needs their outputs, but are not reported.
+
+    Args:
+        n_samples (Int): Number of samples
+        n_features (Int): Number of features
+        params (Dict): Benchmark parameters with feature_params, dim_analysis_params, model_params and umap_params
+
+    Returns:
+        List: One record per reported stage
+    """
+    values = synthetic_inputs(n_samples, n_features, params['feature_params'], params['features_per_sample'],
+                              params['random_state'])
+    names = [name for name, _ in STAGES]
+    last = max(names.index(name) for name in params['stages'])
+    records = []
+    for name, func in STAGES[:last + 1]:
+        print('Benchmark: %s (%d samples x %d features)' % (name, n_samples, n_features))
+        with PeakRSSMonitor() as monitor:
+            start = time.perf_counter()
+            values.update(func(values, params))
+            seconds = time.perf_counter() - start
+        if name in params['stages']:
+            records.append({'stage': name, 'n_samples': n_samples, 'n_features': n_features, 'nnz': values['nnz'],
+                            'seconds': seconds, 'peak_rss_mb': monitor.peak_mb})
+    return records
+
+def benchmark_pipeline(params_path='config/benchmark-params.json', sizes=None):
+    """Time the stage functions at every configured size and append the results to the results table
+
+    Args:
+        params_path (String, optional): Benchmark parameters file. Defaults to 'config/benchmark-params.json'.
+        sizes (List, optional): [n_samples, n_features] pairs overriding the configured sizes. Defaults to None.
+
+    Returns:
+        DataFrame: Results of this run, one row per stage and size, tagged with the commit
+    """
+    with open(params_path) as fh:
+        params = json.load(fh)
+    for name, path in [('feature_params', 'config/feature-params.json'),
+                       ('dim_analysis_params', 'config/dim-analysis-params.json'),
+                       ('model_params', 'config/model-params.json'),
+                       ('umap_params', 'config/umap-params.json')]:
+        with open(path) as fh:
+            params[name] = json.load(fh)
+    if not os.path.exists('data/out'):
+        os.makedirs('data/out')
+    # Figures rendered inline so their cost is part of the stage timings, or skipped
+    render_queue.configure(mode=params['render_mode'], n_workers=0)
+
+    records = []
+    for n_samples, n_features in sizes or params['sizes']:
+        records += benchmark_size(n_samples, n_features, params)
+    results = pd.DataFrame(records)
+    results.insert(0, 'commit', current_commit())
+    results.insert(1, 'date', pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S'))
+    results.to_csv(params['results_path'], sep='\t', index=False, mode='a',
+                   header=not os.path.exists(params['results_path']))
+    return results
+
+def compare_commits(results_path, baseline, commit=None, threshold=1.2):
+    """Compare the stage timings of two commits in the results table
+
+    Args:
+        results_path (String): Results table written by benchmark_pipeline
+        baseline (String): Baseline commit
+        commit (String, optional): Compared commit. Defaults to None, the last commit in the table.
+        threshold (Float, optional): Time ratio above which a stage counts as a regression. Defaults to 1.2.
+
+    Returns:
+        DataFrame: Best time and peak RSS per stage and size for both commits, their ratio and regression flag
+    """
+    results = pd.read_csv(results_path, sep='\t', dtype={'commit': str})
+    commit = commit or results['commit'].iloc[-1]
+    keys = ['stage', 'n_samples', 'n_features']
+    best = results.groupby(['commit'] + keys).agg(seconds=('seconds', 'min'), peak_rss_mb=('peak_rss_mb', 'min'))
+    comparison = best.loc[baseline].join(best.loc[commit], lsuffix='_' + baseline, rsuffix='_' + commit, how='inner')
+    comparison['time_ratio'] = comparison['seconds_' + commit] / comparison['seconds_' + baseline]
+    comparison['memory_ratio'] = comparison['peak_rss_mb_' + commit] / comparison['peak_rss_mb_' + baseline]
+    comparison['regression'] = comparison['time_ratio'] > threshold
+    return comparison.reset_index()
+
+if __name__ == '__main__':
+    # python -m src.benchmarks.pipeline_benchmark [n_samples n_features]
+    # python -m src.benchmarks.pipeline_benchmark compare <baseline commit> [commit]
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'compare':
+        with open('config/benchmark-params.json') as fh:
+            results_path = json.load(fh)['results_path']
+        print(compare_commits(results_path, *sys.argv[2:4]).to_string())
+    elif len(sys.argv) == 3:
+        print(benchmark_pipeline(sizes=[[int(sys.argv[1]), int(sys.argv[2])]]).to_string())
+    else:
+        print(benchmark_pipeline().to_string())
@@ -0,0 +1,49 @@
+import subprocess
+import sys
+
+import pandas as pd
+
+# Imports run.py performs for a target, timed in a fresh interpreter
+TIMED_IMPORT = '''
+import time
+start = time.perf_counter()
+import run
+run.load_target({target!r})
+print(time.perf_counter() - start)
+'''
+
+def time_target_imports(target, repeats=3):
+    """Best time to start run.py and import the modules of a target, in a new process each time
+
+    Args:
+        target (String): run.py target
+        repeats (Int, optional): Number of timed interpreter starts. Defaults to 3.
+
+    Returns:
+        Float: Best import time in seconds
+    """
+    best = float('inf')
+    for _ in range(repeats):
+        output = subprocess.run([sys.executable, '-c', TIMED_IMPORT.format(target=target)], stdout=subprocess.PIPE,
+                                universal_newlines=True, check=True).stdout
+        best = min(best, float(output.strip().split('\n')[-1]))
+    return best
+
+def benchmark_startup(targets=None, repeats=3):
+    """Import time of every run.py target
+
+    Args:
+        targets (List, optional): Targets to time. Defaults to None, every target of run.TARGET_MODULES.
+        repeats (Int, optional): Number of timed interpreter starts per target. Defaults to 3.
+
+    Returns:
+        DataFrame: Best import time per target
+    """
+    import run
+    targets = targets or list(run.TARGET_MODULES)
+    return pd.DataFrame({'target': targets,
+                         'import_seconds': [time_target_imports(target, repeats) for target in targets]})
+
+if __name__ == '__main__':
+    # python -m src.benchmarks.startup_benchmark [target ...]
+    print(benchmark_startup(sys.argv[1:] or None).to_string(index=False))
@@ -0,0 +1,106 @@
+import io
+
+import biom
+import numpy as np
+import pandas as pd
+import skbio
+from scipy import sparse
+
+from src.data.make_dataset import MISSING_VALUES
+
+def synthetic_metadata(n_samples, disease_cols, additional_info_cols, missing_rate=0.05, random_state=0):
+    """Generate study metadata shaped like the Hispanic Community Health Study metadata
+
+    Disease columns hold 0/1 values (diabetes 1-3, ckd 1-5) mixed with 'not applicable'/'not provided',
+    additional columns hold age groups and origin strings. The table goes through a TSV round trip
+    so column dtypes match what read_metadata returns.
+
+    Args:
+        n_samples (Int): Number of samples (rows)
+        disease_cols (List): List of disease column names
+        additional_info_cols (List): List of additional metadata columns
+        missing_rate (Float, optional): Fraction of values replaced by missing value strings. Defaults to 0.05.
+        random_state (Int, optional): Seed of the generator. Defaults to 0.
+
+    Returns:
+        DataFrame: Metadata indexed by sample name
+    """
+    rng = np.random.RandomState(random_state)
+    index = pd.Index(['10317.%09d' % i for i in range(n_samples)], name='sample_name')
+    data = {}
+    for col in disease_cols:
+        if col == 'diabetes2_v2':
+            values = rng.randint(1, 4, n_samples).astype(float)
+        elif col == 'ckd_v2':
+            values = rng.randint(1, 6, n_samples).astype(float)
+        else:
+            values = rng.randint(0, 2, n_samples).astype(float)
+        data[col] = values.astype(object)
+    for col in additional_info_cols:
+        if col == 'hispanic_origin':
+            data[col] = rng.choice(['Mexican', 'Cuban', 'Puerto Rican', 'Dominican',
+                                    'Central American', 'South American'], n_samples).astype(object)
+        else:
+            data[col] = rng.randint(1, 7, n_samples).astype(object)
+    metadata = pd.DataFrame(data, index=index)
+    for col in metadata.columns:
+        missing = rng.rand(n_samples) < missing_rate
+        metadata.loc[missing, col] = rng.choice(MISSING_VALUES, missing.sum())
+
+    buffer = io.StringIO()
+    metadata.to_csv(buffer, sep='\t')
+    buffer.seek(0)
+    return pd.read_csv(buffer, sep='\t', index_col=0)
+
+def synthetic_feature_table(sample_ids, n_features, features_per_sample=300, random_state=0):
+    """Generate a sparse ASV count table
+
+    Feature popularity follows a power law, so a few features are present in most samples and most are rare,
+    and counts are log-normal, like an amplicon feature table. Every sample holds about features_per_sample
+    distinct features, so nonzeros scale with the number of samples and not with samples x features.
+
+    Args:
+        sample_ids (List): Sample ids, e.g. the synthetic_metadata index
+        n_features (Int): Number of features (ASVs)
+        features_per_sample (Int, optional): Number of feature draws per sample. Defaults to 300.
+        random_state (Int, optional): Seed of the generator. Defaults to 0.
+
+    Returns:
+        biom.Table: Feature table (features x samples)
+    """
+    rng = np.random.RandomState(random_state)
+    n_samples = len(sample_ids)
+    popularity = 1.0 / np.arange(1, n_features + 1) ** 0.8
+    popularity = rng.permutation(popularity / popularity.sum())
+    rows = rng.choice(n_features, size=n_samples * features_per_sample, p=popularity)
+    cols = np.repeat(np.arange(n_samples), features_per_sample)
+    counts = np.ceil(rng.lognormal(2.0, 1.5, size=rows.size))
+    # Repeated draws of a feature in a sample add up
+    data = sparse.coo_matrix((counts, (rows, cols)), shape=(n_features, n_samples)).tocsr()
+    feature_ids = ['ASV%07d' % i for i in range(n_features)]
+    return biom.Table(data, feature_ids, [str(x) for x in sample_ids])
+
+def synthetic_phylogeny(feature_ids, random_state=0):
+    """Generate a random rooted binary tree over the features
+
+    Tips are shuffled and joined pairwise level by level, so the tree depth stays logarithmic in the
+    number of features. Branch lengths are exponential.
+
+    Args:
+        feature_ids (List): Tip names
+        random_state (Int, optional): Seed of the generator. Defaults to 0.
+
+    Returns:
+        skbio.TreeNode: Rooted tree
+    """
+    rng = np.random.RandomState(random_state)
+    nodes = [skbio.TreeNode(name=x, length=rng.exponential(0.1)) for x in rng.permutation(feature_ids)]
+    while len(nodes) > 1:
+        joined = [skbio.TreeNode(children=nodes[i:i + 2], length=rng.exponential(0.1))
+                  for i in range(0, len(nodes) - 1, 2)]
+        if len(nodes) % 2:
+            joined.append(nodes[-1])
+        nodes = joined
+    root = nodes[0]
+    root.length = None
+    return root
@@ -1,33 +1,74 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import os
+
 from qiime2 import Artifact
 from qiime2 import Metadata
-from qiime2.plugins.feature_table.methods import filter_features, filter_samples, rarefy
 
+import numpy as np
 import pandas as pd
 import biom
+from scipy import sparse
+
+FeatureMatrix = namedtuple('FeatureMatrix', ['matrix', 'sample_ids', 'feature_ids'])
+
+# Single background thread saving intermediate tables off the critical path
+_WRITER = ThreadPoolExecutor(max_workers=1)
+_PENDING_WRITES = []
+# write_behind also saves a Parquet copy of every table when enabled, see configure_columnar
+_COLUMNAR = {'enabled': False}
 
 def read_feature_table(path):
     """Reads Feature Table
 
     Args:
-        path (String): Path of feature table file
+        path (String): Path of feature table file, or of a columnar copy saved by save_feature_matrix
 
     Returns:
-        FeatureTable[Frequency]: Feature Table
+        FeatureTable[Frequency]: Feature Table, FeatureMatrix for a columnar copy
     """
+    if os.path.isdir(path):
+        return load_feature_matrix(path)
     feature_table = Artifact.load(path)
     return feature_table
 
-def read_metadata(path):
+MISSING_VALUES = ['not applicable', 'not provided']
+
+def read_metadata(path, columns=None, required_cols=None, sample_ids=None, chunksize=None):
     """Reads Metadata file
 
     Args:
         path (String): Path of metadata file
+        columns (List, optional): Only read these columns, parsed as strings. Defaults to None, all columns.
+        required_cols (List, optional): Drop samples missing any of these columns. Defaults to None.
+        sample_ids (List, optional): Only keep these samples, e.g. the feature table sample ids. Defaults to None.
+        chunksize (Int, optional): Number of rows parsed at a time. Defaults to None, whole file at once.
 
     Returns:
         DataFrame: Metadata in dataframe format
     """
-    metadata = pd.read_csv(path, sep='\t', index_col=0)
-    return metadata
+    if columns is None and required_cols is None and sample_ids is None and chunksize is None:
+        metadata = pd.read_csv(path, sep='\t', index_col=0)
+        return metadata
+
+    header = pd.read_csv(path, sep='\t', nrows=0)
+    index_col = header.columns[0]
+    usecols = list(header.columns) if columns is None else [index_col] + list(columns)
+    # Strings keep every chunk's dtypes consistent, organize_metadata unifies numbers later
+    dtype = {index_col: str} if columns is None else {col: str for col in usecols}
+    sample_ids = None if sample_ids is None else pd.Index(sample_ids)
+
+    reader = pd.read_csv(path, sep='\t', index_col=0, usecols=usecols, dtype=dtype,
+                         chunksize=chunksize or 100000)
+    chunks = []
+    for chunk in reader:
+        if sample_ids is not None:
+            chunk = chunk[chunk.index.isin(sample_ids)]
+        if required_cols is not None:
+            required = chunk[required_cols]
+            chunk = chunk[(required.notna() & ~required.isin(MISSING_VALUES)).all(axis=1)]
+        chunks.append(chunk)
+    return pd.concat(chunks)
 
 def read_qiime_metadata(path):
     """Read metadata file in Qiime format
@@ -40,6 +81,88 @@ def read_qiime_metadata(path):
     """
     return Metadata.load(path)
 
+def dataframe_to_qiime_metadata(df):
+    """Convert a metadata dataframe to a qiime Metadata object in memory, typed as if it was saved and loaded as TSV
+
+    Args:
+        df (DataFrame): Metadata dataframe indexed by sample id
+
+    Returns:
+        METADATA: Metadata as qiime object
+    """
+    df = df.copy()
+    df.index = df.index.astype(str)
+    for col in df.columns:
+        # Object columns mixing numbers and strings are categorical once written as text
+        if df[col].dtype == object:
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    return Metadata(df)
+
+def configure_columnar(enabled=True):
+    """Also save a Parquet copy (see columnar_path) of every table written by write_behind
+
+    Args:
+        enabled (Boolean, optional): Save the Parquet copies, which needs pyarrow. Defaults to True.
+    """
+    if enabled:
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            raise ImportError('The columnar cache (columnar_cache in config/data-params.json) needs pyarrow')
+    _COLUMNAR['enabled'] = enabled
+
+def columnar_path(path):
+    """Path of the Parquet copy of a TSV table"""
+    return os.path.splitext(path)[0] + '.parquet'
+
+def _write_table(df, path):
+    df.to_csv(path, sep='\t')
+    if _COLUMNAR['enabled']:
+        df = df.copy()
+        for col in df.columns:
+            # Parquet columns have a single type, mixed object columns are saved as strings
+            if df[col].dtype == object:
+                df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+        df.to_parquet(columnar_path(path))
+
+def write_behind(df, path):
+    """Save a dataframe as TSV (and Parquet, see configure_columnar) on a background thread. The dataframe must not be modified afterwards.
+
+    Args:
+        df (DataFrame): Dataframe that will be saved
+        path (String): Path of the TSV file
+    """
+    _PENDING_WRITES.append(_WRITER.submit(_write_table, df, path))
+
+def read_columnar_table(path, columns=None, sample_ids=None):
+    """Load a table saved by write_behind from its Parquet copy, reading only the given columns and samples
+
+    Args:
+        path (String): Path of the TSV table or of its Parquet copy
+        columns (List, optional): Columns to read. Defaults to None, every column.
+        sample_ids (List, optional): Rows to read. Defaults to None, every row.
+
+    Returns:
+        DataFrame: Table indexed by sample id
+    """
+    import pyarrow.parquet as pq
+    path = path if path.endswith('.parquet') else columnar_path(path)
+    filters = None
+    if sample_ids is not None:
+        index_col = pq.read_schema(path).pandas_metadata['index_columns'][0]
+        filters = [(index_col, 'in', list(sample_ids))]
+    return pd.read_parquet(path, columns=columns, filters=filters)
+
+def flush_writes():
+    """Wait until all write_behind saves are on disk, re-raising any error they hit"""
+    for future in list(_PENDING_WRITES):
+        future.result()
+        try:
+            _PENDING_WRITES.remove(future)
+        except ValueError:
+            # Already flushed by another thread
+            pass
+
 def feature_table_biom_view(feature_table):
     """Reads feature table as biom table. Used to visualize feature table.
 
@@ -51,6 +174,75 @@ def feature_table_biom_view(feature_table):
     """
     return feature_table.view(biom.Table)
 
+def feature_table_matrix(feature_table):
+    """Materialize a feature table as a sparse sample x feature matrix
+
+    Args:
+        feature_table (FeatureTable[Frequency]): Feature table artifact, FeatureMatrix are returned unchanged
+
+    Returns:
+        FeatureMatrix: (csr_matrix samples x features, Index of sample ids, Index of feature ids)
+    """
+    if isinstance(feature_table, FeatureMatrix):
+        return feature_table
+    table = feature_table.view(biom.Table)
+    # biom stores observations x samples
+    X = table.matrix_data.T.tocsr()
+    X.eliminate_zeros()
+    sample_ids = pd.Index(table.ids(axis='sample'), name='SampleID')
+    feature_ids = pd.Index(table.ids(axis='observation'), name='featureid')
+    return FeatureMatrix(X, sample_ids, feature_ids)
+
+def align_features(feature_matrix, feature_ids):
+    """Reorder the columns of a FeatureMatrix to given features
+
+    Features missing from feature_ids are dropped, features missing from the matrix are zero.
+
+    Args:
+        feature_matrix (FeatureMatrix): Sparse samples x features
+        feature_ids (Index): Features of the output columns, in order
+
+    Returns:
+        FeatureMatrix: Samples x feature_ids
+    """
+    feature_ids = pd.Index(feature_ids)
+    X = feature_matrix.matrix.tocoo()
+    columns = feature_ids.get_indexer(feature_matrix.feature_ids)[X.col]
+    known = columns >= 0
+    X = sparse.csr_matrix((X.data[known], (X.row[known], columns[known])), shape=(X.shape[0], len(feature_ids)))
+    return FeatureMatrix(X, feature_matrix.sample_ids, feature_ids)
+
+def _as_biom(feature_table):
+    if isinstance(feature_table, FeatureMatrix):
+        return biom.Table(feature_table.matrix.T.tocsr(), list(feature_table.feature_ids), list(feature_table.sample_ids))
+    return feature_table.view(biom.Table)
+
+def feature_matrix_to_table(feature_matrix):
+    """Wrap a FeatureMatrix as a feature table artifact
+
+    Args:
+        feature_matrix (FeatureMatrix): Sparse samples x features, artifacts are returned unchanged
+
+    Returns:
+        FeatureTable[Frequency]: Feature table
+    """
+    if not isinstance(feature_matrix, FeatureMatrix):
+        return feature_matrix
+    return Artifact.import_data('FeatureTable[Frequency]', _as_biom(feature_matrix))
+
+def merge_feature_tables(feature_table, other):
+    """Append the samples of another feature table, features are the union of both
+
+    Args:
+        feature_table (FeatureTable[Frequency] or FeatureMatrix): Feature table
+        other (FeatureTable[Frequency] or FeatureMatrix): Feature table of new samples
+
+    Returns:
+        FeatureTable[Frequency]: Merged table
+    """
+    merged = _as_biom(feature_table).merge(_as_biom(other))
+    return Artifact.import_data('FeatureTable[Frequency]', merged)
+
 def read_tree_table(path):
     """
     Reads the phylogeny tree table 
@@ -69,6 +261,7 @@ def filter_feature_table(feature_table, min_samples, metadata):
     Returns:
         FeatureTable[Frequency]: Filtered table
     """
+    from qiime2.plugins.feature_table.methods import filter_features, filter_samples
     filtered_feature_table = filter_features(feature_table, min_samples = min_samples).filtered_table
     return filter_samples(filtered_feature_table, metadata = metadata).filtered_table
 
@@ -83,4 +276,190 @@ def rarefy_feature_table(feature_table, sampling_depth):
     Returns:
         FeatureTable[Frequency]: Rarefied table
     """
+    from qiime2.plugins.feature_table.methods import rarefy
     return rarefy(feature_table, sampling_depth=sampling_depth).rarefied_table
+
+def _select(feature_matrix, rows=None, columns=None):
+    """Subset a FeatureMatrix by boolean or positional row and column indexers"""
+    X, sample_ids, feature_ids = feature_matrix
+    if rows is not None:
+        X, sample_ids = X[rows], sample_ids[rows]
+    if columns is not None:
+        X, feature_ids = X[:, columns], feature_ids[columns]
+    return FeatureMatrix(X, sample_ids, feature_ids)
+
+def filter_feature_matrices(feature_matrix, min_samples, sample_id_sets):
+    """Filter a feature table in memory for several sample sets, counting feature prevalence once
+
+    Same result as filter_feature_table for each sample set: features present in fewer than min_samples samples
+    of the whole table are removed, then samples left empty, then samples missing from the set, then features
+    absent from the remaining samples.
+
+    Args:
+        feature_matrix (FeatureMatrix): Sparse samples x features, see feature_table_matrix
+        min_samples (Int): The minimum number of samples that a feature must be present in to remain
+        sample_id_sets (List): Sample ids (e.g. Metadata.ids) of every filtered table
+
+    Returns:
+        List: Filtered FeatureMatrix per sample set
+    """
+    # Prevalence pass shared by every sample set
+    prevalent = _select(feature_matrix, columns=feature_matrix.matrix.getnnz(axis=0) >= min_samples)
+    prevalent = _select(prevalent, rows=prevalent.matrix.getnnz(axis=1) > 0)
+    filtered = []
+    for sample_ids in sample_id_sets:
+        subset = _select(prevalent, rows=prevalent.sample_ids.isin(list(sample_ids)))
+        filtered.append(_select(subset, columns=subset.matrix.getnnz(axis=0) > 0))
+    return filtered
+
+def filter_feature_matrix(feature_matrix, min_samples, sample_ids):
+    """In-memory filter_feature_table on a FeatureMatrix
+
+    Args:
+        feature_matrix (FeatureMatrix): Sparse samples x features
+        min_samples (Int): The minimum number of samples that a feature must be present in to remain
+        sample_ids (List): Samples to keep, e.g. Metadata.ids
+
+    Returns:
+        FeatureMatrix: Filtered samples x features
+    """
+    return filter_feature_matrices(feature_matrix, min_samples, [sample_ids])[0]
+
+def prefilter_features(feature_matrix, min_prevalence=0.0, min_variance=0.0):
+    """Drop rare and near constant features before fitting a classifier
+
+    Args:
+        feature_matrix (FeatureMatrix): Sparse samples x features
+        min_prevalence (Float, optional): Minimum fraction of samples a feature must be present in. Defaults to 0.0.
+        min_variance (Float, optional): Relative abundances of a feature must vary more than this. Defaults to 0.0,
+            only features without any count are dropped.
+
+    Returns:
+        FeatureMatrix: Samples x kept features
+    """
+    X = feature_matrix.matrix.tocsr()
+    depth = np.asarray(X.sum(axis=1)).ravel()
+    depth[depth == 0] = 1
+    relative = sparse.diags(1 / depth) @ X
+    mean = np.asarray(relative.mean(axis=0)).ravel()
+    variance = np.asarray(relative.multiply(relative).mean(axis=0)).ravel() - mean ** 2
+    prevalence = X.getnnz(axis=0) / max(X.shape[0], 1)
+    return _select(feature_matrix, columns=(prevalence >= min_prevalence) & (variance > min_variance))
+
+def rarefy_feature_matrix(feature_matrix, sampling_depth, random_state=0):
+    """In-memory rarefy_feature_table on a FeatureMatrix
+
+    Every sample with at least sampling_depth counts is subsampled without replacement (multivariate
+    hypergeometric draw over its nonzero features) to exactly sampling_depth counts. Shallower samples and
+    features left empty are removed.
+
+    Args:
+        feature_matrix (FeatureMatrix): Sparse samples x features
+        sampling_depth (Int): The total frequency that each sample should be rarefied to
+        random_state (Int, optional): Seed of the subsampling. Defaults to 0.
+
+    Returns:
+        FeatureMatrix: Rarefied samples x features
+    """
+    feature_matrix = _select(feature_matrix, rows=np.asarray(feature_matrix.matrix.sum(axis=1)).ravel() >= sampling_depth)
+    X = feature_matrix.matrix.tocsr().astype(np.int64)
+    rng = np.random.default_rng(random_state)
+    data = np.empty_like(X.data)
+    for i in range(X.shape[0]):
+        start, end = X.indptr[i], X.indptr[i + 1]
+        data[start:end] = rng.multivariate_hypergeometric(X.data[start:end], sampling_depth, method='marginals')
+    rarefied = sparse.csr_matrix((data.astype(np.float64), X.indices, X.indptr), shape=X.shape)
+    rarefied.eliminate_zeros()
+    rarefied = FeatureMatrix(rarefied, feature_matrix.sample_ids, feature_matrix.feature_ids)
+    return _select(rarefied, columns=rarefied.matrix.getnnz(axis=0) > 0)
+
+def save_feature_matrix(feature_matrix, path):
+    """Save a FeatureMatrix as a columnar directory that load_feature_matrix memory-maps
+
+    The CSR arrays are saved as uncompressed .npy files (data, indices, indptr) next to the sample and
+    feature ids, one per line.
+
+    Args:
+        feature_matrix (FeatureMatrix): Sparse samples x features
+        path (String): Output directory
+
+    Returns:
+        String: path
+    """
+    os.makedirs(path, exist_ok=True)
+    X = feature_matrix.matrix.tocsr()
+    X.sort_indices()
+    for name in ['data', 'indices', 'indptr']:
+        np.save(os.path.join(path, name + '.npy'), getattr(X, name))
+    for name, ids in [('sample_ids', feature_matrix.sample_ids), ('feature_ids', feature_matrix.feature_ids)]:
+        with open(os.path.join(path, name + '.txt'), 'w') as fh:
+            fh.write('\n'.join(map(str, ids)))
+    return path
+
+def load_feature_matrix(path, sample_ids=None, feature_ids=None, mmap=True):
+    """Load a FeatureMatrix saved by save_feature_matrix, only reading the given samples and features
+
+    Samples are read from the memory-mapped CSR arrays by their rows, so selecting samples only reads their
+    counts; selecting features reads the counts of the selected samples.
+
+    Args:
+        path (String): Directory saved by save_feature_matrix
+        sample_ids (List, optional): Samples to load, ids missing from the table are ignored. Defaults to None, every sample.
+        feature_ids (List, optional): Features to load, ids missing from the table are ignored. Defaults to None, every feature.
+        mmap (Boolean, optional): Memory-map the arrays rather than reading them. Defaults to True.
+
+    Returns:
+        FeatureMatrix: Sparse samples x features
+    """
+    arrays = {name: np.load(os.path.join(path, name + '.npy'), mmap_mode='r' if mmap else None)
+              for name in ['data', 'indices', 'indptr']}
+    ids = {}
+    for name, index_name in [('sample_ids', 'SampleID'), ('feature_ids', 'FeatureID')]:
+        with open(os.path.join(path, name + '.txt')) as fh:
+            ids[name] = pd.Index(fh.read().split('\n'), name=index_name)
+    n_features = len(ids['feature_ids'])
+
+    if sample_ids is None:
+        matrix = FeatureMatrix(sparse.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']),
+                                                 shape=(len(ids['sample_ids']), n_features), copy=False),
+                               ids['sample_ids'], ids['feature_ids'])
+    else:
+        rows = ids['sample_ids'].get_indexer(list(sample_ids))
+        rows = rows[rows >= 0]
+        starts = np.asarray(arrays['indptr'][rows])
+        lengths = np.asarray(arrays['indptr'][rows + 1]) - starts
+        indptr = np.concatenate([[0], np.cumsum(lengths)])
+        # Positions of the selected rows' entries in the data and indices arrays
+        positions = np.repeat(starts - indptr[:-1], lengths) + np.arange(indptr[-1])
+        matrix = FeatureMatrix(sparse.csr_matrix((arrays['data'][positions], arrays['indices'][positions], indptr),
+                                                 shape=(len(rows), n_features)),
+                               ids['sample_ids'][rows], ids['feature_ids'])
+    if feature_ids is not None:
+        columns = ids['feature_ids'].get_indexer(list(feature_ids))
+        matrix = _select(matrix, columns=columns[columns >= 0])
+    return matrix
+
+def cache_feature_table(feature_table, path='data/temp/columnar/feature_table'):
+    """Columnar copy of a feature table artifact (see save_feature_matrix), rewritten only when the artifact changes
+
+    Args:
+        feature_table (FeatureTable[Frequency]): Feature table artifact
+        path (String, optional): Output directory. Defaults to 'data/temp/columnar/feature_table'.
+
+    Returns:
+        String: path
+    """
+    uuid_path = os.path.join(path, 'uuid.txt')
+    if os.path.exists(uuid_path):
+        with open(uuid_path) as fh:
+            if fh.read() == str(feature_table.uuid):
+                return path
+    save_feature_matrix(feature_table_matrix(feature_table), path)
+    # Written last, an interrupted save is redone by the next run
+    with open(uuid_path, 'w') as fh:
+        fh.write(str(feature_table.uuid))
+    return path
+
+def cache_feature_table_behind(feature_table, path='data/temp/columnar/feature_table'):
+    """cache_feature_table on the write_behind thread, flush_writes waits for it"""
+    _PENDING_WRITES.append(_WRITER.submit(cache_feature_table, feature_table, path))
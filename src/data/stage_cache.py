@@ -0,0 +1,413 @@
+import ast
+import dis
+import functools
+import hashlib
+import importlib
+import inspect
+import json
+import os
+import pickle
+import shutil
+import sys
+import threading
+import time
+import types
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from qiime2 import Artifact, Metadata, Visualization
+from qiime2.metadata import MetadataColumn
+from qiime2.sdk import Results
+
+INDEX_FILE = 'index.json'
+# Modules of this package are part of the key of the stages using them
+PROJECT_PACKAGE = 'src'
+_PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Condensed distances are hashed a slice at a time, so memory-mapped matrices are never read into memory at once
+HASH_BLOCK = 1 << 24
+
+
+def _condensed_distances_type():
+    """CondensedDistances class, () while metrics_analysis (the only module creating them) is not imported"""
+    module = sys.modules.get('src.features.metrics_analysis')
+    return getattr(module, 'CondensedDistances', ())
+
+def _hash_value(value, digest):
+    """Feed a stable representation of a stage input into a hash digest
+
+    Args:
+        value (Any): Stage input (Artifact, Metadata, DataFrame, array, config value...)
+        digest (hashlib object): Running digest that will be updated
+    """
+    if isinstance(value, (Artifact, Visualization)):
+        # Artifacts are immutable, their UUID identifies the data
+        digest.update(b'artifact:' + str(value.uuid).encode())
+    elif isinstance(value, Metadata):
+        _hash_value(value.to_dataframe(), digest)
+    elif isinstance(value, MetadataColumn):
+        _hash_value(value.to_series(), digest)
+    elif isinstance(value, (pd.DataFrame, pd.Series)):
+        digest.update(b'pandas:' + repr(list(getattr(value, 'columns', [value.name]))).encode())
+        digest.update(pd.util.hash_pandas_object(value, index=True).values.tobytes())
+    elif isinstance(value, _condensed_distances_type()):
+        digest.update(b'condensed:' + '\n'.join(value.ids).encode())
+        for start in range(0, len(value.data), HASH_BLOCK):
+            digest.update(np.ascontiguousarray(value.data[start:start + HASH_BLOCK], dtype=np.float32))
+    elif isinstance(value, pd.Index):
+        digest.update(b'index:' + pd.util.hash_pandas_object(value).values.tobytes())
+    elif sparse.issparse(value):
+        value = value.tocsr()
+        digest.update(b'sparse:' + repr(value.shape).encode())
+        for part in (value.indptr, value.indices, value.data):
+            _hash_value(part, digest)
+    elif isinstance(value, np.ndarray):
+        if value.dtype == object:
+            digest.update('\n'.join(map(str, value.ravel())).encode())
+        else:
+            digest.update(value.tobytes())
+    elif isinstance(value, dict):
+        for key in sorted(value, key=str):
+            digest.update(b'key:' + str(key).encode())
+            _hash_value(value[key], digest)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _hash_value(item, digest)
+    elif isinstance(value, np.generic):
+        _hash_value(value.item(), digest)
+    elif value is None or isinstance(value, (str, bool, int, float)):
+        digest.update(json.dumps(value).encode())
+    else:
+        # A repr fallback would hash object addresses, i.e. a new key every run
+        raise TypeError('Stage input of type ' + type(value).__name__ + ' has no stable hash, add it to _hash_value')
+
+
+def _is_project_module(name):
+    return name == PROJECT_PACKAGE or name.startswith(PROJECT_PACKAGE + '.')
+
+def _module_file(module_name):
+    """Source file of a project module, None for names that are not modules (e.g. imported attributes)"""
+    base = os.path.join(_PROJECT_ROOT, *module_name.split('.'))
+    for path in [base + '.py', os.path.join(base, '__init__.py')]:
+        if os.path.isfile(path):
+            return path
+    return None
+
+def _module_imports(path):
+    """Project modules imported anywhere in a source file, deferred imports included"""
+    with open(path) as fh:
+        tree = ast.parse(fh.read())
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names if _is_project_module(alias.name))
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module and _is_project_module(node.module):
+            names.add(node.module)
+            # from package import module
+            names.update(node.module + '.' + alias.name for alias in node.names
+                         if _module_file(node.module + '.' + alias.name))
+    return names
+
+@functools.lru_cache(maxsize=None)
+def module_digest(module_name):
+    """Hash of the source of a project module and of every project module it imports, transitively
+
+    Args:
+        module_name (String): Project module name, e.g. 'src.features.build_features'
+
+    Returns:
+        String: Hex digest
+    """
+    sources = {}
+    pending = [module_name]
+    while pending:
+        name = pending.pop()
+        path = _module_file(name)
+        if name in sources or path is None:
+            continue
+        with open(path, 'rb') as fh:
+            sources[name] = hashlib.sha256(fh.read()).hexdigest()
+        pending.extend(_module_imports(path))
+    return hashlib.sha256(json.dumps(sources, sort_keys=True).encode()).hexdigest()
+
+def _referenced_modules(func):
+    """Project modules of the globals (modules, functions, classes) a function refers to"""
+    names = set()
+    codes = [func.__code__] if hasattr(func, '__code__') else []
+    while codes:
+        code = codes.pop()
+        # Global names only, attribute names (module.function) are not looked up in the globals
+        names.update(i.argval for i in dis.get_instructions(code) if i.opname in ('LOAD_GLOBAL', 'LOAD_NAME'))
+        codes.extend(c for c in code.co_consts if isinstance(c, types.CodeType))
+    modules = set()
+    func_globals = getattr(func, '__globals__', {})
+    for name in names:
+        value = func_globals.get(name)
+        if isinstance(value, types.ModuleType):
+            module_name = value.__name__
+        elif isinstance(value, (types.FunctionType, type)):
+            module_name = value.__module__
+        else:
+            continue
+        if module_name and _is_project_module(module_name):
+            modules.add(module_name)
+    return modules
+
+def function_identity(func):
+    """Identify a stage function by its qualified name, its source code and the project modules it uses
+
+    Project modules referenced by the function are hashed with every project module they import, so an edit
+    to a helper they call changes the identity.
+
+    Args:
+        func (Callable): Stage function
+
+    Returns:
+        String: Qualified name and hash of the function source and project module sources
+    """
+    func = inspect.unwrap(func)
+    name = func.__module__ + '.' + func.__qualname__
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        source = ''
+    digest = hashlib.sha256(source.encode())
+    for module_name in sorted(_referenced_modules(func)):
+        digest.update(module_name.encode() + b':' + module_digest(module_name).encode())
+    return name + ':' + digest.hexdigest()
+
+
+def stage_key(func, args, kwargs, config=None):
+    """Compute the content address of a stage
+
+    Args:
+        func (Callable): Stage function
+        args (Tuple): Positional stage inputs
+        kwargs (Dict): Keyword stage inputs
+        config (Dict, optional): Configuration used by the stage. Defaults to None.
+
+    Returns:
+        String: Hex digest keying the stage outputs
+    """
+    digest = hashlib.sha256()
+    digest.update(function_identity(func).encode())
+    _hash_value(list(args), digest)
+    _hash_value(kwargs, digest)
+    _hash_value(config, digest)
+    return digest.hexdigest()
+
+
+def _dump(value, directory, name):
+    """Save a stage output in directory and return its manifest entry"""
+    path = os.path.join(directory, name)
+    if isinstance(value, Visualization):
+        return {'type': 'visualization', 'file': os.path.basename(value.save(path))}
+    if isinstance(value, Artifact):
+        return {'type': 'artifact', 'file': os.path.basename(value.save(path))}
+    if isinstance(value, Metadata):
+        value.save(path + '.tsv')
+        return {'type': 'metadata', 'file': name + '.tsv'}
+    if isinstance(value, _condensed_distances_type()):
+        # Saved as the .npy and .ids.txt files of CondensedDistances.load, reloaded memory-mapped
+        if isinstance(value.data, np.memmap) and value.data.filename:
+            shutil.copy(value.data.filename, path + '.npy')
+        else:
+            np.save(path + '.npy', value.data)
+        with open(path + '.ids.txt', 'w') as fh:
+            fh.write('\n'.join(value.ids))
+        return {'type': 'condensed_distances', 'file': name, 'peak_rss': value.peak_rss}
+    if isinstance(value, Results):
+        return {'type': 'results', 'fields': list(value._fields),
+                'items': [_dump(v, directory, name + '_' + f) for f, v in zip(value._fields, value)]}
+    if isinstance(value, tuple) and hasattr(value, '_fields'):
+        # namedtuple results are rebuilt from their defining module
+        return {'type': 'namedtuple', 'class': [type(value).__module__, type(value).__qualname__],
+                'items': [_dump(v, directory, name + '_' + f) for f, v in zip(value._fields, value)]}
+    if isinstance(value, (list, tuple)):
+        return {'type': type(value).__name__,
+                'items': [_dump(v, directory, name + '_' + str(i)) for i, v in enumerate(value)]}
+    if isinstance(value, dict) and all(isinstance(k, str) for k in value):
+        return {'type': 'dict', 'keys': list(value),
+                'items': [_dump(value[k], directory, name + '_' + str(i)) for i, k in enumerate(value)]}
+    with open(path + '.pkl', 'wb') as fh:
+        pickle.dump(value, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    return {'type': 'pickle', 'file': name + '.pkl'}
+
+
+def _load(entry, directory):
+    """Reload a stage output from its manifest entry"""
+    kind = entry['type']
+    if kind == 'visualization':
+        return Visualization.load(os.path.join(directory, entry['file']))
+    if kind == 'artifact':
+        return Artifact.load(os.path.join(directory, entry['file']))
+    if kind == 'metadata':
+        return Metadata.load(os.path.join(directory, entry['file']))
+    if kind == 'condensed_distances':
+        from src.features.metrics_analysis import CondensedDistances
+        distances = CondensedDistances.load(os.path.join(directory, entry['file']))
+        distances.peak_rss = entry['peak_rss']
+        return distances
+    if kind == 'results':
+        return Results(entry['fields'], [_load(e, directory) for e in entry['items']])
+    if kind == 'namedtuple':
+        cls = getattr(importlib.import_module(entry['class'][0]), entry['class'][1])
+        return cls(*[_load(e, directory) for e in entry['items']])
+    if kind == 'list':
+        return [_load(e, directory) for e in entry['items']]
+    if kind == 'tuple':
+        return tuple(_load(e, directory) for e in entry['items'])
+    if kind == 'dict':
+        return {k: _load(e, directory) for k, e in zip(entry['keys'], entry['items'])}
+    with open(os.path.join(directory, entry['file']), 'rb') as fh:
+        return pickle.load(fh)
+
+
+def _directory_size(directory):
+    total = 0
+    for root, _, files in os.walk(directory):
+        for f in files:
+            total += os.path.getsize(os.path.join(root, f))
+    return total
+
+
+class StageCache:
+    """Content-addressed cache of pipeline stage outputs with LRU eviction
+
+    Args:
+        cache_dir (String): Directory where stage outputs are stored
+        max_size_gb (Float): Maximum size of the cache before least recently used entries are evicted
+        enabled (Boolean): Whether or not stages are looked up in the cache
+        before_store (Callable, optional): Called with the side files of a computed stage before they are stored,
+            e.g. to wait for files still being written in the background. Defaults to None.
+    """
+    def __init__(self, cache_dir='data/temp/cache', max_size_gb=20, enabled=True, before_store=None):
+        self.cache_dir = cache_dir
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        self.enabled = enabled
+        self.before_store = before_store
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = self._read_index()
+        # Stages may run concurrently, the index is only touched under this lock
+        self._lock = threading.Lock()
+
+    def _read_index(self):
+        path = os.path.join(self.cache_dir, INDEX_FILE)
+        if os.path.exists(path):
+            with open(path) as fh:
+                return json.load(fh)
+        return {'entries': {}, 'stats': {'hits': 0, 'misses': 0, 'time_saved': 0.0, 'stages': {}}}
+
+    def _write_index(self):
+        path = os.path.join(self.cache_dir, INDEX_FILE)
+        with open(path + '.tmp', 'w') as fh:
+            json.dump(self.index, fh, indent=2)
+        os.replace(path + '.tmp', path)
+
+    def _record(self, stage, hit, seconds):
+        stats = self.index['stats']
+        stage_stats = stats['stages'].setdefault(stage, {'hits': 0, 'misses': 0, 'time_saved': 0.0})
+        if hit:
+            stats['hits'] += 1
+            stats['time_saved'] += seconds
+            stage_stats['hits'] += 1
+            stage_stats['time_saved'] += seconds
+        else:
+            stats['misses'] += 1
+            stage_stats['misses'] += 1
+
+    def run(self, stage, func, *args, config=None, side_files=(), **kwargs):
+        """Run a stage, or reload its outputs if an identical stage was already computed
+
+        Args:
+            stage (String): Stage name used for reporting
+            func (Callable): Stage function
+            *args: Positional arguments passed to func
+            config (Dict, optional): Configuration the stage depends on besides its arguments. Defaults to None.
+            side_files (List, optional): Files written by func that are restored on a cache hit, if func wrote them. Defaults to ().
+            **kwargs: Keyword arguments passed to func
+
+        Returns:
+            Any: Outputs of func
+        """
+        if not self.enabled:
+            return func(*args, **kwargs)
+
+        key = stage_key(func, args, kwargs, config)
+        entry_dir = os.path.join(self.cache_dir, key)
+        with self._lock:
+            entry = self.index['entries'].get(key)
+            if entry is not None:
+                entry['last_access'] = time.time()
+
+        if entry is not None and os.path.isdir(entry_dir):
+            start = time.perf_counter()
+            outputs = _load(entry['manifest'], entry_dir)
+            for f in entry['side_files']:
+                os.makedirs(os.path.dirname(f) or '.', exist_ok=True)
+                shutil.copy(os.path.join(entry_dir, 'side_files', os.path.basename(f)), f)
+            load_seconds = time.perf_counter() - start
+            with self._lock:
+                self._record(stage, True, max(entry['compute_seconds'] - load_seconds, 0.0))
+                self._write_index()
+            print('Cache hit: ' + stage)
+            return outputs
+
+        start = time.perf_counter()
+        outputs = func(*args, **kwargs)
+        compute_seconds = time.perf_counter() - start
+        if self.before_store is not None:
+            self.before_store(side_files)
+        side_files = [f for f in side_files if os.path.exists(f)]
+
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.makedirs(os.path.join(entry_dir, 'side_files'))
+        manifest = _dump(outputs, entry_dir, 'output')
+        for f in side_files:
+            shutil.copy(f, os.path.join(entry_dir, 'side_files', os.path.basename(f)))
+        size = _directory_size(entry_dir)
+        with self._lock:
+            self.index['entries'][key] = {'stage': stage,
+                                          'manifest': manifest,
+                                          'side_files': list(side_files),
+                                          'compute_seconds': compute_seconds,
+                                          'size': size,
+                                          'last_access': time.time()}
+            self._record(stage, False, 0.0)
+            self._evict(keep=key)
+            self._write_index()
+        return outputs
+
+    def _evict(self, keep=None):
+        """Remove least recently used entries until the cache fits in max_size
+
+        Args:
+            keep (String, optional): Key of an entry that must not be evicted. Defaults to None.
+        """
+        entries = self.index['entries']
+        total = sum(e['size'] for e in entries.values())
+        for key in sorted(entries, key=lambda k: entries[k]['last_access']):
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            total -= entries[key]['size']
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            del entries[key]
+
+    def stats(self):
+        """Summarize cache usage
+
+        Returns:
+            DataFrame: Hits, misses and time saved per stage with a total row
+        """
+        stats = self.index['stats']
+        stages = pd.DataFrame.from_dict(stats['stages'], orient='index',
+                                        columns=['hits', 'misses', 'time_saved'])
+        stages.loc['total'] = [stats['hits'], stats['misses'], stats['time_saved']]
+        stages['time_saved'] = stages['time_saved'].round(2)
+        return stages
+
+    def size(self):
+        """Total size of stored stage outputs in bytes"""
+        return sum(e['size'] for e in self.index['entries'].values())
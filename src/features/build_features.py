@@ -1,8 +1,10 @@
-from qiime2 import Metadata
+import ast
 
 import numpy as np
 import pandas as pd
 
+from src.data import make_dataset
+
 def missing_values(col):
     """Create unified representation for missing values
 
@@ -75,8 +77,63 @@ def binary_to_tf(val):
         return val
     
     
-def organize_metadata(metadata_df, feauture_table_samples, disease_cols, additional_info_cols, diabetes_binary, ckd_binary):
-    """Organizes metadata_df by dropping missing values and converting categorical variables to binary variables.
+def parse_mapping(mapping):
+    """Parse a categorical to binary mapping given as a dictionary literal string
+
+    Args:
+        mapping (String or Dict): Dictionary, or string representation of a dictionary, of value mappings
+
+    Returns:
+        Dict: Parsed mapping
+    """
+    if isinstance(mapping, dict):
+        return mapping
+    return ast.literal_eval(mapping)
+
+def unified_rep_frame(df):
+    """Vectorized unified_rep_values: converts every value representing a number to float, column by column
+
+    Text columns are parsed once per distinct value with represents_float, so strings such as 'nan', ' 12 ' or
+    '1_000' convert exactly as in unified_rep_values.
+
+    Args:
+        df (DataFrame): Dataframe with integer, float and string values
+
+    Returns:
+        DataFrame: Dataframe where numbers are floats and other values are left unchanged
+    """
+    out = {}
+    for name, col in df.items():
+        if pd.api.types.is_numeric_dtype(col):
+            out[name] = col.astype(np.float64)
+            continue
+        parsed = {x: np.float64(x) for x in col.dropna().unique() if represents_float(x)}
+        if not parsed:
+            out[name] = col
+            continue
+        col = col.astype(object)
+        is_number = col.isin(list(parsed)) | col.isna()
+        numeric = col.map(parsed).astype(np.float64)
+        out[name] = numeric if is_number.all() else col.where(~is_number, numeric)
+    return pd.DataFrame(out, index=df.index)
+
+def map_binary(col, values):
+    """Vectorized cat_to_binary, raising KeyError for values missing from the mapping like a dictionary lookup
+
+    Args:
+        col (Series): Column with categorical varibales
+        values (Dict): Dictionary to map categorical values to binary values
+
+    Returns:
+        Series: Column of binary values
+    """
+    unmapped = ~col.isin(list(values.keys()))
+    if unmapped.any():
+        raise KeyError(col[unmapped].iloc[0])
+    return col.map(values).astype(np.float64)
+
+def clean_metadata_rowwise(metadata_df, disease_cols, additional_info_cols, diabetes_binary, ckd_binary):
+    """Row-wise reference implementation of clean_metadata
 
     Args:
         metadata_df (DataFrame): Metadata dataframe that will be organized
@@ -86,8 +143,7 @@ def organize_metadata(metadata_df, feauture_table_samples, disease_cols, additio
         ckd_binary (Dict): Dictionary of ckd mappings
 
     Returns:
-        List: Returns two dataframes, final_metadata which contains orginal disease binary representation of 0/1 
-        and final_metadata_tf which contains disease data as 'T' and 'F' binary values
+        DataFrame: Metadata without missing disease data and with binary disease values
     """
     features = disease_cols + additional_info_cols
     # Drop na, 'not applicable' and 'not provided'
@@ -101,44 +157,118 @@ def organize_metadata(metadata_df, feauture_table_samples, disease_cols, additio
     # change categorical to binary - will try to abstract this process
     sub_metadata['diabetes2_v2'] = sub_metadata['diabetes2_v2'].apply(lambda x: eval(diabetes_binary)[x])
     sub_metadata['ckd_v2'] = sub_metadata['ckd_v2'].apply(lambda x: eval(ckd_binary)[x])
+    return sub_metadata
+
+def clean_metadata(metadata_df, disease_cols, additional_info_cols, diabetes_binary, ckd_binary):
+    """Drops missing disease data, unifies numeric values and converts categorical disease variables to binary variables
+
+    Args:
+        metadata_df (DataFrame): Metadata dataframe that will be organized
+        disease_cols (List): List of disease column names 
+        additional_info_cols (List): List of additional metadata columns
+        diabetes_binary (Dict): Dictionary of diabetes mappings
+        ckd_binary (Dict): Dictionary of ckd mappings
+
+    Returns:
+        DataFrame: Metadata without missing disease data and with binary disease values
+    """
+    features = disease_cols + additional_info_cols
+    # Drop na, 'not applicable' and 'not provided'
+    sub_metadata = metadata_df[features].replace(['not applicable', 'not provided'], np.nan)
+    # only drop rows with missing disease data
+    sub_metadata = sub_metadata.dropna(subset = disease_cols)
+    
+    # unified values
+    sub_metadata = unified_rep_frame(sub_metadata)
+    
+    # change categorical to binary
+    sub_metadata['diabetes2_v2'] = map_binary(sub_metadata['diabetes2_v2'], parse_mapping(diabetes_binary))
+    sub_metadata['ckd_v2'] = map_binary(sub_metadata['ckd_v2'], parse_mapping(ckd_binary))
+    return sub_metadata
+    
+def organize_metadata(metadata_df, feauture_table_samples, disease_cols, additional_info_cols, diabetes_binary, ckd_binary, engine='vectorized', persist=True):
+    """Organizes metadata_df by dropping missing values and converting categorical variables to binary variables.
+
+    Args:
+        metadata_df (DataFrame): Metadata dataframe that will be organized
+        disease_cols (List): List of disease column names 
+        additional_info_cols (List): List of additional metadata columns
+        diabetes_binary (Dict): Dictionary of diabetes mappings
+        ckd_binary (Dict): Dictionary of ckd mappings
+        engine (String, optional): 'vectorized' or the 'rowwise' reference implementation. Defaults to 'vectorized'.
+        persist (Boolean, optional): Save both tables to data/temp in the background. Defaults to True.
+
+    Returns:
+        List: Returns two dataframes, final_metadata which contains orginal disease binary representation of 0/1 
+        and final_metadata_tf which contains disease data as 'T' and 'F' binary values
+    """
+    clean = clean_metadata_rowwise if engine == 'rowwise' else clean_metadata
+    sub_metadata = clean(metadata_df, disease_cols, additional_info_cols, diabetes_binary, ckd_binary)
     
     # Filter metadata samples based on those that exist in the feature table
     final_metadata = sub_metadata.loc[sub_metadata.index.isin(feauture_table_samples)]
     # save file for 0-1 metadata - will be used for visualizations
-    final_metadata.to_csv('data/temp/final_metadata.tsv',sep='\t')
+    if persist:
+        make_dataset.write_behind(final_metadata, 'data/temp/final_metadata.tsv')
     # create seperate file for tf metadata - will be used for qiime models
-    final_metadata_tf = disease_metadata_to_tf(final_metadata, disease_cols)
+    final_metadata_tf = disease_metadata_to_tf(final_metadata, disease_cols, engine, persist)
     
     return final_metadata, final_metadata_tf
 
-def disease_metadata_to_tf(final_metadata, disease_cols):
+def disease_to_tf(final_metadata, disease_cols, engine='vectorized'):
+    """Convert metadata dataframe 0-1 binary to T-F binary without saving it
+
+    Args:
+        final_metadata (DataFrame): Dataframe with 0-1 binary values
+        disease_cols (List): List of disease types
+        engine (String, optional): 'vectorized' or the 'rowwise' reference implementation. Defaults to 'vectorized'.
+    
+    Returns:
+        DataFrame: Dataframe with T and F values
+    """
+    metadata_df = final_metadata.copy()
+    if engine == 'rowwise':
+        metadata_df.loc[:,disease_cols] = metadata_df.loc[:,disease_cols].applymap(lambda x: binary_to_tf(x))
+        return metadata_df
+    values = metadata_df.loc[:,disease_cols]
+    tf = np.where(values == 1.0, 'T', np.where(values == 0.0, 'F', values.astype(object)))
+    metadata_df.loc[:,disease_cols] = pd.DataFrame(tf, index=values.index, columns=values.columns)
+    return metadata_df
+
+def disease_metadata_to_tf(final_metadata, disease_cols, engine='vectorized', persist=True):
     """Convert metadata dataframe 0-1 binary to T-F binary
 
     Args:
         metadata (DataFrame): Dataframe with 0-1 binary values
         disease_cols (List): List of disease types
+        engine (String, optional): 'vectorized' or the 'rowwise' reference implementation. Defaults to 'vectorized'.
+        persist (Boolean, optional): Save the table to data/temp in the background. Defaults to True.
     
     Returns:
         DataFrame: Dataframe with T and F values
     """
-    metadata_df = final_metadata.copy()
-    metadata_df.loc[:,disease_cols] = metadata_df.loc[:,disease_cols].applymap(lambda x: binary_to_tf(x))
-    metadata_df.to_csv("data/temp/final_metadata_tf.tsv",sep="\t")
+    metadata_df = disease_to_tf(final_metadata, disease_cols, engine)
+    if persist:
+        make_dataset.write_behind(metadata_df, "data/temp/final_metadata_tf.tsv")
     return metadata_df
 
-def balance_precvd(organized_metadata_tf):
+def balance_precvd(organized_metadata_tf, sample_ids=None, path='data/out/balanced_precvd_samples.tsv'):
     """Balance PreCVD Classes
 
     Args:
         organized_metadata_tf (DataFrame): Organized metadata dataframe
+        sample_ids (List, optional): Samples the balanced classes are drawn from. Defaults to None, every sample.
+        path (String, optional): File listing the balanced samples. Defaults to 'data/out/balanced_precvd_samples.tsv'.
 
     Returns:
         METADATA: Balanced PreCVD qiime Metadata Object
     """
     precvd_undersample = organized_metadata_tf[['precvd_v2']]
+    if sample_ids is not None:
+        precvd_undersample = precvd_undersample[precvd_undersample.index.isin(list(sample_ids))]
     balanced_precvd_df = pd.concat([precvd_undersample[precvd_undersample['precvd_v2'] == 'T'],
                                     precvd_undersample[precvd_undersample['precvd_v2'] == 'F'].sample(
                                     precvd_undersample.value_counts().min(), random_state=2)])
-    balanced_precvd_df.to_csv('data/out/balanced_precvd_samples.tsv', sep='\t')
-    balanced_precvd_qiime = Metadata(balanced_precvd_df)
+    make_dataset.write_behind(balanced_precvd_df, path)
+    balanced_precvd_qiime = make_dataset.dataframe_to_qiime_metadata(balanced_precvd_df)
     return balanced_precvd_qiime
\ No newline at end of file
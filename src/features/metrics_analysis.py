@@ -1,46 +1,548 @@
-from qiime2.plugins.diversity.pipelines import core_metrics, core_metrics_phylogenetic,beta_phylogenetic,beta
-from qiime2.plugins.diversity.visualizers import beta_group_significance
-from qiime2.plugins.diversity.methods import pcoa
-        
-def calculate_distance_matrices(feature_table, metrics, phylogeny=None):
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+from qiime2 import Artifact
+
+import numpy as np
+import pandas as pd
+import skbio
+from skbio.diversity import partial_beta_diversity
+from scipy.spatial.distance import cdist, squareform
+
+from src.profiling.memory import PeakRSSMonitor
+from src.visualizations import render_queue
+
+PHYLOGENETIC_METRICS = ['unweighted_unifrac', 'weighted_unifrac']
+
+class CondensedDistances:
+    """Distance matrix stored as its condensed upper triangle in float32, optionally memory-mapped from a .npy file
+
+    Rows are expanded block by block when needed, the full dense matrix is never materialized
+    except by to_artifact.
+
+    Args:
+        ids (List): Sample ids
+        data (Array): Condensed distances, as returned by skbio DistanceMatrix.condensed_form
+
+    peak_rss is the peak RSS (bytes) of computing the matrix, set by calculate_distance_matrices when metrics
+    are computed one at a time.
+    """
+    def __init__(self, ids, data):
+        self.ids = list(ids)
+        self.data = data
+        self.peak_rss = None
+        self._positions = {x: i for i, x in enumerate(self.ids)}
+
+    @classmethod
+    def from_distance_matrix(cls, distance_matrix, path=None):
+        """Condense a DistanceMatrix artifact, spilling it to path.npy (memory-mapped) when path is given"""
+        dm = distance_matrix.view(skbio.DistanceMatrix)
+        data = dm.condensed_form().astype(np.float32)
+        if path is None:
+            return cls(dm.ids, data)
+        np.save(path + '.npy', data)
+        with open(path + '.ids.txt', 'w') as fh:
+            fh.write('\n'.join(dm.ids))
+        return cls.load(path)
+
+    @classmethod
+    def load(cls, path):
+        """Memory-map condensed distances saved by from_distance_matrix"""
+        with open(path + '.ids.txt') as fh:
+            ids = fh.read().split('\n')
+        return cls(ids, np.load(path + '.npy', mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, sample_id):
+        return sample_id in self._positions
+
+    def _condensed_index(self, rows, cols):
+        lo, hi = np.minimum(rows, cols), np.maximum(rows, cols)
+        n = len(self.ids)
+        return n * lo - lo * (lo + 1) // 2 + (hi - lo - 1), lo == hi
+
+    def rows(self, index, block_pairs=1 << 20):
+        """Dense float64 rows of the distance matrix
+
+        Rows are gathered a block at a time, so their index arrays never exceed block_pairs entries.
+
+        Args:
+            index (Array): Row positions
+            block_pairs (Int, optional): Maximum number of distances gathered at a time. Defaults to 1M.
+
+        Returns:
+            Array: len(index) x n distances
+        """
+        index = np.asarray(index)
+        n = len(self.ids)
+        block = np.empty((len(index), n))
+        rows_per_block = max(1, block_pairs // max(n, 1))
+        for start in range(0, len(index), rows_per_block):
+            condensed, diagonal = self._condensed_index(index[start:start + rows_per_block, None], np.arange(n)[None, :])
+            condensed[diagonal] = 0
+            rows = block[start:start + rows_per_block]
+            rows[:] = self.data[condensed]
+            rows[diagonal] = 0
+        return block
+
+    def filter(self, ids, block_pairs=1 << 20):
+        """Condensed distances of a subset of samples, kept in memory
+
+        The subset is gathered a block of rows at a time, so its index arrays never exceed block_pairs entries.
+
+        Args:
+            ids (List): Sample ids of the subset
+            block_pairs (Int, optional): Maximum number of distances gathered at a time. Defaults to 1M.
+
+        Returns:
+            CondensedDistances: Distances of the subset
+        """
+        positions = np.array([self._positions[x] for x in ids], dtype=np.int64)
+        m = len(positions)
+        data = np.empty(m * (m - 1) // 2, dtype=np.float32)
+        rows_per_block = max(1, block_pairs // max(m, 1))
+        out = 0
+        for start in range(0, m - 1, rows_per_block):
+            # Pairs (i, j > i) of the block rows, in condensed order
+            rows = np.arange(start, min(start + rows_per_block, m - 1))
+            lengths = m - rows - 1
+            n_pairs = int(lengths.sum())
+            pair_rows = np.repeat(rows, lengths)
+            pair_cols = np.arange(n_pairs) - np.repeat(np.cumsum(lengths) - lengths, lengths) + pair_rows + 1
+            condensed, _ = self._condensed_index(positions[pair_rows], positions[pair_cols])
+            data[out:out + n_pairs] = self.data[condensed]
+            out += n_pairs
+        return CondensedDistances(ids, data)
+
+    def extend(self, new_ids, new_distances, path=None):
+        """Condensed distances with new samples appended after the current ones
+
+        Args:
+            new_ids (List): Ids of the new samples
+            new_distances (Array): len(new_ids) x (n + len(new_ids)) distances, columns ordered as ids + new_ids
+            path (String, optional): Write to path.npy (memory-mapped) instead of memory. Defaults to None.
+
+        Returns:
+            CondensedDistances: Distances of ids + new_ids
+        """
+        n, m = len(self.ids), len(new_ids)
+        total = n + m
+        size = total * (total - 1) // 2
+        if path is None:
+            data = np.empty(size, dtype=np.float32)
+        else:
+            data = np.lib.format.open_memmap(path + '.npy', mode='w+', dtype=np.float32, shape=(size,))
+        # Row i of the condensed form holds its old distances followed by its distances to the new samples
+        old_start = new_start = 0
+        for i in range(n):
+            length = n - i - 1
+            data[new_start:new_start + length] = self.data[old_start:old_start + length]
+            data[new_start + length:new_start + length + m] = new_distances[:, i]
+            old_start += length
+            new_start += length + m
+        for k in range(m):
+            length = m - k - 1
+            data[new_start:new_start + length] = new_distances[k, n + k + 1:]
+            new_start += length
+        if path is None:
+            return CondensedDistances(self.ids + list(new_ids), data)
+        data.flush()
+        with open(path + '.ids.txt', 'w') as fh:
+            fh.write('\n'.join(self.ids + list(new_ids)))
+        return CondensedDistances.load(path)
+
+    def gower(self, block_pairs=1 << 20):
+        """Gower centered matrix as a blockwise linear operator"""
+        return GowerOperator(self, block_pairs)
+
+    def to_artifact(self):
+        """Expand to a DistanceMatrix artifact for qiime actions that need one"""
+        dm = skbio.DistanceMatrix(squareform(np.asarray(self.data, dtype=np.float64)), self.ids)
+        return Artifact.import_data('DistanceMatrix', dm)
+
+class GowerOperator:
+    """Gower centered matrix B = -1/2 J D^2 J of condensed distances, applied block by block
+
+    Supports B @ Q and trace(), which is all randomized_eigh and permanova_batch need.
+
+    Args:
+        distances (CondensedDistances): Condensed distances
+        block_pairs (Int, optional): Maximum number of distances expanded at a time, i.e. block_pairs // n rows.
+            Defaults to 1M.
+    """
+    def __init__(self, distances, block_pairs=1 << 20):
+        self.distances = distances
+        n = len(distances)
+        self.block_size = block_size = max(1, block_pairs // max(n, 1))
+        self.shape = (n, n)
+        self.row_means = np.empty(n)
+        for start in range(0, n, block_size):
+            block = distances.rows(np.arange(start, min(start + block_size, n)))
+            self.row_means[start:start + block_size] = -0.5 * (block ** 2).mean(axis=1)
+        self.mean = self.row_means.mean()
+
+    def __matmul__(self, Q):
+        n = self.shape[0]
+        out = np.empty((n, Q.shape[1]))
+        for start in range(0, n, self.block_size):
+            block = self.distances.rows(np.arange(start, min(start + self.block_size, n)))
+            out[start:start + self.block_size] = (-0.5 * block ** 2) @ Q
+        column_sums = Q.sum(axis=0)
+        out -= np.outer(self.row_means, column_sums)
+        out -= self.row_means @ Q
+        out += self.mean * column_sums
+        return out
+
+    def trace(self):
+        return -self.shape[0] * self.mean
+
+def calculate_distance_matrix(feature_table, metric, phylogeny=None, n_jobs=1):
+    """Calculate the distance matrix of a single metric
+
+    Args:
+        feature_table (FeatureTable[Frequency]): Feature table that will be used to calculate distance matrix
+        metric (String): Metric for which the beta diversity will be computed
+        phylogeny (Phylogeny[Rooted], optional): Phylogenetic tree, required by unifrac metrics. Defaults to None.
+        n_jobs (Int, optional): Number of threads/jobs of the beta diversity computation. Defaults to 1.
+
+    Returns:
+        DistanceMatrix: Distance matrix, None if a phylogenetic metric was requested without phylogeny
+    """
+    if metric in PHYLOGENETIC_METRICS:
+        if phylogeny is None:
+            print("Can't Calculate " + metric +" distance matrix without phylogeny tree")
+            return None
+        from qiime2.plugins.diversity.pipelines import beta_phylogenetic
+        return beta_phylogenetic(feature_table, phylogeny, metric, threads=n_jobs).distance_matrix
+    from qiime2.plugins.diversity.pipelines import beta
+    return beta(feature_table, metric, n_jobs=n_jobs).distance_matrix
+
+def calculate_distance_matrices(feature_table, metrics, phylogeny=None, n_jobs=1, parallel_metrics=1, compact=False,
+                                compact_dir='data/temp/distance_matrices'):
     """Calculate distance matrices based on given metrics
 
     Args:
         feature_table (FeatureTable[Frequency]): Feature table that will be used to calculate distance matrix
         metrics (List): List of metrics for which the beta diversity will be computed
-        phylogeny (_type_, optional): _description_. Defaults to None.
+        phylogeny (Phylogeny[Rooted], optional): Phylogenetic tree, required by unifrac metrics. Defaults to None.
+        n_jobs (Int, optional): Number of threads/jobs of each beta diversity computation. Defaults to 1.
+        parallel_metrics (Int, optional): Number of metrics computed concurrently. Defaults to 1.
+        compact (Boolean, optional): Keep each matrix as memory-mapped condensed float32 distances
+            (CondensedDistances) saved under compact_dir. Defaults to False.
+        compact_dir (String, optional): Directory of the condensed .npy files. Defaults to 'data/temp/distance_matrices'.
+
+    Returns:
+        Dict: {"Metric": DistanceMatrix}, or {"Metric": CondensedDistances} in compact mode
+    """
+    if compact:
+        os.makedirs(compact_dir, exist_ok=True)
+
+    def compute(metric):
+        distance_matrix = calculate_distance_matrix(feature_table, metric, phylogeny, n_jobs)
+        if compact and distance_matrix is not None:
+            # The dense matrix is released as soon as it is condensed
+            distance_matrix = CondensedDistances.from_distance_matrix(distance_matrix, os.path.join(compact_dir, metric))
+        return distance_matrix
+
+    if parallel_metrics <= 1:
+        # RSS is process-wide, it is only attributed to a metric when metrics run one at a time
+        distance_matrices = []
+        for metric in metrics:
+            with PeakRSSMonitor() as monitor:
+                distance_matrix = compute(metric)
+            print(metric + ' distance matrix peak RSS: %.1f MB' % monitor.peak_mb)
+            if compact and distance_matrix is not None:
+                distance_matrix.peak_rss = monitor.peak
+            distance_matrices.append(distance_matrix)
+    else:
+        # unifrac and scipy distances run outside the GIL, so threads overlap
+        with PeakRSSMonitor() as monitor, ThreadPoolExecutor(max_workers=parallel_metrics) as executor:
+            distance_matrices = list(executor.map(compute, metrics))
+        print('Distance matrices process-wide peak RSS (%d metrics concurrently): %.1f MB'
+              % (min(parallel_metrics, len(metrics)), monitor.peak_mb))
+    output = {}
+    for x, distance_matrix in zip(metrics, distance_matrices):
+        if distance_matrix is not None:
+            output[x] = distance_matrix
+    return output
+
+def as_distances(distance_matrix):
+    """View a DistanceMatrix artifact as skbio DistanceMatrix, leaving CondensedDistances unchanged"""
+    if isinstance(distance_matrix, CondensedDistances):
+        return distance_matrix
+    return distance_matrix.view(skbio.DistanceMatrix)
+
+def subset_distance_matrices(distance_matrix_dict, sample_ids, metrics=None):
+    """Subset distance matrices to given samples instead of recomputing them
+
+    Args:
+        distance_matrix_dict (Dict): Dictionary containing distance matrices
+        sample_ids (List): Sample ids to keep, ids missing from a matrix are ignored
+        metrics (List, optional): Metrics to subset. Defaults to None, all metrics.
 
     Returns:
         Dict: {"Metric": DistanceMatrix}
     """
     output = {}
-    for x in metrics:
-        if (x == 'unweighted_unifrac') or (x == 'weighted_unifrac'):
-            if phylogeny is None:
-                print("Can't Calculate " + x +" distance matrix without phylogeny tree")
-                continue
-            else:
-                distance_matrix = beta_phylogenetic(feature_table, phylogeny, x).distance_matrix
+    for metric in (metrics or distance_matrix_dict.keys()):
+        distance_matrix = as_distances(distance_matrix_dict[metric])
+        ids = [x for x in sample_ids if x in distance_matrix]
+        if isinstance(distance_matrix, CondensedDistances):
+            output[metric] = distance_matrix.filter(ids)
         else:
-            distance_matrix = beta(feature_table, x).distance_matrix
-        output[x] = distance_matrix
+            output[metric] = Artifact.import_data('DistanceMatrix', distance_matrix.filter(ids))
     return output
 
-def calculate_pcoa(distance_matrix_dict, n_dimensions):
+def sample_distances(feature_matrix, new_ids, metric, phylogeny=None, block_size=1024):
+    """Distances between some samples and every sample of a table, without the full pairwise matrix
+
+    jaccard is computed on presence with sparse products, unifrac metrics with scikit-bio on the requested pairs
+    only, other metrics with scipy cdist, block by block.
+
+    Args:
+        feature_matrix (FeatureMatrix): Samples x features of every sample, e.g. the rarefied table
+        new_ids (List): Ids of the samples to compute distances from
+        metric (String): Beta diversity metric
+        phylogeny (Phylogeny[Rooted], optional): Phylogenetic tree, required by unifrac metrics. Defaults to None.
+        block_size (Int, optional): Number of samples densified at a time. Defaults to 1024.
+
+    Returns:
+        DataFrame: new_ids x all samples distances
+    """
+    X, ids = feature_matrix.matrix.tocsr(), feature_matrix.sample_ids
+    rows = ids.get_indexer(new_ids)
+    new = X[rows]
+    distances = np.empty((len(rows), X.shape[0]))
+    if metric == 'jaccard':
+        new_presence, presence = new.astype(bool).astype(np.float64), X.astype(bool).astype(np.float64)
+        intersection = (new_presence @ presence.T).toarray()
+        union = np.asarray(new_presence.sum(axis=1)) + np.asarray(presence.sum(axis=1)).T - intersection
+        distances = 1 - np.divide(intersection, union, out=np.ones_like(intersection), where=union > 0)
+    elif metric in PHYLOGENETIC_METRICS:
+        tree = phylogeny.view(skbio.TreeNode)
+        new_ids = list(new_ids)
+        for start in range(0, X.shape[0], block_size):
+            block_ids = list(ids[start:start + block_size])
+            # Scikit-bio needs dense counts, only the new samples and this block are densified
+            block_samples = list(dict.fromkeys(new_ids + block_ids))
+            block = X[ids.get_indexer(block_samples)]
+            used = np.unique(block.indices)
+            pairs = tuple(dict.fromkeys(tuple(sorted((a, b))) for a in new_ids for b in block_ids if a != b))
+            dm = partial_beta_diversity(metric, block[:, used].toarray(), block_samples, pairs,
+                                                        otu_ids=list(feature_matrix.feature_ids[used]), tree=tree)
+            distances[:, start:start + len(block_ids)] = dm.filter(block_samples).to_data_frame().loc[new_ids, block_ids].values
+    else:
+        new_dense = new.toarray()
+        for start in range(0, X.shape[0], block_size):
+            distances[:, start:start + block_size] = cdist(new_dense, X[start:start + block_size].toarray(), metric)
+    return pd.DataFrame(distances, index=new_ids, columns=ids)
+
+def extend_distance_matrix(distance_matrix, new_distances, path=None):
+    """Append new samples to a distance matrix from their distances to every sample
+
+    Args:
+        distance_matrix (DistanceMatrix or CondensedDistances): Distance matrix of the current samples
+        new_distances (DataFrame): New samples x (current and new samples) distances, as returned by sample_distances
+        path (String, optional): File of the extended CondensedDistances. Defaults to None, in memory.
+
+    Returns:
+        DistanceMatrix or CondensedDistances: Distance matrix of current and new samples, same type as distance_matrix
+    """
+    distances = as_distances(distance_matrix)
+    old_ids = list(distances.ids)
+    old = set(old_ids)
+    new_ids = [x for x in new_distances.index if x not in old]
+    block = new_distances.loc[new_ids, old_ids + new_ids].values
+    if isinstance(distances, CondensedDistances):
+        return distances.extend(new_ids, block, path)
+    n = len(old_ids)
+    data = np.zeros((n + len(new_ids), n + len(new_ids)))
+    data[:n, :n] = distances.data
+    data[n:, :] = block
+    data[:n, n:] = block[:, :n].T
+    np.fill_diagonal(data, 0)
+    return Artifact.import_data('DistanceMatrix', skbio.DistanceMatrix(data, old_ids + new_ids))
+
+def project_pcoa(pcoa_result, distance_matrix, new_distances):
+    """Place new samples into an existing PCoA without recomputing it
+
+    Uses the same triangulation as landmark PCoA, with every current sample as a landmark: a new sample
+    at squared distances d2 lands at -1/2 (d2 - mean squared distances) @ X / ||X||^2 per axis.
+
+    Args:
+        pcoa_result (PCoAResults): PCoA of the current samples
+        distance_matrix (DistanceMatrix or CondensedDistances): Distance matrix the PCoA was computed from
+        new_distances (DataFrame): New samples x current samples distances (more columns are ignored)
+
+    Returns:
+        PCoAResults: Ordination with the new samples appended, eigenvalues unchanged
+    """
+    ordination = pcoa_result.view(skbio.OrdinationResults)
+    distances = as_distances(distance_matrix)
+    if isinstance(distances, CondensedDistances):
+        mean_squared = -2 * distances.gower().row_means
+    else:
+        mean_squared = (distances.data ** 2).mean(axis=0)
+    mean_squared = pd.Series(mean_squared, index=distances.ids)
+
+    coordinates = ordination.samples
+    ids = coordinates.index
+    axis_norms = (coordinates.values ** 2).sum(axis=0)
+    pseudo_inverse = np.divide(coordinates.values, axis_norms, out=np.zeros_like(coordinates.values), where=axis_norms > 0)
+    current = set(ids)
+    new_ids = [x for x in new_distances.index if x not in current]
+    squared = new_distances.loc[new_ids, ids].values ** 2
+    projected = -0.5 * (squared - mean_squared[ids].values) @ pseudo_inverse
+    samples = pd.concat([coordinates, pd.DataFrame(projected, index=new_ids, columns=coordinates.columns)])
+    extended = skbio.OrdinationResults(ordination.short_method_name, ordination.long_method_name, ordination.eigvals,
+                                       samples=samples, proportion_explained=ordination.proportion_explained)
+    return Artifact.import_data('PCoAResults', extended)
+
+def gower_centered(distances):
+    """Double-center the squared distances, B = -1/2 J D^2 J
+
+    Args:
+        distances (Array): Square distance matrix
+
+    Returns:
+        Array: Gower centered matrix
+    """
+    B = distances.astype(np.float64) ** 2
+    B *= -0.5
+    row_means = B.mean(axis=1)
+    B -= row_means[:, None]
+    B -= row_means[None, :]
+    B += row_means.mean()
+    return B
+
+def randomized_eigh(B, n_dimensions, tol=1e-3, oversampling=10, max_iter=20, random_state=0):
+    """Largest eigenpairs of a symmetric matrix by randomized subspace iteration
+
+    Power iterations stop once the top eigenvalues change by less than tol (relative).
+
+    Args:
+        B (Array or GowerOperator): Symmetric matrix
+        n_dimensions (Int): Number of eigenpairs
+        tol (Float, optional): Relative eigenvalue accuracy target. Defaults to 1e-3.
+        oversampling (Int, optional): Extra subspace dimensions. Defaults to 10.
+        max_iter (Int, optional): Maximum number of power iterations. Defaults to 20.
+        random_state (Int, optional): Seed of the random subspace. Defaults to 0.
+
+    Returns:
+        Tuple: (eigenvalues in decreasing order, eigenvectors as columns)
+    """
+    rng = np.random.RandomState(random_state)
+    Q = rng.normal(size=(B.shape[0], min(n_dimensions + oversampling, B.shape[0])))
+    previous = None
+    for _ in range(max_iter):
+        Q, _ = np.linalg.qr(B @ Q)
+        eigvals, small_eigvecs = np.linalg.eigh(Q.T @ (B @ Q))
+        order = np.argsort(eigvals)[::-1][:n_dimensions]
+        eigvals = eigvals[order]
+        if previous is not None and np.all(np.abs(eigvals - previous) <= tol * np.abs(eigvals).max()):
+            break
+        previous = eigvals
+    return eigvals, Q @ small_eigvecs[:, order]
+
+def _ordination_results(ids, coordinates, eigvals, proportion_explained):
+    """Wrap coordinates as a PCoAResults artifact, as returned by the qiime pcoa action"""
+    axes = ['PC' + str(i + 1) for i in range(coordinates.shape[1])]
+    ordination = skbio.OrdinationResults('PCoA', 'Principal Coordinate Analysis',
+                                         eigvals=pd.Series(eigvals, index=axes),
+                                         samples=pd.DataFrame(coordinates, index=ids, columns=axes),
+                                         proportion_explained=pd.Series(proportion_explained, index=axes))
+    return Artifact.import_data('PCoAResults', ordination)
+
+def fast_pcoa(distance_matrix, n_dimensions, method='randomized', tol=1e-3, n_landmarks=1000, random_state=0):
+    """Approximate Principal Coordinates Analysis
+
+    'randomized' runs randomized subspace iteration on the Gower centered matrix. 'landmark' runs classical
+    PCoA on n_landmarks random samples and places every other sample by its distances to the landmarks
+    (landmark MDS), so it never centres or decomposes the full n x n matrix.
+
+    Args:
+        distance_matrix (DistanceMatrix or CondensedDistances): Distance Matrix
+        n_dimensions (Int): Dimensions to reduce the distance matrix to
+        method (String, optional): 'randomized' or 'landmark'. Defaults to 'randomized'.
+        tol (Float, optional): Relative eigenvalue accuracy target of the randomized method. Defaults to 1e-3.
+        n_landmarks (Int, optional): Number of landmark samples. Defaults to 1000.
+        random_state (Int, optional): Seed of the random subspace or landmark choice. Defaults to 0.
+
+    Returns:
+        PCoAResults: Ordination with eigenvalues and proportion explained of the computed axes
+    """
+    distances = as_distances(distance_matrix)
+    compact = isinstance(distances, CondensedDistances)
+    n_samples = len(distances.ids)
+
+    if method == 'landmark' and n_landmarks < n_samples:
+        landmarks = np.sort(np.random.RandomState(random_state).choice(n_samples, n_landmarks, replace=False))
+        landmark_rows = distances.rows(landmarks) if compact else distances.data[landmarks]
+        B = gower_centered(landmark_rows[:, landmarks])
+        eigvals, eigvecs = np.linalg.eigh(B)
+        order = np.argsort(eigvals)[::-1][:n_dimensions]
+        eigvals, eigvecs = np.clip(eigvals[order], 0, None), eigvecs[:, order]
+        # Triangulate all samples from their squared distances to the landmarks
+        squared = landmark_rows.T ** 2
+        mean_squared = (landmark_rows[:, landmarks] ** 2).mean(axis=0)
+        pseudo_inverse = np.divide(eigvecs, np.sqrt(eigvals), out=np.zeros_like(eigvecs), where=eigvals > 0)
+        coordinates = -0.5 * (squared - mean_squared) @ pseudo_inverse
+        proportion_explained = eigvals / np.trace(B)
+        eigvals = eigvals * n_samples / n_landmarks
+    else:
+        if compact:
+            B = distances.gower()
+            total = B.trace()
+        else:
+            B = gower_centered(distances.data)
+            total = np.trace(B)
+        eigvals, eigvecs = randomized_eigh(B, n_dimensions, tol, random_state=random_state)
+        del B
+        eigvals = np.clip(eigvals, 0, None)
+        coordinates = eigvecs * np.sqrt(eigvals)
+        proportion_explained = eigvals / total
+    return _ordination_results(distances.ids, coordinates, eigvals, proportion_explained)
+
+def calculate_pcoa(distance_matrix_dict, n_dimensions, method='exact', tol=1e-3, n_landmarks=1000):
     """Calculate Principle Coordinates Analysis for multiple distance matrices
 
     Args:
         distance_matrix_dict (Dict): Dictionary containing distance matrices
         n_dimensions (Int): Dimensions to reduce the distance matrix to
+        method (String, optional): 'exact' uses the qiime pcoa action (expanding CondensedDistances),
+            'randomized' or 'landmark' use fast_pcoa. Defaults to 'exact'.
+        tol (Float, optional): Relative eigenvalue accuracy target of the randomized method. Defaults to 1e-3.
+        n_landmarks (Int, optional): Number of landmark samples of the landmark method. Defaults to 1000.
 
     Returns:
         Dict: {"Metric": PcoA Results}
     """
+    from qiime2.plugins.diversity.methods import pcoa
     pcoa_results = {}
     for i in distance_matrix_dict.keys():
-        pcoa_results[i] = pcoa(distance_matrix_dict[i], n_dimensions).pcoa
+        if method == 'exact':
+            distance_matrix = distance_matrix_dict[i]
+            if isinstance(distance_matrix, CondensedDistances):
+                distance_matrix = distance_matrix.to_artifact()
+            pcoa_results[i] = pcoa(distance_matrix, n_dimensions).pcoa
+        else:
+            pcoa_results[i] = fast_pcoa(distance_matrix_dict[i], n_dimensions, method, tol, n_landmarks)
     return pcoa_results
 
+def pcoa_variance_explained(pcoa_results):
+    """Proportion of variance explained by each axis of each PCoA result
+
+    Args:
+        pcoa_results (Dict): Dictionary containing pcoa results
+
+    Returns:
+        DataFrame: Proportion explained, metrics as rows and axes as columns
+    """
+    return pd.DataFrame({metric: result.view(skbio.OrdinationResults).proportion_explained
+                         for metric, result in pcoa_results.items()}).T
+
 def permanova_test(distance_matrix, metadata_col, metric):
     """Perform permanova test on given column
 
@@ -49,8 +551,16 @@ def permanova_test(distance_matrix, metadata_col, metric):
         metadata_col (_type_): Column that will undergo permanova test
         metric (String): The beta diversity metric to be computed.
     """
-    permanova_result = beta_group_significance(distance_matrix, metadata_col, method='permanova')
-    permanova_result.visualization.save('data/out/'+metric+'_permanova_test_'+metadata_col.name)
+    # Rendered by the render queue processes
+    path = 'data/out/'+metric+'_permanova_test_'+metadata_col.name+'.qzv'
+    render_queue.submit(path, _permanova_visualization, distance_matrix, metadata_col.to_series(), path)
+
+def _permanova_visualization(distance_matrix_path, metadata_series, path):
+    from qiime2.metadata import CategoricalMetadataColumn
+    from qiime2.plugins.diversity.visualizers import beta_group_significance
+    permanova_result = beta_group_significance(Artifact.load(distance_matrix_path), CategoricalMetadataColumn(metadata_series),
+                                               method='permanova')
+    return permanova_result.visualization.save(path)
     
 def permanova_test_all_diseases(u_unifrac_dis_matrix, w_unifrac_dis_matrix, metadata, disease_targets):
     """Perform permanova test on all disease columns using weighted/unweighted unifrac distance matrices
@@ -67,5 +577,104 @@ def permanova_test_all_diseases(u_unifrac_dis_matrix, w_unifrac_dis_matrix, meta
         metadata_disease_col = metadata.get_column(disease)
         permanova_test(u_unifrac_dis_matrix, metadata_disease_col,'u_unifrac')
         permanova_test(w_unifrac_dis_matrix, metadata_disease_col,'w_unifrac')
-        
 
+def permanova_batch(distance_matrix, groupings, permutations=999, random_state=0, chunk_size=100):
+    """PERMANOVA of several groupings sharing one centred distance matrix and one batch of permutations
+
+    The distance matrix is Gower centred once per labelled sample set. With Z the group indicator columns of
+    every grouping (scaled by 1/sqrt(group size)), trace(HG) of a grouping is the sum of its columns of
+    Z * (G @ Z). Permuting labels permutes the rows of Z, so a chunk of permutations is a single G @ Z[perms]
+    product for all groupings at once.
+
+    Args:
+        distance_matrix (DistanceMatrix or CondensedDistances): Distance Matrix
+        groupings (Dict): Group labels (Series indexed by sample id) keyed by grouping name
+        permutations (Int, optional): Number of permutations. Defaults to 999.
+        random_state (Int, optional): Seed of the permutations. Defaults to 0.
+        chunk_size (Int, optional): Number of permutations evaluated per matrix product. Defaults to 100.
+
+    Returns:
+        DataFrame: Sample size, number of groups, pseudo-F and p-value per grouping
+    """
+    dm = as_distances(distance_matrix)
+    rng = np.random.RandomState(random_state)
+
+    # Groupings labelling the same samples share the centred matrix and permutations
+    sample_sets = {}
+    for name, grouping in groupings.items():
+        grouping = grouping.dropna()
+        grouping = grouping[grouping.index.isin(list(dm.ids))]
+        sample_sets.setdefault(tuple(sorted(grouping.index)), {})[name] = grouping
+
+    rows = []
+    for ids, sample_groupings in sample_sets.items():
+        ids = list(ids)
+        n = len(ids)
+        if isinstance(dm, CondensedDistances):
+            G = dm.filter(ids).gower()
+            total = G.trace()
+        else:
+            G = gower_centered(dm.filter(ids).data)
+            total = np.trace(G)
+
+        blocks, owners, n_groups = [], [], []
+        for i, grouping in enumerate(sample_groupings.values()):
+            codes, uniques = pd.factorize(grouping.reindex(ids))
+            counts = np.bincount(codes)
+            Z = np.zeros((n, len(uniques)))
+            Z[np.arange(n), codes] = 1 / np.sqrt(counts[codes])
+            blocks.append(Z)
+            owners += [i] * len(uniques)
+            n_groups.append(len(uniques))
+        Z = np.hstack(blocks)
+        # Sums the indicator columns of each grouping
+        owner_matrix = np.zeros((Z.shape[1], len(blocks)))
+        owner_matrix[np.arange(Z.shape[1]), owners] = 1
+        n_groups = np.array(n_groups)
+
+        def pseudo_f(trace_hg):
+            with np.errstate(divide='ignore', invalid='ignore'):
+                return (trace_hg / (n_groups - 1)) / ((total - trace_hg) / (n - n_groups))
+
+        observed = pseudo_f(((Z * (G @ Z)).sum(axis=0)) @ owner_matrix)
+        exceed = np.zeros(len(blocks))
+        permutation_index = np.array([rng.permutation(n) for _ in range(permutations)]).reshape(-1, n)
+        for start in range(0, permutations, chunk_size):
+            index = permutation_index[start:start + chunk_size]
+            permuted = Z[index].transpose(1, 0, 2).reshape(n, -1)
+            traces = (permuted * (G @ permuted)).sum(axis=0).reshape(len(index), -1) @ owner_matrix
+            exceed += (pseudo_f(traces) >= observed).sum(axis=0)
+
+        for i, name in enumerate(sample_groupings):
+            rows.append({'grouping': name, 'sample_size': n, 'number_of_groups': n_groups[i],
+                         'test_statistic': observed[i], 'p_value': (exceed[i] + 1) / (permutations + 1),
+                         'permutations': permutations})
+    return pd.DataFrame(rows)
+
+def permanova_tests(distance_matrix_dict, metadata, disease_targets, permutations=999, random_state=0, render=False):
+    """Perform permanova tests of all disease columns on all given distance matrices with the batched engine
+
+    Args:
+        distance_matrix_dict (Dict): Distance matrices keyed by the metric name used in output file names
+        metadata (METADATA): Disease metadata
+        disease_targets (List): Disease column names that will undergo permanova test
+        permutations (Int, optional): Number of permutations. Defaults to 999.
+        random_state (Int, optional): Seed of the permutations. Defaults to 0.
+        render (Boolean, optional): Also save the qiime permanova visualizations. Defaults to False.
+
+    Returns:
+        DataFrame: Pseudo-F and p-value per metric and disease
+    """
+    groupings = {disease: metadata.get_column(disease).to_series() for disease in disease_targets}
+    results = []
+    for metric, distance_matrix in distance_matrix_dict.items():
+        result = permanova_batch(distance_matrix, groupings, permutations, random_state)
+        result.insert(0, 'metric', metric)
+        results.append(result)
+    if render:
+        for metric, distance_matrix in distance_matrix_dict.items():
+            for disease in disease_targets:
+                if isinstance(distance_matrix, CondensedDistances):
+                    distance_matrix = distance_matrix.to_artifact()
+                permanova_test(distance_matrix, metadata.get_column(disease), metric)
+    return pd.concat(results, ignore_index=True)
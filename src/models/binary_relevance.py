@@ -0,0 +1,206 @@
+from collections import namedtuple
+import time
+
+import numpy as np
+import pandas as pd
+from qiime2 import Artifact
+from sklearn.base import clone
+from sklearn.ensemble import GradientBoostingClassifier, RandomForestClassifier
+try:
+    from sklearn.ensemble import HistGradientBoostingClassifier
+except ImportError:
+    # Experimental before scikit-learn 1.0 (the QIIME 2 2022.11 environment ships 0.24)
+    from sklearn.experimental import enable_hist_gradient_boosting  # noqa: F401
+    from sklearn.ensemble import HistGradientBoostingClassifier
+from sklearn.model_selection import PredefinedSplit, cross_val_score
+
+from src.data import make_dataset
+
+BinaryRelevanceResult = namedtuple('BinaryRelevanceResult',
+                                   ['sample_estimator', 'predictions', 'probabilities',
+                                    'training_targets', 'test_targets', 'cv_scores', 'feature_ids', 'fit_seconds'],
+                                   defaults=(None, None))
+
+# Estimator backends of the shared engine; HistGradientBoosting is multi-threaded but needs dense input,
+# RandomForest also fits several labels at once (see multi_label)
+ESTIMATORS = {'gradient_boosting': GradientBoostingClassifier,
+              'hist_gradient_boosting': HistGradientBoostingClassifier,
+              'random_forest': RandomForestClassifier}
+
+def make_estimator(name='gradient_boosting', random_state=100):
+    """Unfitted classifier of an estimator backend
+
+    Args:
+        name (String, optional): Key of ESTIMATORS. Defaults to 'gradient_boosting'.
+        random_state (Int, optional): Seed of the estimator. Defaults to 100.
+
+    Returns:
+        Estimator: Unfitted scikit-learn classifier
+    """
+    if name not in ESTIMATORS:
+        raise ValueError('Unknown estimator: ' + name)
+    return ESTIMATORS[name](random_state=random_state)
+
+def needs_dense(estimator):
+    """Whether or not the estimator rejects sparse input"""
+    return isinstance(estimator, HistGradientBoostingClassifier)
+
+def feature_matrix(feature_table):
+    """Materialize a feature table as a sparse sample x feature matrix
+
+    Args:
+        feature_table (FeatureTable[Frequency]): Feature table artifact
+
+    Returns:
+        Tuple: (csr_matrix samples x features, Index of sample ids, Index of feature ids)
+    """
+    return make_dataset.feature_table_matrix(feature_table)
+
+def rarest_label(targets, sample_ids):
+    """Labels of the disease whose least frequent class is the rarest, to stratify the shared split on
+
+    Args:
+        targets (Dict): Disease target Series (or MetadataColumns) keyed by disease column name
+        sample_ids (Index): Samples of the feature matrix
+
+    Returns:
+        Array: Label of every sample ('' when unlabeled), None when no disease has two classes
+    """
+    strata, rarest = None, None
+    for target in targets.values():
+        if not isinstance(target, pd.Series):
+            target = target.to_series()
+        target = target.reindex(sample_ids)
+        counts = target.value_counts()
+        if len(counts) > 1 and (rarest is None or counts.min() < rarest):
+            rarest = counts.min()
+            strata = target.astype(str).where(target.notna(), '').values
+    return strata
+
+def shared_split(n_samples, test_size=0.3, cv=10, random_state=100, strata=None):
+    """Assign every sample once to the test set or to one of the cross validation folds
+
+    With strata, every stratum is split separately and its training samples are dealt round robin to the
+    folds, like the stratified split and folds of classify_samples, so rare classes reach the test set and
+    every fold.
+
+    Args:
+        n_samples (Int): Number of samples in the feature matrix
+        test_size (Float, optional): Fraction of samples held out for testing. Defaults to 0.3.
+        cv (Int, optional): Number of cross validation folds of the training samples. Defaults to 10.
+        random_state (Int, optional): Seed of the split. Defaults to 100.
+        strata (Array, optional): Label of every sample to stratify on, see rarest_label. Defaults to None.
+
+    Returns:
+        Tuple: (Boolean array marking test samples, Int array of fold ids, -1 for test samples)
+    """
+    rng = np.random.RandomState(random_state)
+    if strata is None:
+        groups = [np.arange(n_samples)]
+    else:
+        _, inverse = np.unique(np.asarray(strata), return_inverse=True)
+        groups = [np.flatnonzero(inverse == k) for k in range(inverse.max() + 1)] if n_samples else []
+    is_test = np.zeros(n_samples, dtype=bool)
+    folds = np.full(n_samples, -1)
+    n_train = 0
+    for group in groups:
+        order = rng.permutation(group)
+        n_test = int(round(test_size * len(order)))
+        is_test[order[:n_test]] = True
+        train_order = order[n_test:]
+        if cv > 1:
+            # Continuing the round robin across strata keeps the folds the same size
+            folds[train_order] = (n_train + np.arange(len(train_order))) % cv
+        n_train += len(train_order)
+    return is_test, folds
+
+def fit_target(X, target, is_test, folds, estimator, n_jobs=1):
+    """Fit one binary classifier on the shared feature matrix
+
+    Args:
+        X (csr_matrix): Sample x feature matrix
+        target (Series): Target values aligned to the rows of X, NaN for unlabeled samples
+        is_test (Array): Boolean array marking test samples
+        folds (Array): Cross validation fold id of every training sample
+        estimator (Estimator): Unfitted scikit-learn classifier
+        n_jobs (Int, optional): Number of cross validation folds fitted in parallel. Defaults to 1.
+
+    Returns:
+        BinaryRelevanceResult: Fitted estimator, test predictions and probabilities, targets, cv scores and
+            training time (cross validation and final fit)
+    """
+    start = time.perf_counter()
+    labeled = target.notna().values
+    train = labeled & ~is_test
+    test = labeled & is_test
+    y_train = target.values[train]
+
+    cv_scores = None
+    train_folds = folds[train]
+    if (train_folds >= 0).any() and len(np.unique(train_folds)) > 1:
+        cv_scores = cross_val_score(clone(estimator), X[train], y_train, cv=PredefinedSplit(train_folds), n_jobs=n_jobs)
+
+    model = clone(estimator).fit(X[train], y_train)
+    fit_seconds = time.perf_counter() - start
+    test_ids = target.index[test]
+    predictions = pd.Series(model.predict(X[test]), index=test_ids, name='prediction')
+    probabilities = pd.DataFrame(model.predict_proba(X[test]), index=test_ids, columns=model.classes_)
+    return BinaryRelevanceResult(model, predictions, probabilities,
+                                 target[train].rename(target.name),
+                                 target[test].rename(target.name), cv_scores, fit_seconds=fit_seconds)
+
+def to_artifacts(result):
+    """Wrap predictions and targets as Qiime artifacts so they can be consumed like classify_samples results
+
+    Args:
+        result (BinaryRelevanceResult): Result of fit_target
+
+    Returns:
+        BinaryRelevanceResult: Result with predictions, probabilities and targets as artifacts
+    """
+    return result._replace(
+        predictions=Artifact.import_data('SampleData[ClassifierPredictions]', result.predictions),
+        probabilities=Artifact.import_data('SampleData[Probabilities]', result.probabilities),
+        training_targets=Artifact.import_data('SampleData[TrueTargets]', result.training_targets),
+        test_targets=Artifact.import_data('SampleData[TrueTargets]', result.test_targets))
+
+def binary_relevance_shared(feature_table, targets, test_size=0.3, cv=10, random_state=100, n_jobs=1, estimator_params=None,
+                            estimator='gradient_boosting'):
+    """Fit one classifier per disease on a single shared feature matrix, split and fold assignment
+
+    Args:
+        feature_table (FeatureTable[Frequency]): Feature table containing all features that will be used to create model
+        targets (Dict): Disease target Series (or MetadataColumns) keyed by disease column name
+        test_size (Float, optional): Fraction of samples held out for testing. Defaults to 0.3.
+        cv (Int, optional): Number of cross validation folds. Defaults to 10.
+        random_state (Int, optional): Seed of the split and the estimators. Defaults to 100.
+        n_jobs (Int, optional): Number of cross validation folds fitted in parallel. Defaults to 1.
+        estimator_params (Dict, optional): Parameters of the estimator keyed by disease, e.g. the gradient_boosting
+            parameters found by tuning.tune_binary_relevance. Defaults to None.
+        estimator (String, optional): Estimator backend, a key of ESTIMATORS. Defaults to 'gradient_boosting'.
+
+    Returns:
+        Dict: Dictionary of model results by disease type: {'disease_col': BinaryRelevanceResult}
+    """
+    estimator_name, estimator = estimator, make_estimator(estimator, random_state)
+    # Tuned parameters (tuning_best_params.json) belong to gradient_boosting, check them before any fit
+    for disease_name, params in (estimator_params or {}).items():
+        unknown = sorted(set(params) - set(estimator.get_params()))
+        if unknown:
+            raise ValueError('estimator_params of ' + disease_name + ' are not parameters of the ' + estimator_name +
+                             ' estimator: ' + ', '.join(unknown))
+    X, sample_ids, feature_ids = feature_matrix(feature_table)
+    is_test, folds = shared_split(len(sample_ids), test_size, cv, random_state, rarest_label(targets, sample_ids))
+    if needs_dense(estimator):
+        X = X.toarray().astype(np.float32)
+
+    results = {}
+    for disease_name, target in targets.items():
+        if not isinstance(target, pd.Series):
+            target = target.to_series()
+        target = target.reindex(sample_ids).rename(disease_name)
+        disease_estimator = clone(estimator).set_params(**estimator_params[disease_name]) \
+            if estimator_params and disease_name in estimator_params else estimator
+        result = fit_target(X, target, is_test, folds, disease_estimator, n_jobs)._replace(feature_ids=feature_ids)
+        results[disease_name] = to_artifacts(result)
+    return results
@@ -1,20 +1,213 @@
-from sklearn.metrics import accuracy_score
+from collections import namedtuple
+import warnings
+
+import numpy as np
 import pandas as pd
+from scipy.stats import rankdata
+
+from src.models.multi_label import LABEL_VALUES
+from src.models.predict import DiseaseClassifiers
+
+
+LabelMatrices = namedtuple('LabelMatrices', ['targets', 'predictions', 'probabilities'])
+
+def _view(value, view_type):
+    """Pandas view of a Qiime artifact, pandas objects are returned unchanged"""
+    return value if isinstance(value, (pd.Series, pd.DataFrame)) else value.view(view_type)
+
+def _binary(values):
+    """1/0 labels of T/F (True/False or 1/0) values, NaN stays NaN"""
+    return values.astype(str).map(LABEL_VALUES).where(values.notna())
+
+def label_matrices(model_results, disease_targets):
+    """Gather the test targets, predictions and probabilities of every disease into aligned label matrices
+
+    Rows are the union of the test samples of all diseases; a disease is NaN for samples outside its test set.
+
+    Args:
+        model_results (Dict): binary_relevance_model results (Qiime results or BinaryRelevanceResult) by disease type
+        disease_targets (List): List of disease column names
+
+    Returns:
+        LabelMatrices: Samples x diseases DataFrames of 1/0 test targets, 1/0 predictions and positive class probabilities
+    """
+    targets, predictions, probabilities = {}, {}, {}
+    for disease_name in disease_targets:
+        results = model_results[disease_name]
+        targets[disease_name] = _binary(_view(results.test_targets, pd.Series))
+        predictions[disease_name] = _binary(_view(results.predictions, pd.Series))
+        proba = _view(results.probabilities, pd.DataFrame)
+        probabilities[disease_name] = proba.iloc[:, DiseaseClassifiers.positive_class(list(proba.columns))]
+    targets = pd.DataFrame(targets)
+    return LabelMatrices(targets, pd.DataFrame(predictions).reindex(targets.index),
+                         pd.DataFrame(probabilities).reindex(targets.index))
+
+def _divide(numerator, denominator, empty=0.0):
+    """Elementwise ratio, empty where the denominator is 0"""
+    numerator, denominator = np.broadcast_arrays(np.asarray(numerator, dtype=float), np.asarray(denominator, dtype=float))
+    return np.divide(numerator, denominator, out=np.full(numerator.shape, empty), where=denominator != 0)
+
+def _auc(y, scores, mask):
+    """ROC-AUC of every label from the ranks of its scores (Mann-Whitney U), along the sample axis (-2)
+
+    Masked samples get infinite scores, so they rank above every valid sample without changing their ranks.
+    Labels with a single class are NaN.
+    """
+    ranks = rankdata(np.where(mask, scores, np.inf), axis=-2)
+    positive = mask & (y == 1)
+    n_positive = positive.sum(axis=-2)
+    n_negative = (mask & (y == 0)).sum(axis=-2)
+    return _divide((ranks * positive).sum(axis=-2) - n_positive * (n_positive + 1) / 2, n_positive * n_negative, np.nan)
+
+def _scores(Y, P, S, mask):
+    """Every score of label matrices shaped (..., samples, labels), in one vectorized pass
+
+    Returns:
+        Dict: Score name -> array (..., labels + 2), the last two columns being the micro and macro averages
+    """
+    y = np.where(mask, Y, 0)
+    p = np.where(mask, P, 0)
+    tp = (mask & (y == 1) & (p == 1)).sum(axis=-2)
+    fp = (mask & (y == 0) & (p == 1)).sum(axis=-2)
+    fn = (mask & (y == 1) & (p == 0)).sum(axis=-2)
+    n = mask.sum(axis=-2)
+
+    def nanmean(values):
+        with warnings.catch_warnings():
+            # Labels without both classes in a resample have no AUC
+            warnings.simplefilter('ignore', RuntimeWarning)
+            return np.nanmean(values, axis=-1)
+
+    def with_averages(per_label, micro):
+        return np.concatenate([per_label, micro[..., None], nanmean(per_label)[..., None]], axis=-1)
+
+    TP, FP, FN, N = tp.sum(axis=-1), fp.sum(axis=-1), fn.sum(axis=-1), n.sum(axis=-1)
+    correct = (mask & (y == p)).sum(axis=-2)
+    scores = {'accuracy': with_averages(_divide(correct, n, np.nan), _divide(correct.sum(axis=-1), N, np.nan)),
+              'precision': with_averages(_divide(tp, tp + fp), _divide(TP, TP + FP)),
+              'recall': with_averages(_divide(tp, tp + fn), _divide(TP, TP + FN)),
+              'f1': with_averages(_divide(2 * tp, 2 * tp + fp + fn), _divide(2 * TP, 2 * TP + FP + FN))}
+
+    # Per disease: micro AUC over the one-hot (negative, positive) columns, macro AUC is the binary AUC
+    auc = _auc(y, S, mask)
+    onehot_auc = _auc(np.concatenate([1 - y, y], axis=-2), np.concatenate([1 - S, S], axis=-2),
+                      np.concatenate([mask, mask], axis=-2))
+    flat_shape = y.shape[:-2] + (-1, 1)
+    micro_auc = _auc(y.reshape(flat_shape), S.reshape(flat_shape), mask.reshape(flat_shape))[..., 0]
+    scores['micro_auc'] = np.concatenate([onehot_auc, micro_auc[..., None], np.full(micro_auc.shape + (1,), np.nan)], axis=-1)
+    scores['macro_auc'] = np.concatenate([auc, np.full(micro_auc.shape + (1,), np.nan),
+                                          nanmean(auc)[..., None]], axis=-1)
 
+    # Label set scores, reported on the micro row
+    overall = np.full(auc.shape[:-1] + (auc.shape[-1] + 2,), np.nan)
+    scores['hamming_loss'] = overall.copy()
+    scores['hamming_loss'][..., -2] = _divide((mask & (y != p)).sum(axis=(-2, -1)), N, np.nan)
+    complete = mask.all(axis=-1)
+    scores['subset_accuracy'] = overall
+    scores['subset_accuracy'][..., -2] = _divide((complete & (y == p).all(axis=-1)).sum(axis=-1), complete.sum(axis=-1), np.nan)
+    return scores
+
+def batch_scores(matrices, n_bootstrap=0, confidence=0.95, batch_size=100, random_state=0):
+    """Accuracy, precision, recall, F1, micro/macro ROC-AUC, Hamming loss and subset accuracy of aligned label matrices
+
+    Bootstrap confidence intervals resample the test samples; every batch of resamples is scored at once by
+    indexing the label matrices with a (batch, samples) array of resampling indices.
+
+    Args:
+        matrices (LabelMatrices): Aligned test targets, predictions and probabilities, see label_matrices
+        n_bootstrap (Int, optional): Number of bootstrap resamples, 0 for no confidence intervals. Defaults to 0.
+        confidence (Float, optional): Confidence level of the intervals. Defaults to 0.95.
+        batch_size (Int, optional): Number of resamples scored at a time. Defaults to 100.
+        random_state (Int, optional): Seed of the resamples. Defaults to 0.
+
+    Returns:
+        DataFrame: Scores per disease with 'micro' and 'macro' rows, and their <score>_low/<score>_high bounds
+    """
+    targets = matrices.targets
+    mask = targets.notna().values
+    Y = targets.fillna(0).values
+    P = matrices.predictions[targets.columns].fillna(0).values
+    S = matrices.probabilities[targets.columns].fillna(0).values
+    index = list(targets.columns) + ['micro', 'macro']
+    scores = pd.DataFrame(_scores(Y, P, S, mask), index=index)
+    if not n_bootstrap:
+        return scores
+
+    rng = np.random.RandomState(random_state)
+    resampled = {name: [] for name in scores.columns}
+    for start in range(0, n_bootstrap, batch_size):
+        indices = rng.randint(0, len(targets), size=(min(batch_size, n_bootstrap - start), len(targets)))
+        for name, values in _scores(Y[indices], P[indices], S[indices], mask[indices]).items():
+            resampled[name].append(values)
+    tail = 100 * (1 - confidence) / 2
+    columns = {}
+    for name in scores.columns:
+        values = np.concatenate(resampled[name])
+        with warnings.catch_warnings():
+            # Scores only defined on some rows (e.g. hamming_loss) are NaN elsewhere
+            warnings.simplefilter('ignore', RuntimeWarning)
+            low, high = np.nanpercentile(values, [tail, 100 - tail], axis=0)
+        columns[name] = scores[name]
+        columns[name + '_low'] = low
+        columns[name + '_high'] = high
+    return pd.DataFrame(columns, index=index)
+
+def disease_aucs(scores):
+    """{disease: [micro AUC, macro AUC]} of batch_scores, as expected by binary_relevance_accuracy_scores_graph_with_auc"""
+    diseases = [x for x in scores.index if x not in ['micro', 'macro']]
+    return {d: [scores.loc[d, 'micro_auc'], scores.loc[d, 'macro_auc']] for d in diseases}
+
+def binary_relevance_scores(model_results, disease_targets, n_bootstrap=0, confidence=0.95, batch_size=100, random_state=0):
+    """Score every binary classifier of the binary relevance model at once, see batch_scores
+
+    Returns:
+        Tuple: (DataFrame of scores, {disease: [micro AUC, macro AUC]})
+    """
+    scores = batch_scores(label_matrices(model_results, disease_targets), n_bootstrap, confidence, batch_size, random_state)
+    return scores, disease_aucs(scores)
 
 def binary_relevance_accuracy_scores(model_results, disease_targets):
     """Calculate accuracy scores of all binary classifers within binary relevance model
 
     Args:
-        model_results (): _description_
+        model_results (Dict): binary_relevance_model results by disease type
         disease_cols (List): List of disease column names 
 
     Returns:
         Dict: Accuracy scores for binary relevance model keyed by disease column name
     """
-    disease_accuracy_scores = {}
-    for i in disease_targets:
-        score = accuracy_score(model_results[i].test_targets.view(pd.Series), model_results[i].predictions.view(pd.Series))
-        disease_accuracy_scores[i] = score
-        
-    return disease_accuracy_scores
\ No newline at end of file
+    scores = batch_scores(label_matrices(model_results, disease_targets))
+    return scores.loc[disease_targets, 'accuracy'].to_dict()
+
+def multi_label_scores(test_targets, predictions, probabilities, n_bootstrap=0, confidence=0.95, batch_size=100, random_state=0):
+    """Per-label and micro/macro averaged scores of a multi-label model
+
+    Args:
+        test_targets (DataFrame): Samples x diseases 1/0 test labels
+        predictions (DataFrame): Samples x diseases 1/0 predictions
+        probabilities (DataFrame): Samples x diseases probability of label 1
+        n_bootstrap, confidence, batch_size, random_state: Bootstrap confidence intervals, see batch_scores
+
+    Returns:
+        Tuple: (accuracy keyed by disease, {disease: [micro AUC, macro AUC]} as expected by
+            make_visualizations.binary_relevance_accuracy_scores_graph_with_auc, DataFrame of batch_scores)
+    """
+    scores = batch_scores(LabelMatrices(test_targets, predictions, probabilities), n_bootstrap, confidence, batch_size, random_state)
+    return scores.loc[list(test_targets.columns), 'accuracy'].to_dict(), disease_aucs(scores), scores
+
+def training_report(disease_accuracy_scores, times_path='data/out/training_times.tsv',
+                    output_path='data/out/training_report.tsv'):
+    """Accuracy and training time of every disease classifier, to weigh speed against fidelity
+
+    Args:
+        disease_accuracy_scores (Dict): Accuracy scores keyed by disease column name
+        times_path (String, optional): Training times saved by make_models.binary_relevance_model. Defaults to 'data/out/training_times.tsv'.
+        output_path (String, optional): Output table. Defaults to 'data/out/training_report.tsv'.
+
+    Returns:
+        DataFrame: Engine, estimator, number of features, training seconds and accuracy per disease
+    """
+    report = pd.read_csv(times_path, sep='\t', index_col='disease')
+    report['accuracy'] = pd.Series(disease_accuracy_scores)
+    report.to_csv(output_path, sep='\t')
+    return report
\ No newline at end of file
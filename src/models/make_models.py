@@ -1,11 +1,41 @@
-from qiime2.plugins.sample_classifier.pipelines import classify_samples
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import pickle
+import time
 
-def sample_classifier_single_disease(feature_table, metadataCol):
+from qiime2 import Artifact, Visualization
+from qiime2.metadata import CategoricalMetadataColumn
+from qiime2.sdk import Results
+import pandas as pd
+from sklearn.pipeline import Pipeline
+from threadpoolctl import threadpool_limits
+
+from src.data import make_dataset
+from src.models import binary_relevance, multi_label
+
+def train_classifier(feature_table, metadataCol, n_jobs=1):
+    """Train and cross validate the gradient boosting classifier of a single disease
+
+    Args:
+        feature_table (FeatureTable[Frequency]): Feature table containing all features that will be used to create model
+        metadataCol (MetadataColumn[Categorical]): Metadata column that will be used as prediction target
+        n_jobs (Int, optional): Number of threads used by the estimator. Defaults to 1.
+
+    Returns:
+        Results: classify_samples results
+    """
+    from qiime2.plugins.sample_classifier.pipelines import classify_samples
+    return classify_samples(feature_table, metadataCol, estimator='GradientBoostingClassifier',
+                            test_size = 0.3, cv = 10, random_state = 100, missing_samples='ignore', n_jobs = n_jobs)
+
+def sample_classifier_single_disease(feature_table, metadataCol, n_jobs=1):
     """Create machine learning model of given metadataCol/disease_type
 
     Args:
         feature_table (FeatureTable[Frequency]): Feature table containing all features that will be used to create model
         metadataCol (MetadataColumn[Categorical]): Metadata column that will be used as prediction target
+        n_jobs (Int, optional): Number of threads used by the estimator. Defaults to 1.
 
     Returns:
         sample_estimator : SampleEstimator[Classifier]
@@ -28,8 +58,7 @@ def sample_classifier_single_disease(feature_table, metadataCol):
         test_targets : SampleData[TrueTargets]
             Series containing true target values of test samples
     """
-    results = classify_samples(feature_table, metadataCol, estimator='GradientBoostingClassifier', 
-                               test_size = 0.3, cv = 10, random_state = 100, missing_samples='ignore')
+    results = train_classifier(feature_table, metadataCol, n_jobs)
     # results
     accuracy_results = results.accuracy_results
     
@@ -38,25 +67,199 @@ def sample_classifier_single_disease(feature_table, metadataCol):
    
     return results
 
-def binary_relevance_model(feature_table, metadata, precvd_metadata, disease_targets):
+def save_estimators(model_results, model_dir='data/out/models'):
+    """Save the trained estimator of every disease for batch inference (see src.models.predict)
+
+    classify_samples estimators are unpacked from their DictVectorizer pipeline, so every disease is saved as
+    the fitted sklearn estimator with the feature id of each of its input columns.
+
+    Args:
+        model_results (Dict): binary_relevance_model results by disease type
+        model_dir (String, optional): Directory of the saved <disease>.pkl files. Defaults to 'data/out/models'.
+    """
+    os.makedirs(model_dir, exist_ok=True)
+    for disease_name, results in model_results.items():
+        if isinstance(results, binary_relevance.BinaryRelevanceResult):
+            estimator, feature_ids = results.sample_estimator, list(results.feature_ids)
+        else:
+            pipeline = results.sample_estimator.view(Pipeline)
+            vectorizer, estimator = pipeline.steps[0][1], pipeline.steps[-1][1]
+            feature_ids = list(vectorizer.feature_names_)
+        with open(os.path.join(model_dir, disease_name + '.pkl'), 'wb') as fh:
+            pickle.dump({'estimator': estimator, 'feature_ids': feature_ids}, fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+def _limit_worker_threads(threads_per_worker):
+    """Process pool initializer limiting the BLAS/OpenMP threads of a worker"""
+    for var in ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']:
+        os.environ[var] = str(threads_per_worker)
+    threadpool_limits(threads_per_worker)
+
+def _train_disease_worker(table_path, target, target_name, out_dir, threads_per_worker):
+    """Train a single disease classifier in a worker process and save its outputs
+
+    Args:
+        table_path (String): Path of the saved feature table artifact
+        target (Series): Disease target values indexed by sample id
+        target_name (String): Disease column name
+        out_dir (String): Directory where the classify_samples outputs are saved
+        threads_per_worker (Int): Number of threads used by the estimator
+
+    Returns:
+        Tuple: (training seconds, (output name, saved path) pairs of the classify_samples results)
+    """
+    feature_table = Artifact.load(table_path)
+    metadataCol = CategoricalMetadataColumn(target.rename(target_name))
+    start = time.perf_counter()
+    results = train_classifier(feature_table, metadataCol, threads_per_worker)
+    train_seconds = time.perf_counter() - start
+    os.makedirs(out_dir, exist_ok=True)
+    return train_seconds, [(name, output.save(os.path.join(out_dir, name))) for name, output in zip(results._fields, results)]
+
+def _load_results(saved_outputs):
+    """Reload classify_samples results saved by a worker process"""
+    fields = [name for name, _ in saved_outputs]
+    outputs = [Visualization.load(path) if path.endswith('.qzv') else Artifact.load(path) for _, path in saved_outputs]
+    return Results(fields, outputs)
+
+def disease_columns(metadata, precvd_metadata, disease_targets):
+    """Target column of every disease, precvd_v2 is taken from the balanced PreCVD metadata
+
+    Args:
+        metadata (Metadata): Metadata containing data about disease targets
+        precvd_metadata (Metadata): Balanced PreCVD metadata
+        disease_targets (List): List of disease targets
+
+    Returns:
+        Dict: MetadataColumn keyed by disease
+    """
+    disease_cols = {}
+    for disease_name in disease_targets:
+        if disease_name == 'precvd_v2':
+            disease_cols[disease_name] = precvd_metadata.get_column('precvd_v2')
+        else:
+            disease_cols[disease_name] = metadata.get_column(disease_name)
+    return disease_cols
+
+def save_training_times(train_seconds, engine, estimator, n_features, path='data/out/training_times.tsv'):
+    """Save the training time of every disease, reported with the accuracy by evaluate_models.training_report
+
+    Args:
+        train_seconds (Dict): Seconds spent training (cross validation and final fit) keyed by disease
+        engine (String): Training engine
+        estimator (String): Estimator backend
+        n_features (Int): Number of features the classifiers were trained on
+        path (String, optional): Output table. Defaults to 'data/out/training_times.tsv'.
+
+    Returns:
+        DataFrame: Training time per disease
+    """
+    times = pd.DataFrame({'disease': list(train_seconds), 'engine': engine, 'estimator': estimator,
+                          'n_features': n_features, 'train_seconds': list(train_seconds.values())})
+    times.to_csv(path, sep='\t', index=False)
+    return times
+
+def binary_relevance_model(feature_table, metadata, precvd_metadata, disease_targets, n_workers=1, threads_per_worker=1, engine='qiime',
+                           estimator_params=None, estimator='gradient_boosting', prefilter=None):
     """Create machine learning models for all disease targets
 
     Args:
         feature_table (FeatureTable[Frequency]): Feature table containing all features that will be used to create model
         metadata (Metadata): Metadata containing data about disease targets
+        precvd_metadata (Metadata): Balanced PreCVD metadata
         disease_targets (List): List of disease targets
+        n_workers (Int, optional): Number of processes training disease classifiers concurrently. Defaults to 1.
+        threads_per_worker (Int, optional): Number of threads each classifier may use. Defaults to 1.
+        engine (String, optional): 'qiime' runs classify_samples per disease, 'shared' fits all diseases on one
+            shared feature matrix and split (see binary_relevance.binary_relevance_shared). Defaults to 'qiime'.
+        estimator_params (Dict, optional): Estimator parameters keyed by disease, used by the 'shared' engine
+            (see tuning.tune_binary_relevance). Defaults to None.
+        estimator (String, optional): Estimator backend of the 'shared' engine, 'gradient_boosting' or the
+            multi-threaded 'hist_gradient_boosting'. The 'qiime' engine only runs 'gradient_boosting'. Defaults to 'gradient_boosting'.
+        prefilter (Dict, optional): min_prevalence and min_variance of the features kept before fitting
+            (see make_dataset.prefilter_features). Defaults to None, every feature.
 
     Returns:
         Dict: Dictionary of model results by disease type: {'disease_col': Qiime results}
     """
+    if engine == 'qiime' and estimator != 'gradient_boosting':
+        raise ValueError('The qiime engine only trains gradient_boosting, use the shared engine for ' + estimator)
+    disease_cols = disease_columns(metadata, precvd_metadata, disease_targets)
+
+    if engine == 'shared' or prefilter:
+        matrix = make_dataset.feature_table_matrix(feature_table)
+        if prefilter:
+            n_features = len(matrix.feature_ids)
+            matrix = make_dataset.prefilter_features(matrix, **prefilter)
+            print('Prefilter kept %d of %d features' % (len(matrix.feature_ids), n_features))
+            if engine != 'shared':
+                feature_table = make_dataset.feature_matrix_to_table(matrix)
+        if engine == 'shared':
+            feature_table = matrix
+        n_features = len(matrix.feature_ids)
+    else:
+        # classify_samples reads the artifact itself, only its width is needed
+        n_features = make_dataset.feature_table_biom_view(feature_table).shape[0]
+
+    train_seconds = {}
+    if engine == 'shared':
+        results = binary_relevance.binary_relevance_shared(feature_table, disease_cols, n_jobs=n_workers * threads_per_worker,
+                                                           estimator_params=estimator_params, estimator=estimator)
+        save_estimators(results)
+        save_training_times({d: r.fit_seconds for d, r in results.items()}, engine, estimator, n_features)
+        return results
+
     results = {}
-    # Iterate through every disease
-    for disease_name in disease_targets:
-        if disease_name == 'precvd_v2':
-            disease_col = precvd_metadata.get_column('precvd_v2')
-        else:
-            disease_col = metadata.get_column(disease_name) 
-        qiime_model = sample_classifier_single_disease(feature_table, disease_col)
-        results[disease_name] = qiime_model
+    if n_workers <= 1:
+        # Iterate through every disease
+        for disease_name in disease_targets:
+            start = time.perf_counter()
+            results[disease_name] = sample_classifier_single_disease(feature_table, disease_cols[disease_name], threads_per_worker)
+            train_seconds[disease_name] = time.perf_counter() - start
+        save_estimators(results)
+        save_training_times(train_seconds, engine, estimator, n_features)
+        return results
+
+    # Workers load the table from disk rather than receiving a pickled artifact
+    table_path = feature_table.save('data/temp/binary_relevance_table')
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_limit_worker_threads, initargs=(threads_per_worker,)) as executor:
+        futures = {disease_name: executor.submit(_train_disease_worker, table_path,
+                                                 disease_cols[disease_name].to_series(), disease_name,
+                                                 'data/temp/models/' + disease_name, threads_per_worker)
+                   for disease_name in disease_targets}
+        # Collect and save accuracy results in disease_targets order
+        for disease_name in disease_targets:
+            train_seconds[disease_name], saved_outputs = futures[disease_name].result()
+            results[disease_name] = _load_results(saved_outputs)
+            results[disease_name].accuracy_results.save('data/out/accuracy_results_'+disease_name)
+    save_estimators(results)
+    save_training_times(train_seconds, engine, estimator, n_features)
+    return results
+
+def multi_label_model(feature_table, metadata, disease_targets, modes=(), estimators=None, prefilter=None, compare=False):
+    """Fit all disease targets at once with the multi-label engines (see multi_label.multi_label_shared)
+
+    Labels come from metadata for every disease, precvd_v2 included: the multi-label models need samples
+    labeled for all diseases, which the balanced PreCVD subset would mostly remove.
+
+    Args:
+        feature_table (FeatureTable[Frequency]): Feature table containing all features that will be used to create model
+        metadata (Metadata): Metadata containing data about disease targets
+        disease_targets (List): List of disease targets
+        modes (List, optional): 'chain' and/or 'joint'. Defaults to (), no model.
+        estimators (Dict, optional): Estimator backend keyed by mode. Defaults to None.
+        prefilter (Dict, optional): min_prevalence and min_variance of the features kept before fitting. Defaults to None.
+        compare (Boolean, optional): Also time separate per-label fits of the same estimators. Defaults to False.
+
+    Returns:
+        Dict: MultiLabelResult keyed by mode
+    """
+    if not modes:
+        return {}
+    matrix = make_dataset.feature_table_matrix(feature_table)
+    if prefilter:
+        matrix = make_dataset.prefilter_features(matrix, **prefilter)
+    targets = {disease_name: metadata.get_column(disease_name) for disease_name in disease_targets}
+    results = multi_label.multi_label_shared(matrix, targets, modes, estimators, compare=compare)
+    multi_label.timing_summary(results).to_csv('data/out/multi_label_timing.tsv', sep='\t', index=False)
     return results
-    
\ No newline at end of file
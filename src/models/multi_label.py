@@ -0,0 +1,148 @@
+from collections import namedtuple
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn.base import clone
+from sklearn.multioutput import ClassifierChain
+
+from src.models import binary_relevance
+
+MultiLabelResult = namedtuple('MultiLabelResult', ['model', 'predictions', 'probabilities', 'test_targets', 'feature_ids',
+                                                   'estimator', 'fit_seconds', 'separate_fit_seconds'])
+
+MODES = ['chain', 'joint']
+# Estimator backends fitting every label in a single multi-output model
+MULTI_OUTPUT_ESTIMATORS = ['random_forest']
+
+# Disease labels of the organized metadata ('T'/'F', see build_features.disease_metadata_to_tf) and of booleans or 1/0
+LABEL_VALUES = {'T': 1, 'F': 0, 'True': 1, 'False': 0, '1': 1, '0': 0, '1.0': 1, '0.0': 0}
+
+def label_matrix(targets, sample_ids):
+    """Binary samples x diseases label matrix
+
+    Args:
+        targets (Dict): Disease target Series (or MetadataColumns) of T/F values keyed by disease column name
+        sample_ids (Index): Rows of the label matrix
+
+    Returns:
+        DataFrame: 1/0 labels, NaN for unlabeled samples
+    """
+    labels = {}
+    for disease_name, target in targets.items():
+        if not isinstance(target, pd.Series):
+            target = target.to_series()
+        target = target.reindex(sample_ids)
+        labels[disease_name] = target.astype(str).map(LABEL_VALUES).where(target.notna())
+    return pd.DataFrame(labels, index=sample_ids)
+
+def _positive_proba(proba, classes):
+    """Probability of label 1 from a predict_proba output, 0 when the label was never positive in training"""
+    classes = list(classes)
+    return proba[:, classes.index(1)] if 1 in classes else np.zeros(proba.shape[0])
+
+def fit_multi_label(X, Y, is_test, mode='chain', estimator='gradient_boosting', random_state=100, compare=False):
+    """Fit every disease label in one pass over the shared feature matrix
+
+    'chain' fits a classifier chain: each label's classifier also sees the labels before it, so correlated
+    diseases inform each other. 'joint' fits one multi-output estimator (MULTI_OUTPUT_ESTIMATORS) whose trees
+    are shared by all labels. Only samples labeled for every disease are used.
+
+    Args:
+        X (csr_matrix): Sample x feature matrix
+        Y (DataFrame): Label matrix aligned to the rows of X, see label_matrix
+        is_test (Array): Boolean array marking test samples
+        mode (String, optional): 'chain' or 'joint'. Defaults to 'chain'.
+        estimator (String, optional): Estimator backend, a key of binary_relevance.ESTIMATORS. Defaults to 'gradient_boosting'.
+        random_state (Int, optional): Seed of the estimators and the chain order. Defaults to 100.
+        compare (Boolean, optional): Also time one separate fit of the estimator per label. Defaults to False.
+
+    Returns:
+        MultiLabelResult: Fitted model, test predictions and probabilities (samples x diseases), test targets,
+            estimator backend and fit seconds of the multi-label model and of the separate fits (None unless compare)
+    """
+    if mode not in MODES:
+        raise ValueError('Unknown multi-label mode: ' + mode)
+    if mode == 'joint' and estimator not in MULTI_OUTPUT_ESTIMATORS:
+        raise ValueError('The joint mode needs a multi-output estimator: ' + ', '.join(MULTI_OUTPUT_ESTIMATORS))
+    base = binary_relevance.make_estimator(estimator, random_state)
+    if binary_relevance.needs_dense(base):
+        X = X.toarray().astype(np.float32)
+
+    complete = Y.notna().all(axis=1).values
+    train = complete & ~is_test
+    test = complete & is_test
+    if not train.any() or not test.any():
+        raise ValueError('Multi-label models need training and test samples labeled for every disease, found %d and %d'
+                         % (train.sum(), test.sum()))
+    Y_train = Y.values[train].astype(int)
+
+    start = time.perf_counter()
+    model = ClassifierChain(base, random_state=random_state) if mode == 'chain' else clone(base)
+    model.fit(X[train], Y_train)
+    fit_seconds = time.perf_counter() - start
+
+    if mode == 'chain':
+        probabilities = model.predict_proba(X[test])
+    else:
+        probabilities = np.column_stack([_positive_proba(p, c) for p, c in zip(model.predict_proba(X[test]), model.classes_)])
+    test_ids = Y.index[test]
+    predictions = pd.DataFrame(model.predict(X[test]).astype(int), index=test_ids, columns=Y.columns)
+    probabilities = pd.DataFrame(probabilities, index=test_ids, columns=Y.columns)
+
+    separate_fit_seconds = None
+    if compare:
+        # Binary relevance baseline: the same estimator fitted once per label
+        start = time.perf_counter()
+        for j in range(Y_train.shape[1]):
+            clone(base).fit(X[train], Y_train[:, j])
+        separate_fit_seconds = time.perf_counter() - start
+    return MultiLabelResult(model, predictions, probabilities, Y[test].astype(int), None, estimator,
+                            fit_seconds, separate_fit_seconds)
+
+def multi_label_shared(feature_table, targets, modes=('chain',), estimators=None, test_size=0.3, random_state=100, compare=False):
+    """Fit the multi-label models of every mode on one shared feature matrix and split
+
+    Args:
+        feature_table (FeatureTable[Frequency] or FeatureMatrix): Feature table used to create the models
+        targets (Dict): Disease target Series (or MetadataColumns) keyed by disease column name
+        modes (List, optional): Multi-label modes. Defaults to ('chain',).
+        estimators (Dict, optional): Estimator backend keyed by mode. Defaults to None, gradient_boosting for
+            'chain' and random_forest for 'joint'.
+        test_size (Float, optional): Fraction of samples held out for testing. Defaults to 0.3.
+        random_state (Int, optional): Seed of the split and the estimators. Defaults to 100.
+        compare (Boolean, optional): Also time separate per-label fits. Defaults to False.
+
+    Returns:
+        Dict: MultiLabelResult keyed by mode
+    """
+    estimators = dict({'chain': 'gradient_boosting', 'joint': 'random_forest'}, **(estimators or {}))
+    X, sample_ids, feature_ids = binary_relevance.feature_matrix(feature_table)
+    # Split of binary_relevance_shared, stratified on the rarest disease of these targets
+    is_test, _ = binary_relevance.shared_split(len(sample_ids), test_size, random_state=random_state,
+                                               strata=binary_relevance.rarest_label(targets, sample_ids))
+    Y = label_matrix(targets, sample_ids)
+
+    results = {}
+    for mode in modes:
+        print('Multi-label: %s (%s)' % (mode, estimators[mode]))
+        results[mode] = fit_multi_label(X, Y, is_test, mode, estimators[mode], random_state,
+                                        compare)._replace(feature_ids=feature_ids)
+    return results
+
+def timing_summary(results):
+    """Wall-clock time of every multi-label model against separate per-label fits
+
+    Args:
+        results (Dict): MultiLabelResult keyed by mode
+
+    Returns:
+        DataFrame: Fit seconds, separate fit seconds and speedup per mode
+    """
+    rows = []
+    for mode, result in results.items():
+        separate = result.separate_fit_seconds
+        rows.append({'mode': mode, 'estimator': result.estimator, 'n_labels': result.test_targets.shape[1],
+                     'fit_seconds': result.fit_seconds, 'separate_fit_seconds': separate,
+                     'speedup': separate / result.fit_seconds if separate is not None else None})
+    return pd.DataFrame(rows)
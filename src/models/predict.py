@@ -0,0 +1,114 @@
+import os
+import pickle
+import threading
+
+import numpy as np
+import pandas as pd
+
+from src.data import make_dataset
+from src.models import binary_relevance
+
+# Classifiers loaded by load_classifiers, reused across calls
+_LOADED = {}
+_LOAD_LOCK = threading.Lock()
+
+class DiseaseClassifiers:
+    """Trained disease classifiers scoring feature tables in batches
+
+    Args:
+        models (Dict): {'estimator', 'feature_ids'} saved by make_models.save_estimators, keyed by disease
+    """
+    def __init__(self, models):
+        self.diseases = list(models)
+        self.estimators = {d: models[d]['estimator'] for d in self.diseases}
+        self.feature_ids = {d: pd.Index(models[d]['feature_ids']) for d in self.diseases}
+        # Diseases trained on the same features share the aligned input matrix
+        self._feature_sets = {}
+        for d in self.diseases:
+            self._feature_sets.setdefault(tuple(self.feature_ids[d]), []).append(d)
+
+    @staticmethod
+    def positive_class(classes):
+        """Index of the positive class among the estimator classes ('T' as in the organized metadata, 'True', True or 1, else the last class)"""
+        labels = [str(c) for c in classes]
+        for positive in ['T', 'True', '1', '1.0']:
+            if positive in labels:
+                return labels.index(positive)
+        return len(classes) - 1
+
+    def predict_proba(self, feature_table, chunk_size=10000):
+        """Probability of every disease for every sample
+
+        Args:
+            feature_table (FeatureTable[Frequency] or FeatureMatrix): Samples to score
+            chunk_size (Int, optional): Number of samples scored at a time. Defaults to 10000.
+
+        Returns:
+            DataFrame: Samples x diseases probability matrix
+        """
+        if not isinstance(feature_table, make_dataset.FeatureMatrix):
+            feature_table = make_dataset.feature_table_matrix(feature_table)
+        sample_ids = feature_table.sample_ids
+
+        probabilities = np.empty((len(sample_ids), len(self.diseases)))
+        for features, diseases in self._feature_sets.items():
+            # Columns in training feature order, unseen features are dropped and missing ones are zero
+            aligned = make_dataset.align_features(feature_table, features).matrix
+            for start in range(0, aligned.shape[0], chunk_size):
+                chunk = aligned[start:start + chunk_size]
+                dense_chunk = None
+                for d in diseases:
+                    estimator = self.estimators[d]
+                    if binary_relevance.needs_dense(estimator):
+                        if dense_chunk is None:
+                            dense_chunk = chunk.toarray().astype(np.float32)
+                        proba = estimator.predict_proba(dense_chunk)
+                    else:
+                        proba = estimator.predict_proba(chunk)
+                    probabilities[start:start + chunk_size, self.diseases.index(d)] = \
+                        proba[:, self.positive_class(list(estimator.classes_))]
+        return pd.DataFrame(probabilities, index=sample_ids, columns=self.diseases)
+
+    def predict(self, feature_table, threshold=0.5, chunk_size=10000):
+        """Multi-label disease predictions, True where the disease probability reaches threshold
+
+        Returns:
+            DataFrame: Samples x diseases boolean matrix
+        """
+        return self.predict_proba(feature_table, chunk_size) >= threshold
+
+def load_classifiers(model_dir='data/out/models', disease_targets=None):
+    """Load the saved disease classifiers once per directory
+
+    Args:
+        model_dir (String, optional): Directory of the <disease>.pkl files. Defaults to 'data/out/models'.
+        disease_targets (List, optional): Diseases to load, in column order. Defaults to None, every saved disease.
+
+    Returns:
+        DiseaseClassifiers: Loaded classifiers, shared by later calls with the same arguments
+    """
+    if disease_targets is None:
+        disease_targets = sorted(f[:-len('.pkl')] for f in os.listdir(model_dir) if f.endswith('.pkl'))
+    key = (os.path.abspath(model_dir), tuple(disease_targets))
+    with _LOAD_LOCK:
+        if key not in _LOADED:
+            models = {}
+            for disease_name in disease_targets:
+                with open(os.path.join(model_dir, disease_name + '.pkl'), 'rb') as fh:
+                    models[disease_name] = pickle.load(fh)
+            _LOADED[key] = DiseaseClassifiers(models)
+        return _LOADED[key]
+
+def predict_diseases(feature_table, model_dir='data/out/models', disease_targets=None, chunk_size=10000):
+    """Score a feature table with the saved disease classifiers
+
+    Args:
+        feature_table (FeatureTable[Frequency] or FeatureMatrix): Samples to score
+        model_dir (String, optional): Directory of the saved classifiers. Defaults to 'data/out/models'.
+        disease_targets (List, optional): Diseases to score. Defaults to None, every saved disease.
+        chunk_size (Int, optional): Number of samples scored at a time. Defaults to 10000.
+
+    Returns:
+        DataFrame: Samples x diseases probability matrix
+    """
+    return load_classifiers(model_dir, disease_targets).predict_proba(feature_table, chunk_size)
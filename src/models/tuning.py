@@ -0,0 +1,154 @@
+import json
+import os
+import time
+
+from joblib import Parallel, delayed
+import numpy as np
+import pandas as pd
+from sklearn.ensemble import GradientBoostingClassifier
+from sklearn.model_selection import ParameterSampler
+
+from src.models import binary_relevance
+
+def _fit_fold(model, X, y, test_mask, n_estimators):
+    """Grow a warm-started estimator of one fold to n_estimators boosting stages and score it on the fold"""
+    start = time.perf_counter()
+    model.set_params(n_estimators=n_estimators)
+    model.fit(X[~test_mask], y[~test_mask])
+    seconds = time.perf_counter() - start
+    return model, model.score(X[test_mask], y[test_mask]), seconds
+
+def successive_halving(X, target, folds, candidates, min_estimators=10, max_estimators=270, factor=3,
+                       random_state=100, n_jobs=1):
+    """Successive halving search of boosting hyperparameters with n_estimators as the resource
+
+    Every candidate starts with min_estimators boosting stages on every fold; after each rung the best
+    1/factor candidates (mean fold accuracy) survive and grow factor times more stages. Estimators are
+    warm-started, so a survivor only fits the stages it adds rather than starting over.
+
+    Args:
+        X (csr_matrix): Sample x feature matrix
+        target (Series): Target values aligned to the rows of X, NaN for unlabeled samples
+        folds (Array): Cross validation fold id of every sample, -1 for held out test samples
+        candidates (List): GradientBoostingClassifier parameter dicts
+        min_estimators (Int, optional): Boosting stages of the first rung. Defaults to 10.
+        max_estimators (Int, optional): Boosting stages of the last rung. Defaults to 270.
+        factor (Int, optional): Candidates kept and stages added per rung. Defaults to 3.
+        random_state (Int, optional): Seed of the estimators. Defaults to 100.
+        n_jobs (Int, optional): Number of fold fits run in parallel. Defaults to 1.
+
+    Returns:
+        DataFrame: One row per candidate and rung it reached (candidate, params, rung, n_estimators, mean and
+            std fold accuracy, fit seconds)
+    """
+    labeled = target.notna().values & (folds >= 0)
+    X, y, folds = X[labeled], target.values[labeled], folds[labeled]
+    fold_ids = np.unique(folds)
+    models = {i: [GradientBoostingClassifier(warm_start=True, random_state=random_state, **params) for _ in fold_ids]
+              for i, params in enumerate(candidates)}
+
+    alive = list(range(len(candidates)))
+    n_estimators = min_estimators
+    rows = []
+    rung = 0
+    with Parallel(n_jobs=n_jobs) as parallel:
+        while True:
+            jobs = [(i, k) for i in alive for k in range(len(fold_ids))]
+            fitted = parallel(delayed(_fit_fold)(models[i][k], X, y, folds == fold_ids[k], n_estimators) for i, k in jobs)
+            scores = {i: [] for i in alive}
+            seconds = {i: 0.0 for i in alive}
+            for (i, k), (model, score, fit_seconds) in zip(jobs, fitted):
+                models[i][k] = model
+                scores[i].append(score)
+                seconds[i] += fit_seconds
+            for i in alive:
+                rows.append({'candidate': i, 'params': json.dumps(candidates[i], sort_keys=True), 'rung': rung,
+                             'n_estimators': n_estimators, 'mean_score': np.mean(scores[i]),
+                             'std_score': np.std(scores[i]), 'fit_seconds': seconds[i]})
+            if len(alive) <= 1 or n_estimators >= max_estimators:
+                break
+            # Survivors of the rung, the others' estimators are released
+            ranked = sorted(alive, key=lambda i: np.mean(scores[i]), reverse=True)
+            alive = ranked[:max(1, len(alive) // factor)]
+            for i in ranked[len(alive):]:
+                del models[i]
+            n_estimators = min(n_estimators * factor, max_estimators)
+            rung += 1
+    return pd.DataFrame(rows)
+
+def leaderboard(history):
+    """Rank candidates by the last rung they reached, then by mean fold accuracy on it
+
+    Args:
+        history (DataFrame): Rows of successive_halving, optionally with a disease column
+
+    Returns:
+        DataFrame: Last row of every candidate with its rank
+    """
+    keys = ['disease', 'candidate'] if 'disease' in history else ['candidate']
+    history = history.assign(total_fit_seconds=history.groupby(keys)['fit_seconds'].transform('sum'))
+    final = history.sort_values('rung').groupby(keys, sort=False).tail(1)
+    groups = ['disease'] if 'disease' in history else []
+    final = final.sort_values(groups + ['rung', 'mean_score'], ascending=[True] * len(groups) + [False, False])
+    if groups:
+        final.insert(0, 'disease', final.pop('disease'))
+    final.insert(len(groups), 'rank', final.groupby(groups).cumcount() + 1 if groups else np.arange(1, len(final) + 1))
+    return final.drop(columns='fit_seconds').reset_index(drop=True)
+
+def tune_binary_relevance(feature_table, targets, param_distributions, n_candidates=27, min_estimators=10,
+                          max_estimators=270, factor=3, test_size=0.3, cv=10, random_state=100, n_jobs=1,
+                          leaderboard_path='data/out/tuning_leaderboard.tsv',
+                          best_params_path='data/out/tuning_best_params.json'):
+    """Tune the boosting hyperparameters of every disease with successive halving on shared folds
+
+    The test samples and cross validation folds are those of binary_relevance.binary_relevance_shared, computed
+    once and shared by all diseases; the same sampled candidates are searched for every disease.
+
+    Args:
+        feature_table (FeatureTable[Frequency] or FeatureMatrix): Feature table used to create the models
+        targets (Dict): Disease target Series (or MetadataColumns) keyed by disease column name
+        param_distributions (Dict): Values sampled for every GradientBoostingClassifier parameter
+        n_candidates (Int, optional): Number of sampled parameter sets. Defaults to 27.
+        min_estimators (Int, optional): Boosting stages of the first rung. Defaults to 10.
+        max_estimators (Int, optional): Boosting stages of the last rung. Defaults to 270.
+        factor (Int, optional): Candidates kept and stages added per rung. Defaults to 3.
+        test_size (Float, optional): Fraction of samples held out for testing. Defaults to 0.3.
+        cv (Int, optional): Number of cross validation folds. Defaults to 10.
+        random_state (Int, optional): Seed of the split, the candidates and the estimators. Defaults to 100.
+        n_jobs (Int, optional): Number of fold fits run in parallel. Defaults to 1.
+        leaderboard_path (String, optional): Output leaderboard. Defaults to 'data/out/tuning_leaderboard.tsv'.
+        best_params_path (String, optional): Output best parameters by disease, in the format of the
+            estimator_params of model-params.json. Defaults to 'data/out/tuning_best_params.json'.
+
+    Returns:
+        DataFrame: Leaderboard of every disease
+    """
+    X, sample_ids, _ = binary_relevance.feature_matrix(feature_table)
+    _, folds = binary_relevance.shared_split(len(sample_ids), test_size, cv, random_state,
+                                             binary_relevance.rarest_label(targets, sample_ids))
+    candidates = list(ParameterSampler(param_distributions, n_candidates, random_state=random_state))
+
+    histories = []
+    for disease_name, target in targets.items():
+        if not isinstance(target, pd.Series):
+            target = target.to_series()
+        print('Tuning: ' + disease_name)
+        history = successive_halving(X, target.reindex(sample_ids), folds, candidates, min_estimators,
+                                     max_estimators, factor, random_state, n_jobs)
+        histories.append(history.assign(disease=disease_name))
+    history = pd.concat(histories, ignore_index=True)
+    board = leaderboard(history)
+
+    os.makedirs(os.path.dirname(leaderboard_path) or '.', exist_ok=True)
+    board.to_csv(leaderboard_path, sep='\t', index=False)
+    best = board[board['rank'] == 1]
+    with open(best_params_path, 'w') as fh:
+        json.dump({row.disease: dict(json.loads(row.params), n_estimators=int(row.n_estimators))
+                   for row in best.itertuples()}, fh, indent=4)
+
+    # Boosting stages fitted, against every candidate grown to max_estimators on every fold
+    fitted_stages = history.groupby(['disease', 'candidate'])['n_estimators'].max().sum() * cv
+    exhaustive_stages = len(candidates) * len(targets) * cv * max_estimators
+    print('Tuning fitted %d boosting stages, %.1f%% of the exhaustive search of the same candidates'
+          % (fitted_stages, 100 * fitted_stages / exhaustive_stages))
+    return board
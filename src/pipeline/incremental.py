@@ -0,0 +1,83 @@
+import os
+
+import pandas as pd
+
+from src.data import make_dataset
+from src.features import build_features, metrics_analysis
+from src.visualizations import dimensionality_analysis
+
+def ingest_batch(results, new_table, file_paths, feature_params, dim_analysis_params,
+                 umap_model_path='data/temp/umap/umap_model.pkl', out_dir='data/temp/incremental'):
+    """Add a batch of samples to the outputs of a full run without recomputing them
+
+    Only the new samples are processed: their metadata rows are read and organized, their counts are restricted
+    to the features kept by the full run and rarefied, their distances to every sample are computed and appended
+    to each distance matrix, and they are projected into the existing PCoA and UMAP embeddings. Features are only
+    reselected, and the embeddings refitted, by the next full run.
+
+    Args:
+        results (Dict): Values of the 'all' stage graph (feature_table, organized metadata, filtered and rarefied
+            tables, tree_artifact, distance_matrices, pcoa_results)
+        new_table (FeatureTable[Frequency]): Feature table of the new batch
+        file_paths (Dict): Data parameters (metadata path and chunk size)
+        feature_params (Dict): Feature parameters
+        dim_analysis_params (Dict): Dimensionality analysis parameters
+        umap_model_path (String, optional): UMAP model saved by umap_plot_supervised. Defaults to 'data/temp/umap/umap_model.pkl'.
+        out_dir (String, optional): Directory of the extended compact distance matrices. Defaults to 'data/temp/incremental'.
+
+    Returns:
+        Dict: Updated values (feature_table, organized_metadata, organized_metadata_tf, filtered_table, rarefied_table,
+            distance_matrices, pcoa_results) and umap_embedding_new, the UMAP coordinates of the new samples
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    new_matrix = make_dataset.feature_table_matrix(new_table)
+    current = set(results['sample_ids'])
+    new_ids = [x for x in new_matrix.sample_ids if x not in current]
+    if not new_ids:
+        print('No new samples to ingest')
+        return {}
+    new_matrix = make_dataset.FeatureMatrix(new_matrix.matrix[new_matrix.sample_ids.get_indexer(new_ids)],
+                                            pd.Index(new_ids, name='SampleID'), new_matrix.feature_ids)
+    print('Ingesting %d new samples' % len(new_ids))
+    updated = {'sample_ids': list(results['sample_ids']) + new_ids,
+               'feature_table': make_dataset.merge_feature_tables(results['feature_table'],
+                                                                  make_dataset.feature_matrix_to_table(new_matrix))}
+
+    # Metadata rows of the new samples only
+    metadata = make_dataset.read_metadata(file_paths['metadata_path'],
+                                          columns = feature_params['disease_cols'] + feature_params['additional_info_cols'],
+                                          required_cols = feature_params['disease_cols'],
+                                          sample_ids = new_ids, chunksize = file_paths['metadata_chunksize'])
+    organized_new, organized_new_tf = build_features.organize_metadata(metadata, new_ids, persist=False, **feature_params)
+    updated['organized_metadata'] = pd.concat([results['organized_metadata'], organized_new])
+    updated['organized_metadata_tf'] = pd.concat([results['organized_metadata_tf'], organized_new_tf])
+    make_dataset.write_behind(updated['organized_metadata'], 'data/temp/final_metadata.tsv')
+    make_dataset.write_behind(updated['organized_metadata_tf'], 'data/temp/final_metadata_tf.tsv')
+
+    # New samples with metadata, on the features of the filtered table, rarefied to the same depth
+    filtered_features = make_dataset.feature_table_matrix(results['filtered_table']).feature_ids
+    kept = [x for x in new_ids if x in organized_new_tf.index]
+    filtered_new = make_dataset.align_features(new_matrix, filtered_features)
+    filtered_new = make_dataset.FeatureMatrix(filtered_new.matrix[filtered_new.sample_ids.get_indexer(kept)],
+                                              pd.Index(kept, name='SampleID'), filtered_features)
+    updated['filtered_table'] = make_dataset.merge_feature_tables(results['filtered_table'], filtered_new)
+    rarefied_new = make_dataset.rarefy_feature_matrix(filtered_new, dim_analysis_params['rarefy_sampling_depth'])
+    updated['rarefied_table'] = make_dataset.merge_feature_tables(results['rarefied_table'], rarefied_new)
+
+    # New-vs-all distances, appended to every matrix and projected into its PCoA
+    rarefied_matrix = make_dataset.feature_table_matrix(updated['rarefied_table'])
+    rarefied_ids = list(rarefied_new.sample_ids)
+    updated['distance_matrices'], updated['pcoa_results'] = {}, {}
+    for metric, distance_matrix in results['distance_matrices'].items():
+        new_distances = metrics_analysis.sample_distances(rarefied_matrix, rarefied_ids, metric,
+                                                          phylogeny = results['tree_artifact'])
+        updated['distance_matrices'][metric] = metrics_analysis.extend_distance_matrix(
+            distance_matrix, new_distances,
+            os.path.join(out_dir, metric) if isinstance(distance_matrix, metrics_analysis.CondensedDistances) else None)
+        if metric in results['pcoa_results']:
+            updated['pcoa_results'][metric] = metrics_analysis.project_pcoa(results['pcoa_results'][metric],
+                                                                            distance_matrix, new_distances)
+
+    if os.path.exists(umap_model_path):
+        updated['umap_embedding_new'] = dimensionality_analysis.umap_transform(new_matrix, path=umap_model_path)
+    return updated
@@ -0,0 +1,206 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from collections import namedtuple
+import cProfile
+import os
+import threading
+import time
+
+from src.data.stage_cache import function_identity
+
+Stage = namedtuple('Stage', ['name', 'func', 'inputs', 'outputs', 'calls', 'cached', 'side_files', 'resources'])
+
+def stage(name, func, inputs=(), outputs=(), calls=(), cached=False, side_files=(), resources=()):
+    """Declare a pipeline stage
+
+    Args:
+        name (String): Stage name, used by --only/--from and in the timing summary
+        func (Callable): Function called with the stage inputs as keyword arguments
+        inputs (List, optional): Names of the values the stage reads. Defaults to ().
+        outputs (List, optional): Names of the values the stage returns, in return order. Defaults to ().
+        calls (List, optional): Library functions wrapped by func, part of the cache key. Defaults to ().
+        cached (Boolean, optional): Run the stage through the stage cache. Defaults to False.
+        side_files (List or Callable, optional): Files written by the stage, or a function of the stage inputs
+            returning them, restored on cache hits. Defaults to ().
+        resources (List, optional): Shared resources (e.g. 'pyplot') stages must not use concurrently. Defaults to ().
+
+    Returns:
+        Stage: Stage declaration
+    """
+    return Stage(name, func, list(inputs), list(outputs), list(calls), cached, side_files, list(resources))
+
+def producers(stages):
+    """Map every value name to the stage producing it"""
+    produced_by = {}
+    for s in stages:
+        for output in s.outputs:
+            if output in produced_by:
+                raise ValueError(output + ' is produced by both ' + produced_by[output] + ' and ' + s.name)
+            produced_by[output] = s.name
+    return produced_by
+
+def dependencies(stages):
+    """Map every stage name to the names of the stages producing its inputs"""
+    produced_by = producers(stages)
+    return {s.name: sorted({produced_by[x] for x in s.inputs if x in produced_by}) for s in stages}
+
+def select_stages(stages, only=None, start_from=None):
+    """Select the stages to run for --only/--from targets
+
+    --only runs the given stages, --from runs the given stages and everything downstream of them.
+    Upstream stages they depend on always run too (and are reloaded from the stage cache when unchanged).
+
+    Args:
+        stages (List): Declared stages
+        only (List, optional): Stage names. Defaults to None.
+        start_from (List, optional): Stage names. Defaults to None.
+
+    Returns:
+        List: Selected stages in declaration order
+    """
+    if not only and not start_from:
+        return list(stages)
+    names = {s.name for s in stages}
+    unknown = (set(only or []) | set(start_from or [])) - names
+    if unknown:
+        raise ValueError('Unknown stages: ' + ', '.join(sorted(unknown)))
+    deps = dependencies(stages)
+
+    selected = set(only or [])
+    if start_from:
+        dependents = {name: [s for s in deps if name in deps[s]] for name in names}
+        stack = list(start_from)
+        while stack:
+            name = stack.pop()
+            if name not in selected:
+                selected.add(name)
+                stack += dependents[name]
+    stack = list(selected)
+    while stack:
+        for dep in deps[stack.pop()]:
+            if dep not in selected:
+                selected.add(dep)
+                stack.append(dep)
+    return [s for s in stages if s.name in selected]
+
+def run_stage(s, context, cache=None):
+    """Run one stage on the values in context
+
+    Returns:
+        Dict: Stage outputs keyed by name
+    """
+    inputs = {x: context[x] for x in s.inputs}
+    if s.cached and cache is not None:
+        side_files = s.side_files(**inputs) if callable(s.side_files) else s.side_files
+        result = cache.run(s.name, s.func, config=[function_identity(f) for f in s.calls],
+                           side_files=side_files, **inputs)
+    else:
+        result = s.func(**inputs)
+    if len(s.outputs) == 0:
+        return {}
+    if len(s.outputs) == 1:
+        return {s.outputs[0]: result}
+    return dict(zip(s.outputs, result))
+
+def run_pipeline(stages, context, n_workers=1, cache=None, only=None, start_from=None, profile_dir=None):
+    """Run a stage graph, starting every stage as soon as its inputs are available
+
+    Args:
+        stages (List): Declared stages
+        context (Dict): Initial values (configuration) keyed by name
+        n_workers (Int, optional): Number of stages running concurrently. Defaults to 1.
+        cache (StageCache, optional): Cache used by cached stages. Defaults to None.
+        only (List, optional): Stage names to run with their dependencies. Defaults to None.
+        start_from (List, optional): Stage names to run with their dependencies and dependents. Defaults to None.
+        profile_dir (String, optional): Directory receiving a cProfile dump <stage>.prof per stage. Defaults to None.
+
+    Returns:
+        Tuple: (Dict of all values, Dict of {stage name: (start, end)} seconds since the pipeline started)
+    """
+    stages = select_stages(stages, only, start_from)
+    context = dict(context)
+    missing = {x for s in stages for x in s.inputs} - set(producers(stages)) - set(context)
+    if missing:
+        raise ValueError('No stage produces: ' + ', '.join(sorted(missing)))
+
+    locks = {r: threading.Lock() for s in stages for r in s.resources}
+    if profile_dir is not None:
+        os.makedirs(profile_dir, exist_ok=True)
+
+    def execute(s):
+        for r in sorted(s.resources):
+            locks[r].acquire()
+        try:
+            start = time.perf_counter() - origin
+            print('Stage: ' + s.name)
+            if profile_dir is None:
+                outputs = run_stage(s, context, cache)
+            else:
+                # cProfile only follows the calling thread, i.e. this stage
+                profiler = cProfile.Profile()
+                outputs = profiler.runcall(run_stage, s, context, cache)
+                profiler.dump_stats(os.path.join(profile_dir, s.name + '.prof'))
+            return outputs, (start, time.perf_counter() - origin)
+        finally:
+            for r in s.resources:
+                locks[r].release()
+
+    origin = time.perf_counter()
+    timings = {}
+    pending = list(stages)
+    running = {}
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        while pending or running:
+            for s in [s for s in pending if all(x in context for x in s.inputs)]:
+                pending.remove(s)
+                running[executor.submit(execute, s)] = s
+            if not running:
+                raise RuntimeError('Stages cannot run: ' + ', '.join(s.name for s in pending))
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                s = running.pop(future)
+                try:
+                    outputs, timings[s.name] = future.result()
+                except Exception:
+                    for other in running:
+                        other.cancel()
+                    raise
+                context.update(outputs)
+    return context, timings
+
+def critical_path(stages, timings):
+    """Longest chain of dependent stages by duration
+
+    Args:
+        stages (List): Declared stages
+        timings (Dict): {stage name: (start, end)} as returned by run_pipeline
+
+    Returns:
+        Tuple: (List of stage names on the critical path, total duration in seconds)
+    """
+    ran = [s for s in stages if s.name in timings]
+    deps = dependencies(ran)
+    length, previous = {}, {}
+    # A stage ends before any stage depending on it starts, so end time order is topological
+    for s in sorted(ran, key=lambda s: timings[s.name][1]):
+        duration = timings[s.name][1] - timings[s.name][0]
+        best = max(deps[s.name], key=lambda d: length[d], default=None)
+        length[s.name] = duration + (length[best] if best else 0.0)
+        previous[s.name] = best
+    if not length:
+        return [], 0.0
+    name = max(length, key=length.get)
+    total = length[name]
+    path = []
+    while name:
+        path.append(name)
+        name = previous[name]
+    return path[::-1], total
+
+def print_timing_summary(stages, timings):
+    """Print the start, end and duration of every stage and the critical path"""
+    print('%-32s %10s %10s %10s' % ('stage', 'start', 'end', 'seconds'))
+    for name, (start, end) in sorted(timings.items(), key=lambda x: x[1][0]):
+        print('%-32s %10.2f %10.2f %10.2f' % (name, start, end, end - start))
+    path, total = critical_path(stages, timings)
+    wall = max((end for _, end in timings.values()), default=0.0)
+    print('Critical path (%.2f s of %.2f s wall time): %s' % (total, wall, ' -> '.join(path)))
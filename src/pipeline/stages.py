@@ -0,0 +1,205 @@
+import pandas as pd
+
+from src.data import make_dataset
+from src.features import build_features, metrics_analysis
+from src.models import make_models, evaluate_models
+from src.visualizations import make_visualizations, dimensionality_analysis, render_queue
+from src.pipeline.scheduler import stage
+
+def wait_for_side_files(side_files):
+    """Wait until side files queued for writing or rendering are saved, the before_store hook of the stage cache"""
+    make_dataset.flush_writes()
+    render_queue.wait(side_files)
+
+def load_feature_table(file_paths):
+    # Reading feature table as Qiime Artifact and biom table
+    feature_table = make_dataset.read_feature_table(file_paths["feature_table_path"])
+    biom_table = make_dataset.feature_table_biom_view(feature_table)
+    if file_paths.get("columnar_cache"):
+        # Memory-mappable copy for notebooks and ingest, see make_dataset.load_feature_matrix
+        make_dataset.cache_feature_table_behind(feature_table)
+    return feature_table, biom_table.ids()
+
+def load_metadata(file_paths, feature_params, sample_ids):
+    # Reading only the metadata columns and samples used by organize_metadata
+    return make_dataset.read_metadata(file_paths["metadata_path"],
+                                      columns = feature_params['disease_cols'] + feature_params['additional_info_cols'],
+                                      required_cols = feature_params['disease_cols'],
+                                      sample_ids = sample_ids,
+                                      chunksize = file_paths['metadata_chunksize'])
+
+def load_tree(file_paths):
+    return make_dataset.read_tree_table(file_paths['tree_path'])
+
+def organize_metadata(metadata, sample_ids, feature_params):
+    # organized_metadata: 0/1 binary; organized_metadata_tf:T/F binary
+    return build_features.organize_metadata(metadata, sample_ids, **feature_params)
+
+def disease_counts_graph(organized_metadata, feature_params):
+    make_visualizations.disease_counts_graph(organized_metadata, feature_params['disease_cols'])
+
+def qiime_metadata(organized_metadata_tf):
+    # Metadata with True and False booleans and balanced PreCVD classes
+    return (make_dataset.dataframe_to_qiime_metadata(organized_metadata_tf),
+            build_features.balance_precvd(organized_metadata_tf))
+
+def process_table_umap(feature_table, organized_metadata, feature_params):
+    # Samples with 1 target disease type, to remove disease ambiguity and perform supervised UMAP
+    return dimensionality_analysis.process_table_umap(feature_table, organized_metadata, feature_params['disease_cols'])
+
+def umap_plot_supervised(feature_df_target_disease, target_disease_map, target_disease_dict, umap_params):
+    return dimensionality_analysis.umap_plot_supervised(feature_df_target_disease, target_disease_map, target_disease_dict, **umap_params)
+
+def filter_feature_table(feature_table, qiime_metadata_tf, dim_analysis_params):
+    # Minimum number of samples a given feature must be present in
+    if dim_analysis_params['table_engine'] == 'sparse':
+        return make_dataset.filter_feature_matrix(make_dataset.feature_table_matrix(feature_table),
+                                                  dim_analysis_params['filter_min_samples'], qiime_metadata_tf.ids)
+    return make_dataset.filter_feature_table(feature_table, dim_analysis_params['filter_min_samples'], qiime_metadata_tf)
+
+def rarefy_feature_table(filtered_table, dim_analysis_params):
+    if dim_analysis_params['table_engine'] == 'sparse':
+        # Wrapped as an artifact for the qiime beta diversity actions
+        rarefied = make_dataset.rarefy_feature_matrix(filtered_table, dim_analysis_params['rarefy_sampling_depth'])
+        return make_dataset.feature_matrix_to_table(rarefied)
+    return make_dataset.rarefy_feature_table(filtered_table, dim_analysis_params['rarefy_sampling_depth'])
+
+def calculate_distance_matrices(rarefied_table, tree_artifact, dim_analysis_params):
+    return metrics_analysis.calculate_distance_matrices(rarefied_table, metrics = dim_analysis_params['metrics'], phylogeny = tree_artifact,
+                                                        n_jobs = dim_analysis_params['n_jobs'],
+                                                        parallel_metrics = dim_analysis_params['parallel_metrics'],
+                                                        compact = dim_analysis_params['compact_distance_matrices'])
+
+def calculate_pcoa(distance_matrices, dim_analysis_params):
+    pcoa_results = metrics_analysis.calculate_pcoa(distance_matrices, dim_analysis_params['pcoa_n_dimensions'],
+                                                   method = dim_analysis_params['pcoa_method'], tol = dim_analysis_params['pcoa_tol'],
+                                                   n_landmarks = dim_analysis_params['pcoa_n_landmarks'])
+    metrics_analysis.pcoa_variance_explained(pcoa_results).to_csv('data/out/pcoa_variance_explained.tsv', sep='\t')
+    return pcoa_results
+
+def plot_pcoa(pcoa_results, qiime_metadata_tf):
+    dimensionality_analysis.plot_pcoa(pcoa_results, qiime_metadata_tf)
+
+def permanova(distance_matrices, qiime_metadata_tf, qiime_metadata_precvd, feature_params, dim_analysis_params):
+    # Permanova Tests - all diseases w/o precvd
+    permanova_results = metrics_analysis.permanova_tests({'u_unifrac': distance_matrices['unweighted_unifrac'], 'w_unifrac': distance_matrices['weighted_unifrac']},
+                                                         qiime_metadata_tf, [x for x in feature_params['disease_cols'] if x != 'precvd_v2'],
+                                                         permutations = dim_analysis_params['permanova_permutations'],
+                                                         render = dim_analysis_params['permanova_render'])
+    permanova_results.to_csv('data/out/permanova_results.tsv', sep='\t', index=False)
+
+    # Permanova Test - balanced precvd, subset of the full cohort distance matrices. Rarefaction removed the samples
+    # under the sampling depth from the matrices, so precvd is balanced again on the samples they hold
+    matrix_ids = list(metrics_analysis.as_distances(distance_matrices[dim_analysis_params['precvd_metrics'][0]]).ids)
+    metadata_tf = qiime_metadata_tf.to_dataframe()
+    precvd = metadata_tf.loc[list(qiime_metadata_precvd.ids), 'precvd_v2']
+    dropped = precvd[~precvd.index.isin(matrix_ids)].value_counts()
+    if dropped.sum() > 0:
+        print('Warning: rarefaction removed %d T and %d F balanced precvd samples, balancing precvd again for PERMANOVA'
+              % (dropped.get('T', 0), dropped.get('F', 0)))
+    qiime_metadata_precvd = build_features.balance_precvd(metadata_tf, matrix_ids, 'data/out/balanced_precvd_samples_permanova.tsv')
+    distance_matrices_precvd = metrics_analysis.subset_distance_matrices(distance_matrices, qiime_metadata_precvd.ids,
+                                                                         dim_analysis_params['precvd_metrics'])
+    permanova_results_precvd = metrics_analysis.permanova_tests({'u_unifrac': distance_matrices_precvd['unweighted_unifrac'], 'w_unifrac': distance_matrices_precvd['weighted_unifrac']},
+                                                                qiime_metadata_precvd, ['precvd_v2'],
+                                                                permutations = dim_analysis_params['permanova_permutations'],
+                                                                render = dim_analysis_params['permanova_render'])
+    for label in ['T', 'F']:
+        permanova_results_precvd['rarefaction_dropped_' + label] = dropped.get(label, 0)
+    permanova_results_precvd.to_csv('data/out/permanova_results_precvd.tsv', sep='\t', index=False)
+    return permanova_results, permanova_results_precvd
+
+def binary_relevance_model(feature_table, qiime_metadata_tf, qiime_metadata_precvd, model_params):
+    # The other sections configure the 'tune' target, the multi_label_model stage and the evaluation
+    return make_models.binary_relevance_model(feature_table, qiime_metadata_tf, qiime_metadata_precvd,
+                                              **{k: v for k, v in model_params.items() if k not in ['tuning', 'multi_label', 'evaluation']})
+
+def binary_relevance_files(model_params, **inputs):
+    # Accuracy visualizations, estimators saved for batch inference and training times
+    return (['data/out/accuracy_results_'+x+'.qzv' for x in model_params['disease_targets']] +
+            ['data/out/models/'+x+'.pkl' for x in model_params['disease_targets']] +
+            ['data/out/training_times.tsv'])
+
+def multi_label_model(feature_table, qiime_metadata_tf, model_params):
+    return make_models.multi_label_model(feature_table, qiime_metadata_tf, model_params['disease_targets'],
+                                         prefilter = model_params['prefilter'], **model_params['multi_label'])
+
+def evaluate_multi_label(multi_label_model, disease_accuracy_scores, model_params):
+    # Per-label and micro/macro scores of every multi-label mode next to the binary relevance accuracy
+    if not multi_label_model:
+        return None
+    scores = {}
+    for mode, result in multi_label_model.items():
+        accuracy_scores, aucs, scores[mode] = evaluate_models.multi_label_scores(result.test_targets, result.predictions,
+                                                                                 result.probabilities, **model_params['evaluation'])
+        make_visualizations.binary_relevance_accuracy_scores_graph_with_auc(accuracy_scores, aucs,
+                                                                            'data/out/performance_metrics_with_auc_'+mode+'.png')
+        scores[mode]['binary_relevance_accuracy'] = pd.Series(disease_accuracy_scores)
+    scores = pd.concat(scores, names=['mode', 'label'])
+    scores.to_csv('data/out/multi_label_scores.tsv', sep='\t')
+    print(scores)
+    print(pd.read_csv('data/out/multi_label_timing.tsv', sep='\t'))
+    return scores
+
+def evaluate_model(binary_relevance_model, model_params):
+    # Model Performance, every score of every disease with bootstrap confidence intervals
+    scores, aucs = evaluate_models.binary_relevance_scores(binary_relevance_model, model_params['disease_targets'],
+                                                           **model_params['evaluation'])
+    scores.to_csv('data/out/model_scores.tsv', sep='\t')
+    disease_accuracy_scores = scores.loc[model_params['disease_targets'], 'accuracy'].to_dict()
+    make_visualizations.binary_relevance_accuracy_scores_graph(disease_accuracy_scores)
+    make_visualizations.binary_relevance_accuracy_scores_graph_with_auc(disease_accuracy_scores, aucs)
+    print(evaluate_models.training_report(disease_accuracy_scores))
+    return disease_accuracy_scores
+
+def all_stages():
+    """Stage graph of the 'all' target
+
+    The UMAP branch, the distance/PCoA/PERMANOVA branch and the classifier branch only share the loaded
+    tables and metadata, so they run concurrently. Stages drawing with pyplot share the 'pyplot' resource.
+
+    Returns:
+        List: Stage declarations
+    """
+    return [
+        stage('load_feature_table', load_feature_table, ['file_paths'], ['feature_table', 'sample_ids']),
+        stage('load_metadata', load_metadata, ['file_paths', 'feature_params', 'sample_ids'], ['metadata']),
+        stage('load_tree', load_tree, ['file_paths'], ['tree_artifact']),
+        stage('organize_metadata', organize_metadata, ['metadata', 'sample_ids', 'feature_params'],
+              ['organized_metadata', 'organized_metadata_tf'], calls=[build_features.organize_metadata], cached=True,
+              side_files=["data/temp/final_metadata.tsv", "data/temp/final_metadata_tf.tsv",
+                          "data/temp/final_metadata.parquet", "data/temp/final_metadata_tf.parquet"]),
+        stage('disease_counts_graph', disease_counts_graph, ['organized_metadata', 'feature_params'], resources=['pyplot']),
+        stage('qiime_metadata', qiime_metadata, ['organized_metadata_tf'], ['qiime_metadata_tf', 'qiime_metadata_precvd']),
+        # UMAP branch
+        stage('process_table_umap', process_table_umap, ['feature_table', 'organized_metadata', 'feature_params'],
+              ['feature_df_target_disease', 'target_disease_map', 'target_disease_dict'],
+              calls=[dimensionality_analysis.process_table_umap], cached=True, side_files=["data/temp/target_disease.tsv", "data/temp/target_disease.parquet"]),
+        stage('umap_plot_supervised', umap_plot_supervised,
+              ['feature_df_target_disease', 'target_disease_map', 'target_disease_dict', 'umap_params'], ['umap_embedding'],
+              calls=[dimensionality_analysis.umap_plot_supervised], cached=True,
+              side_files=["data/out/umap_supervised.png", "data/temp/umap/umap_model.pkl"], resources=['pyplot']),
+        # Distance, PCoA and PERMANOVA branch
+        stage('filter_feature_table', filter_feature_table, ['feature_table', 'qiime_metadata_tf', 'dim_analysis_params'],
+              ['filtered_table'], calls=[make_dataset.filter_feature_table, make_dataset.filter_feature_matrices], cached=True),
+        stage('rarefy_feature_table', rarefy_feature_table, ['filtered_table', 'dim_analysis_params'], ['rarefied_table'],
+              calls=[make_dataset.rarefy_feature_table, make_dataset.rarefy_feature_matrix], cached=True),
+        stage('calculate_distance_matrices', calculate_distance_matrices, ['rarefied_table', 'tree_artifact', 'dim_analysis_params'],
+              ['distance_matrices'], calls=[metrics_analysis.calculate_distance_matrices], cached=True),
+        stage('calculate_pcoa', calculate_pcoa, ['distance_matrices', 'dim_analysis_params'], ['pcoa_results'],
+              calls=[metrics_analysis.calculate_pcoa], cached=True, side_files=['data/out/pcoa_variance_explained.tsv']),
+        stage('plot_pcoa', plot_pcoa, ['pcoa_results', 'qiime_metadata_tf']),
+        stage('permanova', permanova,
+              ['distance_matrices', 'qiime_metadata_tf', 'qiime_metadata_precvd', 'feature_params', 'dim_analysis_params'],
+              ['permanova_results', 'permanova_results_precvd']),
+        # Classifier branch
+        stage('binary_relevance_model', binary_relevance_model,
+              ['feature_table', 'qiime_metadata_tf', 'qiime_metadata_precvd', 'model_params'], ['binary_relevance_model'],
+              calls=[make_models.binary_relevance_model], cached=True, side_files=binary_relevance_files),
+        stage('evaluate_model', evaluate_model, ['binary_relevance_model', 'model_params'], ['disease_accuracy_scores'],
+              resources=['pyplot']),
+        stage('multi_label_model', multi_label_model, ['feature_table', 'qiime_metadata_tf', 'model_params'], ['multi_label_model'],
+              calls=[make_models.multi_label_model], cached=True, side_files=['data/out/multi_label_timing.tsv']),
+        stage('evaluate_multi_label', evaluate_multi_label, ['multi_label_model', 'disease_accuracy_scores', 'model_params'],
+              ['multi_label_scores'], resources=['pyplot']),
+    ]
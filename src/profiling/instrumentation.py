@@ -0,0 +1,147 @@
+import functools
+import inspect
+import json
+import threading
+import time
+
+import psutil
+
+from src.profiling.memory import PeakRSSMonitor
+
+_LOCK = threading.Lock()
+_LOCAL = threading.local()
+_FUNCTIONS = {}
+_CALLS = []
+_ARTIFACT_SHAPES = {}
+_SETTINGS = {'artifact_shapes': False}
+_PROCESS = psutil.Process()
+CPU_TIME = ('process CPU time (user + system) of all threads and of the child processes that exited during the call; '
+            'calls running concurrently in other threads are included')
+
+def configure(artifact_shapes=False):
+    """Configure what instrumented calls record
+
+    Args:
+        artifact_shapes (Boolean, optional): Also record the samples x features of FeatureTable artifacts,
+            which views each artifact once as a biom table. Defaults to False.
+    """
+    _SETTINGS['artifact_shapes'] = artifact_shapes
+
+def describe_size(value):
+    """Size of a function input: [samples, features] for tables, shape for arrays, None if unknown"""
+    if hasattr(value, 'id_count') and hasattr(value, 'column_count'):
+        # qiime2 Metadata
+        return [value.id_count, value.column_count]
+    if hasattr(value, 'uuid') and hasattr(value, 'type'):
+        # qiime2 Artifact, viewed at most once
+        if _SETTINGS['artifact_shapes'] and str(value.type).startswith('FeatureTable'):
+            if value.uuid not in _ARTIFACT_SHAPES:
+                import biom
+                observations, samples = value.view(biom.Table).shape
+                _ARTIFACT_SHAPES[value.uuid] = [samples, observations]
+            return _ARTIFACT_SHAPES[value.uuid]
+        return str(value.type)
+    if type(value).__name__ == 'Table' and type(value).__module__.startswith('biom'):
+        # biom stores observations x samples
+        return [value.shape[1], value.shape[0]]
+    if hasattr(value, 'shape') and not callable(value.shape):
+        return [int(x) for x in value.shape]
+    if hasattr(value, 'ids') and hasattr(value, '__len__'):
+        return [len(value)]
+    return None
+
+def _input_sizes(func, args, kwargs):
+    try:
+        bound = inspect.signature(func).bind_partial(*args, **kwargs)
+    except TypeError:
+        return {}
+    sizes = {}
+    for name, value in bound.arguments.items():
+        size = describe_size(value)
+        if size is not None:
+            sizes[name] = size
+    return sizes
+
+def process_cpu_time():
+    """CPU seconds of the process, its BLAS/OpenMP/joblib threads and its exited (joined) child processes"""
+    times = _PROCESS.cpu_times()
+    return times.user + times.system + times.children_user + times.children_system
+
+def _record(name, wall, cpu, peak_rss, input_sizes, started):
+    with _LOCK:
+        stats = _FUNCTIONS.setdefault(name, {'calls': 0, 'wall_time': 0.0, 'cpu_time': 0.0, 'peak_rss_mb': None})
+        stats['calls'] += 1
+        stats['wall_time'] += wall
+        stats['cpu_time'] += cpu
+        if peak_rss is not None:
+            stats['peak_rss_mb'] = max(stats['peak_rss_mb'] or 0.0, peak_rss / 1024 ** 2)
+        if input_sizes is not None:
+            _CALLS.append({'function': name, 'start': started, 'wall_time': wall, 'cpu_time': cpu,
+                           'peak_rss_mb': peak_rss / 1024 ** 2, 'input_sizes': input_sizes})
+
+def profiled(func, name):
+    """Wrap a function so its calls are recorded
+
+    Every call adds to the wall and process CPU time (see CPU_TIME) of the function. Outermost calls of a thread
+    also record peak RSS and input sizes; nested calls skip them to keep the overhead of small helpers low.
+
+    Args:
+        func (Callable): Function to wrap
+        name (String): Qualified name used in the profile
+
+    Returns:
+        Callable: Wrapped function
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        depth = getattr(_LOCAL, 'depth', 0)
+        _LOCAL.depth = depth + 1
+        monitor = PeakRSSMonitor() if depth == 0 else None
+        input_sizes = _input_sizes(func, args, kwargs) if depth == 0 else None
+        started = time.time()
+        if monitor is not None:
+            monitor.__enter__()
+        wall, cpu = time.perf_counter(), process_cpu_time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            wall, cpu = time.perf_counter() - wall, process_cpu_time() - cpu
+            if monitor is not None:
+                monitor.__exit__(None, None, None)
+            _LOCAL.depth = depth
+            _record(name, wall, cpu, monitor.peak if monitor is not None else None, input_sizes, started)
+    wrapper.__profiled__ = True
+    return wrapper
+
+def instrument_module(module):
+    """Replace every public function defined in module by its profiled version
+
+    Args:
+        module (Module): Module to instrument
+    """
+    for attr, value in list(vars(module).items()):
+        if (inspect.isfunction(value) and not attr.startswith('_') and value.__module__ == module.__name__
+                and not getattr(value, '__profiled__', False)):
+            setattr(module, attr, profiled(value, module.__name__ + '.' + attr))
+
+def instrument_modules(modules):
+    """Instrument several modules
+
+    Args:
+        modules (List): Modules to instrument
+    """
+    for module in modules:
+        instrument_module(module)
+
+def write_profile(path):
+    """Save the recorded calls as JSON
+
+    Args:
+        path (String): Path of the profile file
+    """
+    with _LOCK:
+        profile = {'cpu_time': CPU_TIME,
+                   'functions': dict(sorted(_FUNCTIONS.items(), key=lambda x: -x[1]['wall_time'])),
+                   'calls': sorted(_CALLS, key=lambda x: x['start'])}
+    with open(path, 'w') as fh:
+        json.dump(profile, fh, indent=2)
@@ -0,0 +1,43 @@
+import threading
+
+import psutil
+
+class PeakRSSMonitor:
+    """Context manager recording the peak resident set size of the process while its block runs
+
+    RSS is sampled on a background thread, so the peak is the process peak during the block
+    (including other threads), not only the memory allocated by the block itself.
+
+    Args:
+        interval (Float, optional): Seconds between samples. Defaults to 0.05.
+    """
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._process = psutil.Process()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        while True:
+            self.peak = max(self.peak, self._process.memory_info().rss)
+            if self._stop.wait(self.interval):
+                break
+
+    def __enter__(self):
+        self.peak = self._process.memory_info().rss
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self._process.memory_info().rss)
+        return False
+
+    @property
+    def peak_mb(self):
+        """Peak resident set size in megabytes"""
+        return self.peak / 1024 ** 2
@@ -1,13 +1,19 @@
-from qiime2.plugins.diversity.pipelines import core_metrics_phylogenetic
-from qiime2.plugins.diversity.methods import umap
-from qiime2.plugins.emperor.visualizers import plot
-from qiime2.plugins.feature_table.methods import filter_samples
-from qiime2 import Metadata
+from src.data import make_dataset
+from src.visualizations import render_queue
+
+import hashlib
+import json
+import os
+import pickle
 
-import umap
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
+from scipy import sparse
+from sklearn.utils import check_random_state
+
+# UMAP metrics computed on feature presence only
+PRESENCE_METRICS = ['jaccard', 'dice', 'hamming', 'kulsinski', 'rogerstanimoto', 'russellrao', 'sokalmichener', 'sokalsneath', 'yule']
 
 def plot_pcoa(pcoa_results, metadata):
     """Create PcoA emperor plots
@@ -16,11 +22,19 @@ def plot_pcoa(pcoa_results, metadata):
         pcoa_results (Dict): Dictionary containing pcoa results
         metadata (METADATA): Metadata
     """
+    # Rendered by the render queue processes
+    metadata_df = metadata.to_dataframe()
     for metric in pcoa_results.keys():
         pcoa = pcoa_results[metric]
-        plot(pcoa=pcoa, metadata=metadata).visualization.save('data/out/'+metric+'_pcoa_emp')
+        path = 'data/out/'+metric+'_pcoa_emp.qzv'
+        render_queue.submit(path, _emperor_plot, pcoa, metadata_df, path)
+
+def _emperor_plot(pcoa_path, metadata_df, path):
+    from qiime2 import Artifact, Metadata
+    from qiime2.plugins.emperor.visualizers import plot
+    return plot(pcoa=Artifact.load(pcoa_path), metadata=Metadata(metadata_df)).visualization.save(path)
         
-def process_table_umap(table, metadata_df, disease_cols):
+def process_table_umap(table, metadata_df, disease_cols, persist=True):
     '''
     Process the feature table by mapping disease labels into parameters for the UMAP algorithm
 
@@ -29,10 +43,12 @@ def process_table_umap(table, metadata_df, disease_cols):
     table: feature table
 
     metadata_df: Metadata dataframe
+
+    persist: Save the target disease of each sample to data/temp in the background
     
     Returns
     -------
-    feature_df_target_disease: Feature table in Pandas dataframe format, that has been filtered with the metadata of samples with only 1 target disease
+    feature_df_target_disease: Sparse FeatureMatrix (csr matrix, sample ids, feature ids) of the samples with only 1 target disease, rows aligned with target_disease_mapped
     target_disease_mapped: Metadata information that has been processed to only include the target disease types and sample ID, mapped to the numeric encoding of the disease type (e.g, 1,2,3,4 or 5)
     target_disease_dict: The dictionary of the mapping of target disease
     '''
@@ -44,14 +60,17 @@ def process_table_umap(table, metadata_df, disease_cols):
 
     #Get the target disease and sample name,then create the metadata and filterd feature table
     target_disease = filtered_metadata_df['target_disease']
-    target_disease.to_csv('data/temp/target_disease.tsv', sep="\t")
+    if persist:
+        make_dataset.write_behind(target_disease, 'data/temp/target_disease.tsv')
 
-    metadata_target_disease = Metadata.load("data/temp/target_disease.tsv") 
-    feature_table_target_disease = filter_samples(table, metadata = metadata_target_disease).filtered_table
-
-    #View as a DF to perform cleaning
-    feature_df_target_disease = feature_table_target_disease.view(pd.DataFrame)
-    feature_df_target_disease = feature_df_target_disease[feature_df_target_disease.columns[((feature_df_target_disease > 0).sum() > 3)]] #Dropping features that appear in less than 3 samples
+    #Sparse samples x features matrix of the single disease samples, memory scales with nonzeros
+    feature_matrix = make_dataset.feature_table_matrix(table)
+    rows = feature_matrix.sample_ids.get_indexer(target_disease.index)
+    rows = np.sort(rows[rows >= 0])
+    X = feature_matrix.matrix[rows]
+    keep = X.getnnz(axis=0) > 3 #Dropping features that appear in less than 3 samples
+    feature_df_target_disease = make_dataset.FeatureMatrix(X[:, keep], feature_matrix.sample_ids[rows],
+                                                           feature_matrix.feature_ids[keep])
     
     #Rename disease labels for better readability
     target_disease_renamed = {'abdominal_obesity_ncep_v2': 'Obesity',
@@ -68,16 +87,127 @@ def process_table_umap(table, metadata_df, disease_cols):
         target_disease_dict[target_disease.unique()[i]] = i
 
     #Map the target diseases
-    target_disease_mapped = target_disease.map(target_disease_dict)
+    target_disease_mapped = target_disease.map(target_disease_dict).reindex(feature_df_target_disease.sample_ids)
 
     return feature_df_target_disease, target_disease_mapped, target_disease_dict 
 
 
-def umap_plot_supervised(feature_table, target, target_dict,n_neighbors, n_components, metric):
+def umap_input(feature_table, metric):
+    """Samples x features UMAP input: the sparse matrix of a FeatureMatrix (presence only for set based metrics) or a dataframe"""
+    X = feature_table.matrix if isinstance(feature_table, make_dataset.FeatureMatrix) else feature_table
+    if metric in PRESENCE_METRICS and sparse.issparse(X):
+        #Set based metrics only look at presence, UMAP works on float32 either way
+        X = X.astype(bool).astype(np.float32)
+    return X
+
+def _knn_key(X, n_neighbors, metric, random_state):
+    """Hash of the UMAP input, the nearest neighbor parameters and the umap version"""
+    import umap
+    digest = hashlib.sha256(json.dumps([umap.__version__, list(X.shape), n_neighbors, metric, random_state]).encode())
+    if sparse.issparse(X):
+        X = X.tocsr()
+        parts = [X.indptr, X.indices, X.data]
+    else:
+        parts = [np.asarray(X)]
+    for part in parts:
+        digest.update(str(part.dtype).encode())
+        digest.update(np.ascontiguousarray(part))
+    return digest.hexdigest()
+
+def umap_knn_graph(X, n_neighbors, metric, random_state=10, cache_dir='data/temp/umap'):
+    """Nearest neighbor graph of the UMAP input, saved and reused for the same data, n_neighbors and metric
+
+    Args:
+        X (csr_matrix or DataFrame): Samples x features UMAP input
+        n_neighbors (Int): Number of neighbors
+        metric (String): UMAP metric
+        random_state (Int, optional): Seed of the nearest neighbor descent. Defaults to 10.
+        cache_dir (String, optional): Directory of the saved graphs. Defaults to 'data/temp/umap'.
+
+    Returns:
+        Tuple: (knn indices, knn distances, search index), the precomputed_knn of umap.UMAP
+    """
+    from umap.umap_ import nearest_neighbors
+    path = os.path.join(cache_dir, 'knn_' + _knn_key(X, n_neighbors, metric, random_state) + '.pkl')
+    if os.path.exists(path):
+        with open(path, 'rb') as fh:
+            return pickle.load(fh)
+    knn = nearest_neighbors(X, n_neighbors, metric, {}, False, check_random_state(random_state))
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(path, 'wb') as fh:
+        pickle.dump(knn, fh, protocol=pickle.HIGHEST_PROTOCOL)
+    return knn
+
+def fit_umap(X, target, n_neighbors, n_components, metric, min_dist=0.1, random_state=10, cache_dir='data/temp/umap'):
+    """Fit a supervised UMAP on a saved nearest neighbor graph
+
+    Only the graph depends on n_neighbors and metric, so changing min_dist or n_components re-embeds without
+    searching neighbors again.
+
+    Returns:
+        umap.UMAP: Fitted model, embedding_ holds the training embedding
+    """
+    import umap
+    knn = umap_knn_graph(X, n_neighbors, metric, random_state, cache_dir)
+    return umap.UMAP(n_neighbors=n_neighbors, n_components=n_components, metric=metric, min_dist=min_dist,
+                     random_state=random_state, precomputed_knn=knn).fit(X, y=target)
+
+def save_umap_model(model, feature_ids, path='data/temp/umap/umap_model.pkl'):
+    """Save a fitted UMAP model with the feature ids of its input columns
+
+    Args:
+        model (umap.UMAP): Fitted model
+        feature_ids (Index): Feature id of every input column
+        path (String, optional): Model file. Defaults to 'data/temp/umap/umap_model.pkl'.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as fh:
+        pickle.dump({'model': model, 'feature_ids': list(feature_ids)}, fh, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_umap_model(path='data/temp/umap/umap_model.pkl'):
+    """Load a model saved by save_umap_model
+
+    Returns:
+        Tuple: (umap.UMAP, Index of feature ids)
+    """
+    with open(path, 'rb') as fh:
+        saved = pickle.load(fh)
+    return saved['model'], pd.Index(saved['feature_ids'])
+
+def umap_transform(feature_matrix, model=None, path='data/temp/umap/umap_model.pkl'):
+    """Project new samples into a saved UMAP embedding without refitting
+
+    Columns are aligned to the model features: features the model has not seen are dropped and
+    missing ones are zero.
+
+    Args:
+        feature_matrix (FeatureMatrix): Sparse samples x features of the new samples
+        model (Tuple, optional): (umap.UMAP, feature ids) as returned by load_umap_model. Defaults to None, loaded from path.
+        path (String, optional): Model file. Defaults to 'data/temp/umap/umap_model.pkl'.
+
+    Returns:
+        DataFrame: Embedding of the new samples indexed by sample id
+    """
+    reducer, feature_ids = model if model is not None else load_umap_model(path)
+    embedding = reducer.transform(umap_input(make_dataset.align_features(feature_matrix, feature_ids), reducer.metric))
+    return pd.DataFrame(embedding, index=feature_matrix.sample_ids,
+                        columns=['UMAP' + str(i + 1) for i in range(embedding.shape[1])])
+
+def umap_plot_supervised(feature_table, target, target_dict,n_neighbors, n_components, metric, min_dist=0.1,
+                         model_path='data/temp/umap/umap_model.pkl'):
     '''
     Perform supervised UMAP on the Single Disease samples, returns the embedding and save the matplotlib plot in .png format
+
+    feature_table: FeatureMatrix from process_table_umap (kept sparse) or a samples x features dataframe
+
+    model_path: The fitted model is saved there for umap_transform of new samples
     '''
-    embedding = umap.UMAP(n_neighbors=n_neighbors, n_components= n_components,metric=metric, random_state=10).fit_transform(feature_table, y=target)
+    X = umap_input(feature_table, metric)
+    reducer = fit_umap(X, target, n_neighbors, n_components, metric, min_dist=min_dist,
+                       cache_dir=os.path.dirname(model_path))
+    embedding = reducer.embedding_
+    feature_ids = feature_table.feature_ids if isinstance(feature_table, make_dataset.FeatureMatrix) else feature_table.columns
+    save_umap_model(reducer, feature_ids, model_path)
     fig, ax = plt.subplots(1, figsize=(7, 4))
     plt.scatter(*embedding.T, s=10, c=target, cmap='rainbow', alpha=1.0)
     plt.setp(ax, xticks=[], yticks=[])
@@ -86,7 +216,7 @@ def umap_plot_supervised(feature_table, target, target_dict,n_neighbors, n_compo
     cbar.set_ticklabels(target_dict.keys())
     
     plt.title(
-    "Sample Size: 324",
+    "Sample Size: {}".format(X.shape[0]),
     fontsize=7,
     pad=6.5,
     loc="left",
@@ -99,6 +229,6 @@ def umap_plot_supervised(feature_table, target, target_dict,n_neighbors, n_compo
     y=0.97,
     ha="left",
     )
-    plt.savefig('data/out/umap_supervised.png', dpi=300)
+    render_queue.save_figure(fig, 'data/out/umap_supervised.png', dpi=300)
     return embedding
 
@@ -3,6 +3,8 @@ import matplotlib.pyplot as plt
 import pandas as pd
 import numpy as np
 
+from src.visualizations import render_queue
+
 def create_bar_col_binary(metadata_df, disease_col_name):
     """Create bar graph of outcomes for given disease type
 
@@ -31,7 +33,7 @@ def disease_counts_graph(metadata_df, disease_cols):
     ax.set_title('Disease counts')
     ax.set_xlabel('Disease Type')
     ax.tick_params(axis='x', labelrotation = 0)
-    plt.savefig('data/out/disease_counts.png', bbox_inches='tight',dpi=300)
+    render_queue.save_figure(plt.gcf(), 'data/out/disease_counts.png', bbox_inches='tight', dpi=300)
 
     
 def total_disease_count_graph(metadata_df, disease_cols):
@@ -48,7 +50,7 @@ def total_disease_count_graph(metadata_df, disease_cols):
     ax.tick_params(axis='x', labelrotation = 0)
     ax.set_ylabel('Number of samples')
     ax.set_xlabel('Number of diseases')
-    plt.savefig('data/out/total_disease_counts.png', bbox_inches='tight',dpi=300)
+    render_queue.save_figure(plt.gcf(), 'data/out/total_disease_counts.png', bbox_inches='tight', dpi=300)
     
 def binary_relevance_accuracy_scores_graph(disease_accuracy_scores):
     """Create bar graph of accuracy scores of binary relevance model
@@ -62,15 +64,16 @@ def binary_relevance_accuracy_scores_graph(disease_accuracy_scores):
     ax.set_title('Gradient Boosting Classifier Accuracy Scores')
     ax.set_ylabel('Accuracy Score')
     plt.tight_layout()
-    plt.savefig('data/out/GBC_accuracy_scores.png',bbox_inches='tight',dpi=300)
+    render_queue.save_figure(plt.gcf(), 'data/out/GBC_accuracy_scores.png', bbox_inches='tight', dpi=300)
     
     
-def binary_relevance_accuracy_scores_graph_with_auc(disease_accuracy_scores, aucs):
+def binary_relevance_accuracy_scores_graph_with_auc(disease_accuracy_scores, aucs, path='data/out/performance_metrics_with_auc.png'):
     """Create bar graph of accuracy scores and auc's of binary relevance model.
 
     Args:
         disease_accuracy_scores (Dict): Dictionary containing scores of model accuracy scores by disease type
         aucs (Dict):Dictionary containing micro and macro average aucs. In the following format: {"disease col":[micro auc, macro auc]}.
+        path (String, optional): Output figure. Defaults to 'data/out/performance_metrics_with_auc.png'.
     """
     micro = {}
     macro = {}
@@ -93,4 +96,4 @@ def binary_relevance_accuracy_scores_graph_with_auc(disease_accuracy_scores, auc
     plt.figure(figsize=(19,8))
     plt.xticks(fontsize=12)
     sns.barplot(data=performance_metrics_seaborn, x='Disease Type',y='Percentage',hue='metric_type')
-    plt.savefig('data/out/performance_metrics_with_auc.png',dpi=300,bbox_inches='tight')
+    render_queue.save_figure(plt.gcf(), path, dpi=300, bbox_inches='tight')
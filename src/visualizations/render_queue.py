@@ -0,0 +1,134 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import os
+import pickle
+import threading
+
+# Render settings, see configure
+_SETTINGS = {'mode': 'full', 'n_workers': 2, 'draft_dpi': 72, 'artifact_dir': 'data/temp/render'}
+_POOL = None
+# Pending renders keyed by the file they save
+_PENDING = {}
+_LOCK = threading.Lock()
+
+MODES = ['full', 'draft', 'skip']
+
+def configure(mode='full', n_workers=2, draft_dpi=72, artifact_dir='data/temp/render'):
+    """Set how figures and visualizations are rendered
+
+    Args:
+        mode (String, optional): 'full' renders everything, 'draft' renders matplotlib figures at draft_dpi,
+            'skip' renders nothing (for CI and benchmark runs). Defaults to 'full'.
+        n_workers (Int, optional): Render processes, 0 renders in the calling thread. Defaults to 2.
+        draft_dpi (Int, optional): Maximum figure resolution in 'draft' mode. Defaults to 72.
+        artifact_dir (String, optional): Directory of the artifacts handed to the render processes. Defaults to 'data/temp/render'.
+    """
+    if mode not in MODES:
+        raise ValueError('Unknown render mode: ' + mode)
+    wait()
+    global _POOL
+    with _LOCK:
+        if _POOL is not None and n_workers != _SETTINGS['n_workers']:
+            _POOL.shutdown()
+            _POOL = None
+        _SETTINGS.update(mode=mode, n_workers=n_workers, draft_dpi=draft_dpi, artifact_dir=artifact_dir)
+
+def _init_worker():
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+
+def submit(path, func, *args):
+    """Render in the background: func(*args) saves path
+
+    Args:
+        path (String): File saved by func, used by wait
+        func (Callable): Module level render function (run in another process)
+        *args: Picklable arguments of func, artifacts are passed as the path of their saved .qza (see artifact_path)
+
+    Returns:
+        Future: Render result, None when renders are skipped
+    """
+    if _SETTINGS['mode'] == 'skip':
+        return None
+    from qiime2 import Artifact
+    args = [artifact_path(arg) if isinstance(arg, Artifact) else arg for arg in args]
+    global _POOL
+    with _LOCK:
+        if _SETTINGS['n_workers'] <= 0:
+            future = None
+        else:
+            if _POOL is None:
+                _POOL = ProcessPoolExecutor(max_workers=_SETTINGS['n_workers'],
+                                            mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker)
+            future = _POOL.submit(func, *args)
+            _PENDING[os.path.normpath(path)] = future
+    if future is None:
+        func(*args)
+    return future
+
+def _save_figure(payload, path, dpi, savefig_kwargs):
+    import matplotlib.pyplot as plt
+    fig = pickle.loads(payload)
+    fig.savefig(path, dpi=dpi, **savefig_kwargs)
+    plt.close(fig)
+    return path
+
+def save_figure(fig, path, dpi=300, **savefig_kwargs):
+    """Save a matplotlib figure in the background and close it
+
+    The figure is pickled, so the calling thread only pays for building it, not for rasterizing it.
+
+    Args:
+        fig (Figure): Figure to save
+        path (String): Output file
+        dpi (Int, optional): Resolution, capped at draft_dpi in 'draft' mode. Defaults to 300.
+        **savefig_kwargs: Other Figure.savefig arguments (e.g. bbox_inches)
+
+    Returns:
+        Future: Render result, None when renders are skipped
+    """
+    import matplotlib.pyplot as plt
+    if _SETTINGS['mode'] == 'draft':
+        dpi = min(dpi, _SETTINGS['draft_dpi'])
+    payload = None if _SETTINGS['mode'] == 'skip' else pickle.dumps(fig, protocol=pickle.HIGHEST_PROTOCOL)
+    plt.close(fig)
+    if payload is None:
+        return None
+    return submit(path, _save_figure, payload, path, dpi, savefig_kwargs)
+
+def artifact_path(artifact):
+    """Path of an artifact saved for the render processes, each artifact is only saved once
+
+    Args:
+        artifact (Artifact): Artifact read by a render function
+
+    Returns:
+        String: Path of the saved .qza
+    """
+    path = os.path.join(_SETTINGS['artifact_dir'], str(artifact.uuid) + '.qza')
+    if not os.path.exists(path):
+        os.makedirs(_SETTINGS['artifact_dir'], exist_ok=True)
+        # Stages run concurrently, each thread writes its own temporary file
+        tmp_path = '%s.%d.tmp.qza' % (path, threading.get_ident())
+        artifact.save(tmp_path)
+        os.replace(tmp_path, path)
+    return path
+
+def wait(paths=None):
+    """Wait until renders are saved, re-raising any error they hit
+
+    Args:
+        paths (List, optional): Only wait for the renders of these files. Defaults to None, every render.
+    """
+    with _LOCK:
+        if paths is None:
+            keys = list(_PENDING)
+        else:
+            keys = [k for k in map(os.path.normpath, paths) if k in _PENDING]
+        futures = [(k, _PENDING[k]) for k in keys]
+    for key, future in futures:
+        try:
+            future.result()
+        finally:
+            with _LOCK:
+                if _PENDING.get(key) is future:
+                    del _PENDING[key]
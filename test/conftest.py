@@ -0,0 +1,25 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+# Tests import the pipeline modules as the run.py targets do, from the project root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from src.data import make_dataset
+
+@pytest.fixture
+def synthetic_table():
+    """Sparse FeatureMatrix of 120 samples and 8 features, with T/F disease targets depending on two features"""
+    rng = np.random.default_rng(0)
+    X = rng.poisson(2.0, size=(120, 8)).astype(float)
+    sample_ids = pd.Index(['s%d' % i for i in range(120)], name='SampleID')
+    table = make_dataset.FeatureMatrix(sparse.csr_matrix(X), sample_ids,
+                                       pd.Index(['f%d' % i for i in range(8)], name='FeatureID'))
+    # Organized metadata labels, as written by build_features.disease_metadata_to_tf
+    targets = {'ibd': pd.Series(np.where(X[:, 0] > 2, 'T', 'F'), index=sample_ids),
+               'diabetes': pd.Series(np.where(X[:, 1] > 1, 'T', 'F'), index=sample_ids)}
+    return table, targets
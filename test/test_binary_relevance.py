@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+from src.data import make_dataset
+from src.models import binary_relevance
+
+@pytest.mark.parametrize('name', sorted(binary_relevance.ESTIMATORS))
+def test_make_estimator(name):
+    estimator = binary_relevance.make_estimator(name, random_state=0)
+    assert binary_relevance.needs_dense(estimator) == (name == 'hist_gradient_boosting')
+
+def test_make_estimator_rejects_unknown_names():
+    with pytest.raises(ValueError):
+        binary_relevance.make_estimator('svm')
+
+@pytest.mark.parametrize('estimator', sorted(binary_relevance.ESTIMATORS))
+def test_binary_relevance_shared_estimators(estimator, synthetic_table):
+    table, targets = synthetic_table
+    results = binary_relevance.binary_relevance_shared(table, targets, cv=3, estimator=estimator)
+    for disease_name, result in results.items():
+        predictions = result.predictions.view(pd.Series)
+        test_targets = result.test_targets.view(pd.Series)
+        assert predictions.index.equals(test_targets.index)
+        assert set(predictions) <= {'T', 'F'}
+        assert len(result.cv_scores) == 3
+        assert result.fit_seconds > 0
+
+def test_prefilter_features_drops_rare_and_constant_features():
+    X = np.array([[2, 1, 0, 2],
+                  [4, 0, 0, 4],
+                  [1, 0, 0, 1],
+                  [3, 0, 0, 3]], dtype=float)
+    table = make_dataset.FeatureMatrix(sparse.csr_matrix(X), pd.Index(list('abcd')), pd.Index(['f0', 'f1', 'f2', 'f3']))
+    # Features without any count are always dropped
+    assert list(make_dataset.prefilter_features(table).feature_ids) == ['f0', 'f1', 'f3']
+    assert list(make_dataset.prefilter_features(table, min_prevalence=0.5).feature_ids) == ['f0', 'f3']
+    # f0 and f3 have the same counts, their relative abundances only vary with f1
+    X[0, 1] = 0
+    table = table._replace(matrix=sparse.csr_matrix(X))
+    assert list(make_dataset.prefilter_features(table, min_variance=1e-12).feature_ids) == []
+
+def test_shared_split_stratifies_rare_classes():
+    n = 500
+    # ckd-like target: 10 positives, some unlabeled samples
+    labels = np.array(['F'] * (n - 10) + ['T'] * 10, dtype=object)
+    labels[:40] = None
+    sample_ids = pd.Index(['s%d' % i for i in range(n)])
+    targets = {'common': pd.Series(np.where(np.arange(n) % 2, 'T', 'F'), index=sample_ids),
+               'rare': pd.Series(labels, index=sample_ids)}
+    strata = binary_relevance.rarest_label(targets, sample_ids)
+    assert (strata == 'T').sum() == 10 and (strata == '').sum() == 40
+
+    is_test, folds = binary_relevance.shared_split(n, test_size=0.3, cv=5, random_state=0, strata=strata)
+    rare = strata == 'T'
+    assert is_test[rare].sum() == 3
+    # Every fold gets one or two of the 7 training positives, and folds stay the same size
+    assert sorted(np.bincount(folds[rare & ~is_test], minlength=5)) == [1, 1, 1, 2, 2]
+    assert np.ptp(np.bincount(folds[~is_test])) <= 1
+    assert (folds[is_test] == -1).all() and (folds[~is_test] >= 0).all()
+    assert abs(is_test.mean() - 0.3) < 0.01
+
+def test_shared_split_without_strata_is_a_random_split():
+    is_test, folds = binary_relevance.shared_split(100, test_size=0.3, cv=10, random_state=1)
+    assert is_test.sum() == 30
+    assert sorted(np.bincount(folds[~is_test])) == [7] * 10
+
+def test_estimator_params_must_match_the_estimator(synthetic_table):
+    table, targets = synthetic_table
+    tuned = {'ibd': {'subsample': 0.8, 'max_features': 'sqrt', 'n_estimators': 20}}
+    with pytest.raises(ValueError, match='ibd are not parameters of the hist_gradient_boosting estimator: .*subsample'):
+        binary_relevance.binary_relevance_shared(table, targets, cv=3, estimator='hist_gradient_boosting',
+                                                 estimator_params=tuned)
+    results = binary_relevance.binary_relevance_shared(table, targets, cv=3, estimator_params=tuned)
+    assert results['ibd'].sample_estimator.n_estimators == 20
@@ -0,0 +1,57 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.data import make_dataset
+from src.features import build_features
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+@pytest.fixture
+def feature_params():
+    with open(os.path.join(ROOT, 'config/feature-params.json')) as fh:
+        return json.load(fh)
+
+def edge_case_metadata(feature_params):
+    """Raw metadata with the value representations seen in the Qiita export, and harder ones"""
+    n = 12
+    df = pd.DataFrame(index=pd.Index(['s%d' % i for i in range(n)], name='#SampleID'))
+    for col in feature_params['disease_cols']:
+        df[col] = ['1', '0', 1, 0.0, '1.0', ' 0 ', 'not provided', '1', '0', np.nan, '1', 'not applicable']
+    df['diabetes2_v2'] = ['1', '2', 3, '3.0', ' 1 ', '2', 'not provided', '1e0', '3', np.nan, '2', '1']
+    df['ckd_v2'] = ['1', '2', 3, '4.0', ' 5', '1', '2', '1', '3', '2', '1', '1']
+    df['agegroup_c6_v2'] = ['1', ' 2 ', 'nan', 'NaN', 'inf', '-1e3', '1_000', 'not applicable', 'abc', '', 'not provided', 3]
+    df['hispanic_origin'] = ['Mexican', '1', 'nan', ' Cuban ', 'Other', np.nan, '2.5', 'x', 'y', 'z', 'w', 'v']
+    return df
+
+def test_clean_metadata_matches_rowwise_on_edge_cases(feature_params):
+    metadata = edge_case_metadata(feature_params)
+    params = {k: feature_params[k] for k in ['disease_cols', 'additional_info_cols', 'diabetes_binary', 'ckd_binary']}
+    rowwise = build_features.clean_metadata_rowwise(metadata, **params)
+    vectorized = build_features.clean_metadata(metadata, **params)
+    pd.testing.assert_frame_equal(vectorized, rowwise)
+    assert vectorized.to_csv(sep='\t') == rowwise.to_csv(sep='\t')
+
+def test_unified_rep_frame_matches_unified_rep_values():
+    col = pd.Series(['nan', ' 12 ', '1e3', 'inf', '1_000', 'abc', np.nan, 7, '', 'Infinity'], dtype=object)
+    df = pd.DataFrame({'mixed': col, 'numeric': [1, 2, 3, 4, 5, 6, 7, 8, 9, 10], 'strings': list('abcdefghij')})
+    expected = df.apply(build_features.unified_rep_values)
+    pd.testing.assert_frame_equal(build_features.unified_rep_frame(df), expected)
+
+def test_balance_precvd_draws_from_the_given_samples(tmp_path):
+    ids = ['s%d' % i for i in range(20)]
+    metadata = pd.DataFrame({'precvd_v2': ['T'] * 6 + ['F'] * 14}, index=pd.Index(ids, name='#SampleID'))
+    path = str(tmp_path / 'balanced.tsv')
+    balanced = build_features.balance_precvd(metadata, path=path).to_dataframe()['precvd_v2']
+    assert balanced.value_counts().to_dict() == {'T': 6, 'F': 6}
+
+    # Samples s0, s1 (T) and s10 (F) were removed by rarefaction
+    kept = [x for x in ids if x not in ['s0', 's1', 's10']]
+    balanced = build_features.balance_precvd(metadata, kept, path=path).to_dataframe()['precvd_v2']
+    assert balanced.value_counts().to_dict() == {'T': 4, 'F': 4}
+    assert set(balanced.index) <= set(kept)
+    make_dataset.flush_writes()
+    assert len(pd.read_csv(path, sep='\t')) == 8
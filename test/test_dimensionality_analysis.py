@@ -0,0 +1,26 @@
+import numpy as np
+import pytest
+from scipy import sparse
+
+from src.visualizations import dimensionality_analysis
+
+def test_umap_knn_graph_is_saved_and_reused(tmp_path):
+    pytest.importorskip('umap')
+    X = np.random.default_rng(0).random((60, 40), dtype=np.float32)
+    knn = dimensionality_analysis.umap_knn_graph(X, 5, 'euclidean', cache_dir=str(tmp_path))
+    assert knn[0].shape == (60, 5)
+    assert len(list(tmp_path.glob('knn_*.pkl'))) == 1
+    reloaded = dimensionality_analysis.umap_knn_graph(X, 5, 'euclidean', cache_dir=str(tmp_path))
+    np.testing.assert_array_equal(reloaded[0], knn[0])
+
+def test_umap_knn_key_follows_the_input_and_parameters():
+    pytest.importorskip('umap')
+    X = sparse.random(30, 20, density=0.2, format='csr', random_state=0, dtype=np.float32)
+    key = dimensionality_analysis._knn_key(X, 5, 'braycurtis', 10)
+    assert dimensionality_analysis._knn_key(X.copy(), 5, 'braycurtis', 10) == key
+    modified = X.copy()
+    modified.data[0] += 1
+    assert dimensionality_analysis._knn_key(modified, 5, 'braycurtis', 10) != key
+    assert dimensionality_analysis._knn_key(X, 6, 'braycurtis', 10) != key
+    assert dimensionality_analysis._knn_key(X, 5, 'jaccard', 10) != key
+    assert dimensionality_analysis._knn_key(X.toarray(), 5, 'braycurtis', 10) != key
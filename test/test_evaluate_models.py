@@ -0,0 +1,77 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn import metrics
+
+from src.models import evaluate_models
+
+# Fields of the q2-sample-classifier classify_samples results used by the evaluation
+ClassifierResults = namedtuple('ClassifierResults', ['predictions', 'probabilities', 'test_targets'])
+
+class ArtifactView:
+    """Artifact holding a pandas view, as the classify_samples outputs"""
+    def __init__(self, value):
+        self.value = value
+
+    def view(self, view_type):
+        assert view_type is type(self.value)
+        return self.value
+
+def classifier_results(n_diseases=3, n_samples=400, test_size=120, random_state=0):
+    """classify_samples shaped results with 'T'/'F' labels on a different test set for every disease"""
+    rng = np.random.default_rng(random_state)
+    sample_ids = np.array(['s%d' % i for i in range(n_samples)])
+    results = {}
+    for j in range(n_diseases):
+        test_ids = rng.choice(sample_ids, test_size, replace=False)
+        y = rng.random(test_size) < 0.2 + 0.1 * j
+        # Rounded probabilities, so ranks have ties
+        p = np.round(np.clip(0.35 * y + 0.65 * rng.random(test_size), 0, 1), 2)
+        results['d%d' % j] = ClassifierResults(
+            ArtifactView(pd.Series(np.where(p >= 0.5, 'T', 'F'), index=test_ids)),
+            ArtifactView(pd.DataFrame({'F': 1 - p, 'T': p}, index=test_ids)),
+            ArtifactView(pd.Series(np.where(y, 'T', 'F'), index=test_ids)))
+    return results
+
+def test_binary_relevance_scores_match_sklearn():
+    results = classifier_results()
+    diseases = list(results)
+    scores, aucs = evaluate_models.binary_relevance_scores(results, diseases)
+    for d in diseases:
+        y = (results[d].test_targets.value == 'T').astype(int)
+        p = (results[d].predictions.value == 'T').astype(int)
+        s = results[d].probabilities.value['T']
+        assert scores.loc[d, 'accuracy'] == pytest.approx(metrics.accuracy_score(y, p))
+        assert scores.loc[d, 'precision'] == pytest.approx(metrics.precision_score(y, p))
+        assert scores.loc[d, 'recall'] == pytest.approx(metrics.recall_score(y, p))
+        assert scores.loc[d, 'f1'] == pytest.approx(metrics.f1_score(y, p))
+        assert aucs[d][1] == pytest.approx(metrics.roc_auc_score(y, s))
+        assert aucs[d][0] == pytest.approx(metrics.roc_auc_score(np.column_stack([1 - y, y]),
+                                                                 np.column_stack([1 - s, s]), average='micro'))
+    assert evaluate_models.binary_relevance_accuracy_scores(results, diseases) == \
+        pytest.approx(scores.loc[diseases, 'accuracy'].to_dict())
+
+def test_multi_label_scores_match_sklearn():
+    rng = np.random.default_rng(1)
+    ids = ['s%d' % i for i in range(200)]
+    Y = pd.DataFrame((rng.random((200, 4)) < 0.3).astype(int), index=ids, columns=list('abcd'))
+    S = pd.DataFrame(np.round(np.clip(0.3 * Y.values + 0.7 * rng.random((200, 4)), 0, 1), 2), index=ids, columns=Y.columns)
+    P = (S >= 0.5).astype(int)
+    accuracy, aucs, scores = evaluate_models.multi_label_scores(Y, P, S)
+    assert scores.loc['micro', 'f1'] == pytest.approx(metrics.f1_score(Y, P, average='micro'))
+    assert scores.loc['macro', 'f1'] == pytest.approx(metrics.f1_score(Y, P, average='macro'))
+    assert scores.loc['micro', 'micro_auc'] == pytest.approx(metrics.roc_auc_score(Y, S, average='micro'))
+    assert scores.loc['macro', 'macro_auc'] == pytest.approx(metrics.roc_auc_score(Y, S, average='macro'))
+    assert scores.loc['micro', 'hamming_loss'] == pytest.approx(metrics.hamming_loss(Y, P))
+    assert scores.loc['micro', 'subset_accuracy'] == pytest.approx(metrics.accuracy_score(Y, P))
+    assert accuracy['a'] == pytest.approx(metrics.accuracy_score(Y['a'], P['a']))
+
+def test_bootstrap_intervals_contain_the_score():
+    results = classifier_results()
+    scores, _ = evaluate_models.binary_relevance_scores(results, list(results), n_bootstrap=200, batch_size=64)
+    for name in ['accuracy', 'f1', 'macro_auc']:
+        rows = scores[name].notna()
+        assert (scores.loc[rows, name + '_low'] <= scores.loc[rows, name]).all()
+        assert (scores.loc[rows, name] <= scores.loc[rows, name + '_high']).all()
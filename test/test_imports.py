@@ -0,0 +1,11 @@
+import importlib
+
+import pytest
+
+import run
+
+@pytest.mark.parametrize('target', sorted(run.TARGET_MODULES))
+def test_target_modules_import(target):
+    # Every module a run.py target loads imports on the pinned environment
+    for name in run.TARGET_MODULES[target]:
+        importlib.import_module(name)
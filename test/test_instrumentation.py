@@ -0,0 +1,31 @@
+import json
+import threading
+import time
+
+from src.profiling import instrumentation
+
+def spin(seconds):
+    # Spins on this thread's CPU time, so the threads spend it even on a loaded machine
+    end = time.thread_time() + seconds
+    while time.thread_time() < end:
+        pass
+
+def work_in_threads(n_threads=2, seconds=0.2):
+    threads = [threading.Thread(target=spin, args=(seconds,)) for _ in range(n_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def test_cpu_time_includes_worker_threads(tmp_path):
+    profiled = instrumentation.profiled(work_in_threads, 'test.work_in_threads')
+    profiled()
+    path = str(tmp_path / 'profile.json')
+    instrumentation.write_profile(path)
+    with open(path) as fh:
+        profile = json.load(fh)
+    stats = profile['functions']['test.work_in_threads']
+    # The calling thread only waits, the CPU time is spent by the two worker threads
+    assert stats['cpu_time'] > 0.2
+    assert profile['cpu_time'] == instrumentation.CPU_TIME
+    assert profile['calls'][-1]['input_sizes'] == {}
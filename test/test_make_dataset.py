@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+from src.data import make_dataset
+
+@pytest.fixture
+def feature_matrix():
+    X = sparse.random(50, 30, density=0.2, format='csr', random_state=1) * 10
+    return make_dataset.FeatureMatrix(X.tocsr(), pd.Index(['s%d' % i for i in range(50)], name='SampleID'),
+                                      pd.Index(['f%d' % i for i in range(30)], name='FeatureID'))
+
+def test_feature_matrix_columnar_round_trip(feature_matrix, tmp_path):
+    path = make_dataset.save_feature_matrix(feature_matrix, str(tmp_path / 'table'))
+    loaded = make_dataset.read_feature_table(path)
+    assert (loaded.matrix != feature_matrix.matrix).nnz == 0
+    assert loaded.sample_ids.equals(feature_matrix.sample_ids)
+    assert loaded.feature_ids.equals(feature_matrix.feature_ids)
+
+def test_load_feature_matrix_selects_samples_and_features(feature_matrix, tmp_path):
+    path = make_dataset.save_feature_matrix(feature_matrix, str(tmp_path / 'table'))
+    loaded = make_dataset.load_feature_matrix(path, sample_ids=['s7', 's3', 'unknown', 's40', 's0'],
+                                              feature_ids=['f29', 'f2', 'unknown', 'f10'])
+    assert list(loaded.sample_ids) == ['s7', 's3', 's40', 's0']
+    assert list(loaded.feature_ids) == ['f29', 'f2', 'f10']
+    expected = feature_matrix.matrix[[7, 3, 40, 0]][:, [29, 2, 10]].toarray()
+    np.testing.assert_array_equal(loaded.matrix.toarray(), expected)
+
+def test_columnar_metadata_copy(tmp_path):
+    pytest.importorskip('pyarrow')
+    df = pd.DataFrame({'ibd': ['T', 'F', np.nan], 'age': [30.0, 41.5, np.nan], 'mixed': [1, 'a', np.nan]},
+                      index=pd.Index(['a', 'b', 'c'], name='#SampleID'))
+    path = str(tmp_path / 'final_metadata_tf.tsv')
+    make_dataset.configure_columnar(True)
+    try:
+        make_dataset.write_behind(df, path)
+        make_dataset.flush_writes()
+    finally:
+        make_dataset.configure_columnar(False)
+    subset = make_dataset.read_columnar_table(path, columns=['ibd', 'age'], sample_ids=['c', 'a'])
+    assert sorted(subset.index) == ['a', 'c']
+    assert list(subset.columns) == ['ibd', 'age']
+    assert subset.loc['a', 'ibd'] == 'T'
@@ -0,0 +1,129 @@
+import numpy as np
+import pandas as pd
+import pytest
+import skbio
+from qiime2 import Artifact
+from scipy.spatial.distance import pdist, squareform
+
+from src.features import metrics_analysis
+
+@pytest.fixture
+def distances():
+    rng = np.random.default_rng(0)
+    points = rng.random((40, 5))
+    ids = ['s%d' % i for i in range(40)]
+    condensed = pdist(points).astype(np.float32)
+    return metrics_analysis.CondensedDistances(ids, condensed), squareform(condensed.astype(np.float64)), ids
+
+@pytest.mark.parametrize('block_pairs', [1, 50, 1 << 20])
+def test_rows_expand_the_condensed_matrix(distances, block_pairs):
+    condensed, dense, _ = distances
+    np.testing.assert_allclose(condensed.rows([3, 0, 39], block_pairs=block_pairs), dense[[3, 0, 39]], rtol=1e-6)
+
+@pytest.mark.parametrize('block_pairs', [1, 7, 1 << 22])
+def test_filter_matches_the_dense_subset(distances, block_pairs):
+    condensed, dense, ids = distances
+    subset = [ids[i] for i in [31, 2, 17, 5, 39, 0]]
+    filtered = condensed.filter(subset, block_pairs=block_pairs)
+    positions = [31, 2, 17, 5, 39, 0]
+    assert filtered.ids == subset
+    np.testing.assert_allclose(squareform(np.asarray(filtered.data, dtype=np.float64)),
+                               dense[np.ix_(positions, positions)], rtol=1e-6)
+
+def test_filter_of_one_sample(distances):
+    condensed, _, ids = distances
+    assert len(condensed.filter(ids[:1]).data) == 0
+
+def test_extend_appends_new_samples(distances, tmp_path):
+    condensed, dense, ids = distances
+    head = condensed.filter(ids[:30])
+    new_distances = dense[30:, :]
+    extended = head.extend(ids[30:], new_distances, path=str(tmp_path / 'extended'))
+    assert extended.ids == ids
+    np.testing.assert_allclose(squareform(np.asarray(extended.data, dtype=np.float64)), dense, rtol=1e-6)
+
+def test_gower_operator_matches_the_dense_centered_matrix(distances):
+    condensed, dense, _ = distances
+    n = len(dense)
+    J = np.eye(n) - 1.0 / n
+    B = -0.5 * J @ (dense ** 2) @ J
+    Q = np.random.default_rng(1).random((n, 3))
+    gower = condensed.gower(block_pairs=16 * n)
+    np.testing.assert_allclose(gower @ Q, B @ Q, rtol=1e-5, atol=1e-8)
+    assert gower.trace() == pytest.approx(np.trace(B), rel=1e-5)
+
+@pytest.fixture
+def euclidean_distances():
+    rng = np.random.default_rng(2)
+    points = rng.random((60, 3)) * [4.0, 2.0, 1.0]
+    ids = ['s%d' % i for i in range(60)]
+    return skbio.DistanceMatrix(squareform(pdist(points)), ids)
+
+def test_randomized_eigh_matches_numpy(euclidean_distances):
+    B = metrics_analysis.gower_centered(euclidean_distances.data)
+    eigvals, eigvecs = metrics_analysis.randomized_eigh(B, 3, tol=1e-8)
+    expected = np.sort(np.linalg.eigvalsh(B))[::-1][:3]
+    np.testing.assert_allclose(eigvals, expected, rtol=1e-6)
+    np.testing.assert_allclose(B @ eigvecs, eigvecs * eigvals, atol=1e-6)
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_randomized_pcoa_matches_skbio(euclidean_distances, compact):
+    if compact:
+        distance_matrix = metrics_analysis.CondensedDistances(list(euclidean_distances.ids),
+                                                              euclidean_distances.condensed_form())
+    else:
+        distance_matrix = Artifact.import_data('DistanceMatrix', euclidean_distances)
+    result = metrics_analysis.fast_pcoa(distance_matrix, 3, tol=1e-8).view(skbio.OrdinationResults)
+    expected = skbio.stats.ordination.pcoa(euclidean_distances, number_of_dimensions=3)
+    np.testing.assert_allclose(result.eigvals.values, expected.eigvals.values[:3], rtol=1e-5)
+    np.testing.assert_allclose(result.proportion_explained.values, expected.proportion_explained.values[:3], rtol=1e-5)
+    # Axes are defined up to their sign
+    np.testing.assert_allclose(np.abs(result.samples.values), np.abs(expected.samples.values[:, :3]), atol=1e-5)
+
+def test_landmark_pcoa_preserves_euclidean_distances(euclidean_distances):
+    distance_matrix = Artifact.import_data('DistanceMatrix', euclidean_distances)
+    result = metrics_analysis.fast_pcoa(distance_matrix, 3, method='landmark', n_landmarks=20).view(skbio.OrdinationResults)
+    assert list(result.samples.index) == list(euclidean_distances.ids)
+    np.testing.assert_allclose(squareform(pdist(result.samples.values)), euclidean_distances.data, atol=1e-6)
+    assert result.proportion_explained.sum() == pytest.approx(1.0)
+
+@pytest.fixture
+def groupings(euclidean_distances):
+    ids = list(euclidean_distances.ids)
+    rng = np.random.default_rng(3)
+    # shifted_distances moves the first 30 samples along the first axis
+    separated = pd.Series(np.where(np.arange(60) < 30, 'T', 'F'), index=ids)
+    random = pd.Series(rng.choice(['a', 'b', 'c'], 60), index=ids)
+    # Unlabelled samples are tested on their own sample set
+    partial = random.where(np.arange(60) % 4 != 0)
+    return {'separated': separated, 'random': random, 'partial': partial}
+
+@pytest.fixture
+def shifted_distances(euclidean_distances):
+    points = np.random.default_rng(2).random((60, 3)) * [4.0, 2.0, 1.0]
+    points[:30, 0] += 3.0
+    return skbio.DistanceMatrix(squareform(pdist(points)), euclidean_distances.ids)
+
+@pytest.mark.parametrize('compact', [False, True])
+def test_permanova_batch_matches_skbio(shifted_distances, groupings, compact):
+    if compact:
+        distance_matrix = metrics_analysis.CondensedDistances(list(shifted_distances.ids), shifted_distances.condensed_form())
+    else:
+        distance_matrix = Artifact.import_data('DistanceMatrix', shifted_distances)
+    results = metrics_analysis.permanova_batch(distance_matrix, groupings, permutations=199,
+                                               chunk_size=64).set_index('grouping')
+    for name, grouping in groupings.items():
+        grouping = grouping.dropna()
+        expected = skbio.stats.distance.permanova(shifted_distances.filter(grouping.index), grouping.values,
+                                                 permutations=0)
+        assert results.loc[name, 'sample_size'] == expected['sample size']
+        assert results.loc[name, 'number_of_groups'] == expected['number of groups']
+        assert results.loc[name, 'test_statistic'] == pytest.approx(expected['test statistic'], rel=1e-5)
+    assert results.loc['separated', 'p_value'] == pytest.approx(1 / 200)
+    assert results.loc['random', 'p_value'] > 0.05
+
+def test_permanova_batch_is_reproducible(shifted_distances, groupings):
+    distance_matrix = Artifact.import_data('DistanceMatrix', shifted_distances)
+    first = metrics_analysis.permanova_batch(distance_matrix, groupings, permutations=99, chunk_size=10)
+    second = metrics_analysis.permanova_batch(distance_matrix, groupings, permutations=99, chunk_size=99)
+    pd.testing.assert_frame_equal(first, second)
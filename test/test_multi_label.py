@@ -0,0 +1,27 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from src.models import multi_label
+
+def test_label_matrix_of_tf_labels():
+    ids = pd.Index(['a', 'b', 'c', 'd'])
+    Y = multi_label.label_matrix({'ibd': pd.Series(['T', 'F', np.nan], index=['a', 'b', 'c'])}, ids)
+    assert Y['ibd'].tolist()[:2] == [1, 0]
+    assert Y['ibd'].isna().tolist() == [False, False, True, True]
+
+@pytest.mark.parametrize('mode', multi_label.MODES)
+def test_multi_label_shared_fits_tf_targets(mode, synthetic_table):
+    table, targets = synthetic_table
+    result = multi_label.multi_label_shared(table, targets, modes=[mode], compare=True)[mode]
+    assert list(result.predictions.columns) == ['ibd', 'diabetes']
+    assert len(result.predictions) == len(result.test_targets) > 0
+    assert set(np.unique(result.test_targets.values)) <= {0, 1}
+    assert ((result.probabilities.values >= 0) & (result.probabilities.values <= 1)).all()
+    assert result.separate_fit_seconds is not None
+
+def test_fit_multi_label_without_complete_samples(synthetic_table):
+    table, targets = synthetic_table
+    targets['ibd'] = targets['ibd'].iloc[:0]
+    with pytest.raises(ValueError, match='labeled for every disease'):
+        multi_label.multi_label_shared(table, targets)
@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.linear_model import LogisticRegression
+
+from src.data import make_dataset
+from src.models.predict import DiseaseClassifiers
+
+def test_positive_class_of_tf_labels():
+    assert DiseaseClassifiers.positive_class(['F', 'T']) == 1
+    assert DiseaseClassifiers.positive_class(['T', 'F']) == 0
+    assert DiseaseClassifiers.positive_class([False, True]) == 1
+    assert DiseaseClassifiers.positive_class([0, 1]) == 1
+
+def test_predict_proba_aligns_features_and_scores_positive_class():
+    rng = np.random.default_rng(0)
+    X = rng.poisson(1.0, size=(40, 5)).astype(float)
+    y = np.where(X[:, 0] > 1, 'T', 'F')
+    features = ['f0', 'f1', 'f2', 'f3', 'f4']
+    estimator = LogisticRegression().fit(X, y)
+    classifiers = DiseaseClassifiers({'ibd': {'estimator': estimator, 'feature_ids': features}})
+
+    # Scored table has its features in another order plus an unseen one
+    order = [4, 2, 0, 1, 3]
+    scored = make_dataset.FeatureMatrix(sparse.csr_matrix(np.column_stack([X[:, order], np.ones(40)])),
+                                        pd.Index(['s%d' % i for i in range(40)], name='SampleID'),
+                                        pd.Index([features[i] for i in order] + ['unseen'], name='FeatureID'))
+    proba = classifiers.predict_proba(scored, chunk_size=7)
+    expected = estimator.predict_proba(X)[:, list(estimator.classes_).index('T')]
+    np.testing.assert_allclose(proba['ibd'].values, expected)
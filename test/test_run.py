@@ -0,0 +1,25 @@
+import os
+import subprocess
+import sys
+
+import run
+from src.pipeline import stages
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_load_context_provides_every_stage_input(monkeypatch):
+    monkeypatch.chdir(ROOT)
+    context = run.load_context()
+    assert sorted(context) == sorted(name for name, _ in run.CONTEXT_FILES)
+    produced = set(context)
+    for s in stages.all_stages():
+        produced.update(s.outputs)
+    missing = {x for s in stages.all_stages() for x in s.inputs} - produced
+    assert not missing
+
+def test_numba_cache_is_anchored_at_the_project_root(tmp_path):
+    env = {k: v for k, v in os.environ.items() if k != 'NUMBA_CACHE_DIR'}
+    env['PYTHONPATH'] = os.pathsep.join([ROOT, env.get('PYTHONPATH', '')])
+    output = subprocess.run([sys.executable, '-c', 'import os, run; print(os.environ["NUMBA_CACHE_DIR"])'], cwd=str(tmp_path),
+                            env=env, stdout=subprocess.PIPE, universal_newlines=True, check=True).stdout
+    assert output.strip() == os.path.join(ROOT, 'data', 'numba_cache')
@@ -0,0 +1,85 @@
+import threading
+import time
+
+import pytest
+
+from src.data.stage_cache import StageCache
+from src.pipeline import scheduler
+
+def add(a, b):
+    return a + b
+
+def split(total):
+    return total // 2, total - total // 2
+
+def product(left, right):
+    return left * right
+
+def fail(total):
+    raise RuntimeError('stage failed')
+
+def graph():
+    return [scheduler.stage('add', add, inputs=['a', 'b'], outputs=['total']),
+            scheduler.stage('split', split, inputs=['total'], outputs=['left', 'right']),
+            scheduler.stage('product', product, inputs=['left', 'right'], outputs=['result']),
+            scheduler.stage('double', lambda total: 2 * total, inputs=['total'], outputs=['doubled'])]
+
+def test_run_pipeline_passes_outputs_to_dependent_stages():
+    context, timings = scheduler.run_pipeline(graph(), {'a': 3, 'b': 4}, n_workers=2)
+    assert (context['total'], context['left'], context['right']) == (7, 3, 4)
+    assert context['result'] == 12
+    assert context['doubled'] == 14
+    assert set(timings) == {'add', 'split', 'product', 'double'}
+    assert timings['add'][1] <= timings['split'][0]
+    assert timings['split'][1] <= timings['product'][0]
+
+def test_select_stages_adds_dependencies_and_dependents():
+    stages = graph()
+    assert [s.name for s in scheduler.select_stages(stages, only=['split'])] == ['add', 'split']
+    assert [s.name for s in scheduler.select_stages(stages, start_from=['split'])] == ['add', 'split', 'product']
+    with pytest.raises(ValueError, match='Unknown stages: missing'):
+        scheduler.select_stages(stages, only=['missing'])
+
+def test_run_pipeline_rejects_missing_inputs():
+    with pytest.raises(ValueError, match='No stage produces: b'):
+        scheduler.run_pipeline(graph(), {'a': 3})
+
+def test_outputs_must_have_one_producer():
+    stages = graph() + [scheduler.stage('other', add, inputs=['a', 'b'], outputs=['total'])]
+    with pytest.raises(ValueError, match='total is produced by both add and other'):
+        scheduler.producers(stages)
+
+def test_stage_errors_propagate():
+    stages = graph()[:1] + [scheduler.stage('fail', fail, inputs=['total'])]
+    with pytest.raises(RuntimeError, match='stage failed'):
+        scheduler.run_pipeline(stages, {'a': 3, 'b': 4}, n_workers=2)
+
+def test_independent_stages_run_concurrently_unless_they_share_a_resource():
+    barrier = threading.Barrier(2, timeout=5)
+    concurrent = scheduler.run_pipeline([scheduler.stage(name, barrier.wait) for name in ['first', 'second']], {},
+                                        n_workers=2)[1]
+    assert set(concurrent) == {'first', 'second'}
+
+    active, overlaps = [], []
+    def exclusive():
+        active.append(1)
+        overlaps.append(len(active))
+        time.sleep(0.05)
+        active.pop()
+    stages = [scheduler.stage(name, exclusive, resources=['pyplot']) for name in ['first', 'second']]
+    scheduler.run_pipeline(stages, {}, n_workers=2)
+    assert overlaps == [1, 1]
+
+def test_cached_stages_are_reloaded(tmp_path):
+    cache = StageCache(str(tmp_path / 'cache'))
+    stages = [scheduler.stage('add', add, inputs=['a', 'b'], outputs=['total'], cached=True)]
+    scheduler.run_pipeline(stages, {'a': 3, 'b': 4}, cache=cache)
+    context, _ = scheduler.run_pipeline(stages, {'a': 3, 'b': 4}, cache=cache)
+    assert context['total'] == 7
+    assert cache.stats().loc['add', 'hits'] == 1
+
+def test_critical_path_follows_the_longest_chain():
+    timings = {'add': (0.0, 1.0), 'split': (1.0, 2.0), 'product': (2.0, 5.0), 'double': (1.0, 4.5)}
+    path, total = scheduler.critical_path(graph(), timings)
+    assert path == ['add', 'split', 'product']
+    assert total == pytest.approx(5.0)
@@ -0,0 +1,135 @@
+import hashlib
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import sparse
+
+from src.data import make_dataset, stage_cache
+from src.pipeline import stages
+
+@pytest.fixture
+def fresh_digests():
+    stage_cache.module_digest.cache_clear()
+    yield
+    stage_cache.module_digest.cache_clear()
+
+def test_function_identity_follows_helper_modules(tmp_path, monkeypatch, fresh_digests):
+    original = stage_cache._module_file('src.features.build_features')
+    copy = str(tmp_path / 'build_features.py')
+    shutil.copy(original, copy)
+    module_file = stage_cache._module_file
+    monkeypatch.setattr(stage_cache, '_module_file',
+                        lambda name: copy if name == 'src.features.build_features' else module_file(name))
+
+    before = {s.name: stage_cache.function_identity(s.func) for s in stages.all_stages()}
+    with open(copy, 'a') as fh:
+        fh.write('\n# helper edited\n')
+    stage_cache.module_digest.cache_clear()
+    after = {s.name: stage_cache.function_identity(s.func) for s in stages.all_stages()}
+
+    # Stages calling build_features change, stages that never use it keep their cache entries
+    assert before['organize_metadata'] != after['organize_metadata']
+    assert before['qiime_metadata'] != after['qiime_metadata']
+    assert before['load_tree'] == after['load_tree']
+    assert before['calculate_pcoa'] == after['calculate_pcoa']
+
+def test_module_imports_include_deferred_and_submodule_imports():
+    imports = stage_cache._module_imports(stage_cache._module_file('src.models.evaluate_models'))
+    assert {'src.models.multi_label', 'src.models.predict'} <= imports
+    imports = stage_cache._module_imports(stage_cache._module_file('src.pipeline.stages'))
+    assert 'src.data.make_dataset' in imports
+
+def compute(table, factor, side_file, calls):
+    calls.append(factor)
+    with open(side_file, 'w') as fh:
+        fh.write(str(factor))
+    return {'scaled': table._replace(matrix=table.matrix * factor), 'total': pd.Series([table.matrix.sum() * factor])}
+
+def test_stage_cache_reloads_identical_stages(tmp_path):
+    cache = stage_cache.StageCache(cache_dir=str(tmp_path / 'cache'))
+    table = make_dataset.FeatureMatrix(sparse.csr_matrix(np.arange(6.0).reshape(2, 3)), pd.Index(['a', 'b']),
+                                       pd.Index(['f0', 'f1', 'f2']))
+    side_file = str(tmp_path / 'side.txt')
+    calls = []
+    first = cache.run('compute', compute, table, 2, side_file, [], side_files=[side_file])
+    os.remove(side_file)
+    second = cache.run('compute', compute, table, 2, side_file, calls, side_files=[side_file])
+    assert calls == []
+    assert isinstance(second['scaled'], make_dataset.FeatureMatrix)
+    assert (second['scaled'].matrix != first['scaled'].matrix).nnz == 0
+    pd.testing.assert_series_equal(second['total'], first['total'])
+    with open(side_file) as fh:
+        assert fh.read() == '2'
+
+    cache.run('compute', compute, table, 3, side_file, calls, side_files=[side_file])
+    assert calls == [3]
+    stats = cache.index['stats']
+    assert (stats['hits'], stats['misses']) == (1, 2)
+
+def condense(distance_matrices, calls):
+    calls.append(sorted(distance_matrices))
+    return {metric: distances.filter(distances.ids[:3]) for metric, distances in distance_matrices.items()}
+
+def identity(distance_matrices):
+    return distance_matrices
+
+def test_stage_cache_keys_and_reloads_compact_distance_matrices(tmp_path):
+    from src.features.metrics_analysis import CondensedDistances
+    ids = ['s%d' % i for i in range(5)]
+    path = str(tmp_path / 'braycurtis')
+    np.save(path + '.npy', np.arange(10, dtype=np.float32))
+    with open(path + '.ids.txt', 'w') as fh:
+        fh.write('\n'.join(ids))
+
+    cache = stage_cache.StageCache(cache_dir=str(tmp_path / 'cache'))
+    calls = []
+    first = cache.run('condense', condense, {'braycurtis': CondensedDistances.load(path)}, [])
+    # A new object memory-mapping the same distances has the same key
+    second = cache.run('condense', condense, {'braycurtis': CondensedDistances.load(path)}, calls)
+    assert calls == []
+    assert isinstance(second['braycurtis'], CondensedDistances)
+    assert second['braycurtis'].ids == ids[:3]
+    np.testing.assert_array_equal(second['braycurtis'].data, first['braycurtis'].data)
+
+    # Cached memory-mapped matrices are reloaded memory-mapped, and hashed by content
+    stored = cache.run('identity', identity, {'braycurtis': CondensedDistances.load(path)})
+    reloaded = cache.run('identity', identity, stored)
+    assert isinstance(reloaded['braycurtis'].data, np.memmap)
+    assert reloaded['braycurtis'].data.filename != stored['braycurtis'].data.filename
+    cache.run('identity', identity, reloaded)
+    assert cache.stats().loc['identity', 'hits'] == 2
+
+    modified = np.arange(10, dtype=np.float32)
+    modified[4] = 100
+    cache.run('condense', condense, {'braycurtis': CondensedDistances(ids, modified)}, calls)
+    assert calls == [['braycurtis']]
+
+def test_stage_inputs_without_a_stable_hash_are_rejected():
+    digest = hashlib.sha256()
+    stage_cache._hash_value({'n_neighbors': np.int64(15), 'metric': 'braycurtis', 'params': [0.1, None, True]}, digest)
+    with pytest.raises(TypeError, match='object has no stable hash'):
+        stage_cache._hash_value({'estimator': object()}, digest)
+
+def queue_side_file(side_file):
+    # The side file is only saved by the before_store hook, like a write-behind save
+    return side_file
+
+def test_before_store_runs_before_side_files_are_stored(tmp_path):
+    flushed = []
+    def flush(side_files):
+        flushed.append(side_files)
+        for f in side_files:
+            with open(f, 'w') as fh:
+                fh.write('saved')
+    cache = stage_cache.StageCache(cache_dir=str(tmp_path / 'cache'), before_store=flush)
+    side_file = str(tmp_path / 'side.txt')
+    cache.run('queue_side_file', queue_side_file, side_file, side_files=[side_file])
+    os.remove(side_file)
+    cache.run('queue_side_file', queue_side_file, side_file, side_files=[side_file])
+    # The hit restores the stored side file without calling the hook
+    assert flushed == [[side_file]]
+    with open(side_file) as fh:
+        assert fh.read() == 'saved'